@@ -1,20 +1,23 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response, g, has_request_context
 import openai
 import os
 import sys
 from dotenv import load_dotenv
 import json
-from datetime import datetime
+import copy
+from datetime import datetime, timedelta
 import csv
 import time
 import hashlib
 import ssl
+import socket
 import certifi
 import urllib3
 import re
 import glob
 import uuid
 import zipfile
+import textwrap
 import tempfile
 from pathlib import Path
 from functools import lru_cache, wraps
@@ -22,12 +25,25 @@ from werkzeug.utils import secure_filename
 import numpy as np
 from sklearn.cluster import KMeans
 import threading
-import tempfile as _tempfile
-import fcntl as _fcntl
-import errno as _errno
+import atexit
 import redis as _redis
 import rq as _rq
 from rq.job import Job as _RQJob
+from storage.log_store import SegmentedLogStore, DEFAULT_SEGMENT_MAX_BYTES, dedupe_entries
+from storage.write_behind import WriteBehindQueue
+from storage.shard_store import ShardedJsonStore
+from storage.json_txn import JsonDocument, try_file_lock
+from storage.lock_manager import LockManager, collect_stats
+from storage.log_index import LogIndex
+from storage.log_catalog import LogDateCatalog, list_gcs_dates
+from storage.conversation_store import ConversationStore
+from storage.session_registry import SessionRegistry
+from storage.job_notifier import JobNotifier, WaiterLimitReached
+from storage.summary_cache import SummaryCache
+from storage.memo_cache import MemoCache
+from storage.error_sampler import BurstSampler
+from storage.summary_repository import SummaryRepository
+from storage.services import ServiceContainer
 
 
 # 環境変数を読み込み
@@ -37,6 +53,14 @@ load_dotenv()
 LEARNING_PROGRESS_FILE = os.environ.get('LEARNING_PROGRESS_FILE', 'learning_progress.json')
 PROMPTS_DIR = Path('prompts')
 
+# 外部サービス（GCS・Firestore・Redis・OpenAI）のクライアントは起動時には作らず、
+# 初回利用時に作成する（コールドスタートを速くし、使わないクライアントの分を払わない）。
+# 作成に失敗したサービスは SERVICE_RETRY_INTERVAL 秒後に作り直しを試みる。
+SERVICE_RETRY_INTERVAL = float(os.environ.get('SERVICE_RETRY_INTERVAL', 30))
+# Redis の死活確認の間隔。停止中は同期処理で動き、復旧すれば再起動なしで使い始める。
+SERVICE_PROBE_INTERVAL = float(os.environ.get('SERVICE_PROBE_INTERVAL', 15))
+services = ServiceContainer(retry_interval=SERVICE_RETRY_INTERVAL)
+
 # ストレージ設定：GCS（本番環境）またはローカルJSON（開発環境）
 # 本番では FLASK_ENV=production のほか Cloud Run の環境変数 (K_SERVICE) や
 # 明示的なフラグ `USE_GCS=1` によって GCS を有効化できます。
@@ -45,39 +69,35 @@ USE_GCS = (
     or bool(os.getenv('K_SERVICE'))
     or os.getenv('USE_GCS') == '1'
 ) and bool(os.getenv('GCP_PROJECT_ID'))
+GCS_BUCKET_NAME = os.getenv('GCS_BUCKET_NAME', 'science-buddy-logs')
 
-if USE_GCS:
-    try:
-        from google.cloud import storage
-        gcp_project = os.getenv('GCP_PROJECT_ID')
-        storage_client = storage.Client(project=gcp_project)
-        bucket_name = os.getenv('GCS_BUCKET_NAME', 'science-buddy-logs')
-        bucket = storage_client.bucket(bucket_name)
-        # バケット接続確認
-        print(f"[INIT] GCS bucket '{bucket_name}' initialized successfully")
-    except Exception as e:
-        print(f"[INIT] Warning: GCS initialization failed: {e}")
-        USE_GCS = False
-        bucket = None
-else:
-    bucket = None
+
+def _create_gcs_bucket():
+    from google.cloud import storage as gcs
+    storage_client = gcs.Client(project=os.getenv('GCP_PROJECT_ID'))
+    return storage_client.bucket(GCS_BUCKET_NAME)
+
+
+services.register('gcs', _create_gcs_bucket)
+# 初回利用時に作成される。作成できないあいだは偽として扱われ、ローカル保存にフォールバックする
+bucket = services.lazy('gcs') if USE_GCS else None
 
 # Firestore optional runtime storage
 USE_FIRESTORE = os.getenv('USE_FIRESTORE', '0').lower() in ('1', 'true', 'yes')
 FIRESTORE_DATABASE = os.getenv('FIRESTORE_DATABASE')  # e.g. 'rika' for non-default DB
-if USE_FIRESTORE:
-    try:
-        from storage import firestore_store
-        FIRESTORE_PROJECT = os.getenv('GCP_PROJECT_ID') or os.getenv('GCP_PROJECT') or None
-        # create a client (may raise if credentials/project/db invalid)
-        firestore_client = firestore_store.get_client(project=FIRESTORE_PROJECT, database=FIRESTORE_DATABASE)
-        print(f"[INIT] Firestore initialized project={firestore_client.project} database={FIRESTORE_DATABASE or '(default)'}")
-    except Exception as e:
-        print(f"[INIT] Firestore init failed: {e}")
-        USE_FIRESTORE = False
-        firestore_client = None
-else:
-    firestore_client = None
+FIRESTORE_PROJECT = os.getenv('GCP_PROJECT_ID') or os.getenv('GCP_PROJECT') or None
+
+
+def _create_firestore_client():
+    from storage import firestore_store
+    # may raise if credentials/project/db invalid
+    fs_client = firestore_store.get_client(project=FIRESTORE_PROJECT, database=FIRESTORE_DATABASE)
+    print(f"[INIT] Firestore project={fs_client.project} database={FIRESTORE_DATABASE or '(default)'}")
+    return fs_client
+
+
+services.register('firestore', _create_firestore_client)
+firestore_client = services.lazy('firestore') if USE_FIRESTORE else None
 
 # SSL証明書の設定
 ssl_context = ssl.create_default_context(cafile=certifi.where())
@@ -85,123 +105,383 @@ ssl_context = ssl.create_default_context(cafile=certifi.where())
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # 本番環境では安全なキーに変更
 
+# 認証チェック用デコレータ（運用状況の API でも使うため、ルート定義より前に置く）
+def require_teacher_auth(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('teacher_authenticated'):
+            return redirect(url_for('teacher_login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
 # ============================================================================
-# OpenAI API リクエスト同時実行数制限（2025年12月2日追加）
+# OpenAI API リクエストスケジューラ
 # 30 人同時接続でも OpenAI rate limit に引っかからないようにするため
-# 
+#
 # 背景：
-# - Free tier / Pay-as-you-go 低スピード: 3 requests/min が上限
-# - 30 人が同時に「予想をまとめる」と 30 個のリクエストが一度に飛ぶ
-# - OpenAI が 503 Service Unavailable を返す → Flask が 500 エラーになる
-# 
+# - 以前はプロセス全体で 1 つの Semaphore を使っていたため、1 クラスの集中や
+#   リトライ待ち（permit を持ったまま sleep）が他の児童を待たせていた
+# - waitress の各プロセスや RQ ワーカー間で上限が共有されていなかった
+#
 # 対策：
-# - Semaphore で同時実行数を制限（OPENAI_CONCURRENT_LIMIT）
-# - 超過分はキュー待ち（自動的に順序付け）
+# - 優先度（chat > summary > analytics）ごと、クラスごとの公平なキュー
+#   （同じ優先度の中ではクラス単位のラウンドロビン）
+# - RPM / TPM のトークンバケット。Redis があれば Lua スクリプトで補充と予約を
+#   1 回の呼び出しで原子的に行い、全プロセス共通の上限として扱う。
+#   無ければプロセス内のバケットで制限
+# - permit は API 呼び出し 1 回分だけ保持し、リトライ待ちの間は返却する
 # ============================================================================
-from threading import Semaphore
+import heapq
+import itertools
+from contextlib import contextmanager
 
 OPENAI_CONCURRENT_LIMIT = int(os.environ.get('OPENAI_CONCURRENT_LIMIT', 3))
-openai_request_semaphore = Semaphore(OPENAI_CONCURRENT_LIMIT)
+OPENAI_RPM_LIMIT = int(os.environ.get('OPENAI_RPM_LIMIT', 500))      # 0 で無制限
+OPENAI_TPM_LIMIT = int(os.environ.get('OPENAI_TPM_LIMIT', 200000))   # 0 で無制限
+OPENAI_QUEUE_TIMEOUT = float(os.environ.get('OPENAI_QUEUE_TIMEOUT', 120))
+
+# 優先度（小さいほど先に処理）
+OPENAI_PRIORITIES = {'chat': 0, 'summary': 1, 'analytics': 2}
+
+
+# Redis 上のトークンバケット（KEYS[1] のハッシュに残量と最終補充時刻を持つ）。
+# 補充・判定・予約を 1 スクリプトで行うので、複数プロセスが同時に呼んでも
+# 枠を超えて予約されない。予約できれば 0、できなければ待つべき秒数を返す
+_OPENAI_BUCKET_RESERVE_LUA = """
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local need = tonumber(ARGV[3])
+-- TIME を使うため、Redis 5 未満ではコマンド単位の複製に切り替える
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'req', 'tok', 'ts')
+local req = tonumber(state[1]) or rpm
+local tok = tonumber(state[2]) or tpm
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+req = math.min(rpm, req + elapsed * rpm / 60)
+tok = math.min(tpm, tok + elapsed * tpm / 60)
+local wait = 0
+if rpm > 0 and req < 1 then wait = math.max(wait, (1 - req) * 60 / rpm) end
+if tpm > 0 and tok < need then wait = math.max(wait, (need - tok) * 60 / tpm) end
+if wait == 0 then
+  if rpm > 0 then req = req - 1 end
+  if tpm > 0 then tok = tok - need end
+end
+redis.call('HMSET', KEYS[1], 'req', tostring(req), 'tok', tostring(tok), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(wait)
+"""
 
-print(f"[INIT] OpenAI concurrent request limit set to: {OPENAI_CONCURRENT_LIMIT}")
+# 実際の使用トークン数との差分（ARGV[1]）をバケットに反映する
+_OPENAI_BUCKET_ADJUST_LUA = """
+local tok = tonumber(redis.call('HGET', KEYS[1], 'tok'))
+if tok == nil then return 0 end
+tok = math.min(tonumber(ARGV[2]), tok - tonumber(ARGV[1]))
+redis.call('HSET', KEYS[1], 'tok', tostring(tok))
+return 1
+"""
 
-# File lock and atomic write utilities to avoid concurrent write corruption.
-# Uses fcntl.flock on Unix-like systems. Also provides an in-process
-# threading.Lock fallback for environments without fcntl.
-_file_locks = {}
-_file_locks_lock = threading.Lock()
 
+class OpenAIQueueTimeout(Exception):
+    """スケジューラの待ち時間が上限を超えた"""
 
-def _get_lock_for_path(path):
-    """Return a threading.Lock object for the given path (process-local).
-    This is used as a fallback for platforms without fcntl, and to
-    serialize atomic replace operations within the same process.
-    """
-    with _file_locks_lock:
-        lock = _file_locks.get(path)
-        if lock is None:
-            lock = threading.Lock()
-            _file_locks[path] = lock
-        return lock
-
-
-def _atomic_write_json(path, data):
-    """Atomically write JSON-serializable `data` to `path`.
-
-    Implementation details:
-    - Write to a temporary file in the same directory
-    - fsync the file and directory to ensure durability
-    - os.replace to atomically move into place
-    - Use an in-process lock to avoid races within the same process
-      and also use POSIX fcntl locks when available to coordinate
-      between processes on the same host.
+
+class OpenAIRequestScheduler:
+    """OpenAI 呼び出しの permit を優先度・クラス単位で公平に配る
+
+    - 同時実行数はプロセス内で max_concurrent まで
+    - 待ち行列は (優先度, クラスごとの仮想時刻, 到着順) の順に並べる。
+      仮想時刻はクラスごとに 1 ずつ進むため、1 クラスが大量に並んでも
+      他クラスのリクエストが間に割り込める（start-time fair queuing）
+    - 先頭のリクエストだけが RPM / TPM の枠を予約し、枠が空くまで待つ。
+      予約（Redis への問い合わせ）は条件変数のロックを離して行い、
+      結果を反映するときだけロックを取り直す
     """
-    import json
-    import os
-
-    dirpath = os.path.dirname(os.path.abspath(path)) or '.'
-    basename = os.path.basename(path)
-    tmp = None
-    lock = _get_lock_for_path(path)
-    with lock:
-        # create temp file in same directory
-        fd, tmp = _tempfile.mkstemp(prefix=basename, dir=dirpath)
+
+    def __init__(self, max_concurrent, rpm_limit=0, tpm_limit=0, redis_getter=None, key_prefix='openai:ratelimit'):
+        self.max_concurrent = max(1, max_concurrent)
+        self.rpm_limit = max(0, rpm_limit)
+        self.tpm_limit = max(0, tpm_limit)
+        self._redis_getter = redis_getter
+        self._key_prefix = key_prefix
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._vtime = 0
+        self._class_vfinish = {}
+        # ロック外で枠を予約中のチケット（その間は他のチケットは予約しない）
+        self._reserving = None
+        self._bucket_key = f"{key_prefix}:bucket"
+        self._reserve_script = None
+        self._adjust_script = None
+        # プロセス内トークンバケット（容量 = 1 分ぶん）
+        self._bucket_requests = float(self.rpm_limit)
+        self._bucket_tokens = float(self.tpm_limit)
+        self._bucket_refilled = time.monotonic()
+        self._stats = {'granted': 0, 'timeouts': 0, 'rate_waits': 0, 'redis_errors': 0}
+
+    # ------------------------------------------------------------------
+    # permit
+    # ------------------------------------------------------------------
+    @contextmanager
+    def slot(self, priority='chat', class_key=None, estimated_tokens=0, timeout=None):
+        """permit を 1 つ取得して API 呼び出し 1 回分だけ保持する
+
+        yield される dict に 'total_tokens' を入れると、見積もりとの差分を
+        TPM の枠に反映する。
+        """
+        reservation = self.acquire(priority, class_key, estimated_tokens, timeout)
         try:
-            with os.fdopen(fd, 'w', encoding='utf-8') as f:
-                # If fcntl available, acquire exclusive lock on temp file
-                try:
-                    _fcntl.flock(f.fileno(), _fcntl.LOCK_EX)
-                except Exception:
-                    pass
-                json.dump(data, f, ensure_ascii=False, indent=2)
-                f.flush()
+            yield reservation
+        finally:
+            self.release(reservation)
+
+    def acquire(self, priority='chat', class_key=None, estimated_tokens=0, timeout=None):
+        prio = OPENAI_PRIORITIES.get(priority, OPENAI_PRIORITIES['analytics'])
+        class_key = str(class_key) if class_key not in (None, '') else '_'
+        tokens = max(0, int(estimated_tokens or 0))
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            start = max(self._vtime, self._class_vfinish.get(class_key, 0))
+            self._class_vfinish[class_key] = start + 1
+            ticket = (prio, start, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                with self._cond:
+                    # 先頭以外は permit の返却通知で起きる。念のため定期的に再確認する
+                    while not (self._waiting[0] == ticket and self._active < self.max_concurrent
+                               and self._reserving is None):
+                        self._cond.wait(self._wait_time(None, deadline, timeout, priority, class_key))
+                    self._reserving = ticket
                 try:
-                    os.fsync(f.fileno())
-                except Exception:
-                    pass
-
-            # ensure directory entry is flushed
+                    wait = self._reserve(tokens)
+                except BaseException:
+                    with self._cond:
+                        self._reserving = None
+                    raise
+                # 予約の解除と permit の付与は同じロック区間で行う
+                with self._cond:
+                    self._reserving = None
+                    self._cond.notify_all()
+                    if wait <= 0:
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                        self._active += 1
+                        self._vtime = max(self._vtime, start)
+                        self._stats['granted'] += 1
+                        self._cond.notify_all()
+                        return {'tokens': tokens, 'total_tokens': None}
+                    self._stats['rate_waits'] += 1
+                    self._cond.wait(self._wait_time(wait, deadline, timeout, priority, class_key))
+        except BaseException:
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                self._cond.notify_all()
+            raise
+
+    def _wait_time(self, wait, deadline, timeout, priority, class_key):
+        """次に条件変数で待つ秒数（期限切れなら OpenAIQueueTimeout）。ロック内で呼ぶ"""
+        wait = 5.0 if wait is None else min(wait, 5.0)
+        if deadline is None:
+            return wait
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._stats['timeouts'] += 1
+            raise OpenAIQueueTimeout(f"OpenAI queue wait exceeded {timeout}s ({priority}, class {class_key})")
+        return min(wait, remaining)
+
+    def release(self, reservation):
+        used = reservation.get('total_tokens')
+        if used is not None and self.tpm_limit:
+            self._adjust_tokens(reservation, int(used) - reservation['tokens'])
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # RPM / TPM
+    # ------------------------------------------------------------------
+    def _redis(self):
+        return self._redis_getter() if self._redis_getter else None
+
+    def _reserve(self, tokens):
+        """RPM / TPM の枠を予約する。予約できたら 0、できなければ待つべき秒数
+
+        条件変数のロックを持たずに呼ぶ（Redis の I/O をロック内で行わない）。
+        """
+        if not self.rpm_limit and not self.tpm_limit:
+            return 0
+        r = self._redis()
+        if r is not None:
             try:
-                dirfd = os.open(dirpath, os.O_DIRECTORY)
-                try:
-                    os.fsync(dirfd)
-                finally:
-                    os.close(dirfd)
+                return self._reserve_redis(r, tokens)
+            except Exception as e:
+                with self._cond:
+                    self._stats['redis_errors'] += 1
+                print(f"[OPENAI_QUEUE] Redis rate limit unavailable, using local bucket: {e}")
+        with self._cond:
+            return self._reserve_local(tokens)
+
+    def _reserve_redis(self, r, tokens):
+        if self._reserve_script is None:
+            self._reserve_script = r.register_script(_OPENAI_BUCKET_RESERVE_LUA)
+        # 1 件で TPM を超える巨大リクエストは満タンのバケットでだけ通す
+        need_tokens = min(tokens, self.tpm_limit)
+        wait = float(self._reserve_script(
+            keys=[self._bucket_key], args=[self.rpm_limit, self.tpm_limit, need_tokens], client=r,
+        ))
+        return max(0.05, wait) if wait > 0 else 0
+
+    def _reserve_local(self, tokens):
+        now = time.monotonic()
+        elapsed = now - self._bucket_refilled
+        self._bucket_refilled = now
+        if self.rpm_limit:
+            self._bucket_requests = min(self.rpm_limit, self._bucket_requests + elapsed * self.rpm_limit / 60)
+        if self.tpm_limit:
+            self._bucket_tokens = min(self.tpm_limit, self._bucket_tokens + elapsed * self.tpm_limit / 60)
+        need_tokens = min(tokens, self.tpm_limit)
+        wait = 0
+        if self.rpm_limit and self._bucket_requests < 1:
+            wait = max(wait, (1 - self._bucket_requests) * 60 / self.rpm_limit)
+        if self.tpm_limit and self._bucket_tokens < need_tokens:
+            wait = max(wait, (need_tokens - self._bucket_tokens) * 60 / self.tpm_limit)
+        if wait > 0:
+            return wait
+        if self.rpm_limit:
+            self._bucket_requests -= 1
+        if self.tpm_limit:
+            self._bucket_tokens -= need_tokens
+        return 0
+
+    def _adjust_tokens(self, reservation, delta):
+        """実際の使用トークン数との差分を枠に反映する"""
+        if not delta:
+            return
+        r = self._redis()
+        if r is not None:
+            try:
+                if self._adjust_script is None:
+                    self._adjust_script = r.register_script(_OPENAI_BUCKET_ADJUST_LUA)
+                self._adjust_script(keys=[self._bucket_key], args=[delta, self.tpm_limit], client=r)
+                return
             except Exception:
-                pass
+                with self._cond:
+                    self._stats['redis_errors'] += 1
+        with self._cond:
+            self._bucket_tokens = min(self.tpm_limit, self._bucket_tokens - delta)
+
+    def stats(self):
+        with self._cond:
+            waiting = {}
+            for prio, _, _ in self._waiting:
+                name = next((k for k, v in OPENAI_PRIORITIES.items() if v == prio), str(prio))
+                waiting[name] = waiting.get(name, 0) + 1
+            return {
+                'active': self._active,
+                'max_concurrent': self.max_concurrent,
+                'rpm_limit': self.rpm_limit,
+                'tpm_limit': self.tpm_limit,
+                'waiting': waiting,
+                'shared_limits': self._redis() is not None,
+                **self._stats,
+            }
 
-            # atomic replace
-            os.replace(tmp, path)
-            tmp = None
-        finally:
-            if tmp and os.path.exists(tmp):
-                try:
-                    os.remove(tmp)
-                except Exception:
-                    pass
 
+def _estimate_tokens(messages, max_output=0):
+    """TPM 予約用のおおまかなトークン数（日本語は 1 文字 ≒ 1 トークンで見積もる）"""
+    if isinstance(messages, str):
+        chars = len(messages)
+    else:
+        chars = sum(len(str(m.get('content', ''))) for m in messages if isinstance(m, dict))
+    return chars + int(max_output or 0)
 
-def _read_json_file(path):
-    """Read JSON from path safely; returns parsed JSON or None if file missing/invalid."""
-    import json
-    import os
 
-    if not os.path.exists(path):
-        return None
+def _current_class_key():
+    """リクエスト中ならセッションのクラス番号をスケジューラのキーにする"""
+    if has_request_context():
+        return session.get('class_number')
+    return None
+
+
+# redis_conn は後段で初期化されるため、参照は呼び出し時に解決する
+openai_scheduler = OpenAIRequestScheduler(
+    OPENAI_CONCURRENT_LIMIT,
+    rpm_limit=OPENAI_RPM_LIMIT,
+    tpm_limit=OPENAI_TPM_LIMIT,
+    redis_getter=lambda: globals().get('redis_conn'),
+)
+
+print(f"[INIT] OpenAI scheduler: concurrency={OPENAI_CONCURRENT_LIMIT}, rpm={OPENAI_RPM_LIMIT}, tpm={OPENAI_TPM_LIMIT}")
+
+# In-process locks for local JSON files. Cross-process exclusion and atomic
+# writes live in storage.json_txn (sidecar lockfile + version check); these
+# locks make the threads of one process queue before taking the file lock.
+# Per-record stores (sessions, summaries) have one file per student/unit/stage,
+# so their locks are striped to keep memory constant.
+FILE_LOCK_STRIPES = int(os.environ.get('FILE_LOCK_STRIPES', 64))
+progress_file_locks = LockManager('learning_progress')
+session_file_locks = LockManager('session_storage', stripes=FILE_LOCK_STRIPES)
+summary_file_locks = LockManager('summary_storage', stripes=FILE_LOCK_STRIPES)
 
-    lock = _get_lock_for_path(path)
-    with lock:
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                try:
-                    # Try to acquire shared lock where available
-                    _fcntl.flock(f.fileno(), _fcntl.LOCK_SH)
-                except Exception:
-                    pass
-                data = json.load(f)
-                return data
-        except Exception:
-            return None
+
+@app.route('/api/service_status')
+@require_teacher_auth
+def service_status():
+    """外部サービス（GCS・Firestore・Redis・OpenAI）の作成状況・利用可否・直近のエラーを返す"""
+    return jsonify(services.status())
+
+
+@app.route('/api/file_lock_status')
+@require_teacher_auth
+def file_lock_status():
+    """ローカル JSON ストアごとのロックの取得回数・待ち回数・待ち時間・混雑しているキーを返す"""
+    return jsonify(collect_stats(progress_file_locks, session_file_locks, summary_file_locks))
+
+
+# ============================================================================
+# 永続化のライトビハインドキュー
+# チャット応答を GCS アップロードやローカル書き込みの完了待ちにしないため、
+# 学習ログ・エラーログ・セッションのスナップショット保存はキューに積んで
+# バックグラウンドのワーカースレッドでまとめて書き込む。
+# キューが満杯のときは呼び出し元で同期的に書き込む（データは捨てない）。
+# RQ ワーカー内ではジョブ終了時にプロセスが即終了するため同期書き込みにする。
+# ============================================================================
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', '1').lower() in ('1', 'true', 'yes')
+persistence_queue = WriteBehindQueue(
+    name='persistence',
+    max_size=int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 2000)),
+    workers=int(os.environ.get('WRITE_BEHIND_WORKERS', 2)),
+    batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 100)),
+)
+atexit.register(persistence_queue.shutdown)
+
+
+def _persist_in_background():
+    """永続化をキュー経由で行うかどうか（RQ ジョブ実行中は同期）"""
+    return WRITE_BEHIND_ENABLED and _rq.get_current_job() is None
+
+
+@app.route('/api/persistence_status')
+@require_teacher_auth
+def persistence_status():
+    """ライトビハインドキューの滞留数などを返す"""
+    return jsonify(persistence_queue.stats())
+
+
+@app.route('/api/openai_queue_status')
+@require_teacher_auth
+def openai_queue_status():
+    """OpenAI スケジューラの実行中・待機中のリクエスト数とまとめ文キャッシュの状況を返す"""
+    stats = openai_scheduler.stats()
+    stats['summary_cache'] = summary_cache.stats()
+    return jsonify(stats)
 
 
 # 開発用: 重い要約処理を模擬するエンドポイント（POST）。
@@ -273,19 +553,14 @@ def debug_save_progress():
         unit = data.get('unit') or f"unit_{random.randint(1,10)}"
 
         # 進捗データを読み込み・更新（簡易）
-        progress = load_learning_progress()
         student_id = f"{class_number}_{student_number}"
-        if student_id not in progress:
-            progress[student_id] = {}
-        if unit not in progress[student_id]:
-            progress[student_id][unit] = get_student_progress(class_number, student_number, unit)
+        current = get_student_progress(class_number, student_number, unit)
 
         # マーク予想/考察の作成フラグをトグルする（模擬）
-        current = progress[student_id][unit]
         current['stage_progress']['prediction']['summary_created'] = True
         current['stage_progress']['prediction']['last_message'] = '並行テストによる更新'
 
-        save_learning_progress(progress)
+        save_student_unit_progress(student_id, unit, current)
 
         return jsonify({'status': 'ok', 'student_id': student_id, 'unit': unit})
     except Exception as e:
@@ -327,8 +602,7 @@ STUDENT_CLASS_MAPPING = {
 LOG_DELETE_PASSWORD = "RIKA"  # ログを消す際のパスワード
 
 # 同時セッション管理用（同じアカウントの同時ログインを防止）
-active_sessions = {}  # {student_id: session_id}
-session_devices = {}  # {session_id: device_info}
+# 児童 ID ⇔ セッション ID の対応は session_registry（Redis 初期化後に作成）に保持する
 
 def get_device_fingerprint():
     """デバイスフィンガープリントを生成"""
@@ -343,10 +617,8 @@ def check_session_conflict(student_id):
     """同一児童IDの他セッションを検出"""
     current_device = get_device_fingerprint()
     
-    if student_id in active_sessions:
-        previous_session_id = active_sessions[student_id]
-        previous_device = session_devices.get(previous_session_id)
-        
+    previous_session_id, previous_device = session_registry.lookup(student_id)
+    if previous_session_id:
         # 異なるデバイスからのアクセス
         if previous_device and previous_device != current_device:
             return True, previous_session_id, previous_device
@@ -356,19 +628,11 @@ def check_session_conflict(student_id):
 def register_session(student_id, session_id):
     """セッションを登録"""
     device_fingerprint = get_device_fingerprint()
-    active_sessions[student_id] = session_id
-    session_devices[session_id] = device_fingerprint
+    session_registry.register(student_id, session_id, device_fingerprint)
 
 def clear_session(session_id):
-    """セッションをクリア"""
-    # student_idを逆引きして削除
-    for student_id, sid in list(active_sessions.items()):
-        if sid == session_id:
-            del active_sessions[student_id]
-            break
-    
-    if session_id in session_devices:
-        del session_devices[session_id]
+    """セッションをクリア（セッション ID から児童 ID を直接引いて削除）"""
+    session_registry.clear(session_id)
 
 def normalize_class_value(class_value):
     """クラス指定の表記ゆれを統一（lab -> '5' など）"""
@@ -391,29 +655,55 @@ def normalize_class_value_int(class_value):
     except ValueError:
         return None
 
-# 認証チェック用デコレータ
-def require_teacher_auth(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not session.get('teacher_authenticated'):
-            return redirect(url_for('teacher_login'))
-        return f(*args, **kwargs)
-    return decorated_function
-
 # セッション管理機能（ブラウザ閉鎖後の復帰対応）
-# デフォルトはローカルファイルだが、コンテナ環境ではボリュームにマウントした
-# パスを環境変数 `SESSION_STORAGE_FILE` で指定して永続化できる。
+# デフォルトはローカルディレクトリだが、コンテナ環境ではボリュームにマウントした
+# パスを環境変数 `SESSION_STORAGE_DIR` で指定して永続化できる。
+# 旧形式（全児童を1つの JSON マップに保存）のファイル。起動時にシャードへ移行する。
 SESSION_STORAGE_FILE = os.environ.get('SESSION_STORAGE_FILE', 'session_storage.json')
+# student_id/unit/stage ごとに1ファイルで保存するディレクトリ
+SESSION_STORAGE_DIR = os.environ.get('SESSION_STORAGE_DIR', 'session_storage')
+session_store = ShardedJsonStore(SESSION_STORAGE_DIR, locking=True, lock_for=session_file_locks.lock_for)
+
+
+def _session_shard_parts(key, entry):
+    """旧形式のセッションエントリからシャードのキーを取り出す"""
+    if not all(entry.get(field) for field in ('student_id', 'unit', 'stage')):
+        print(f"[SESSION_MIGRATE] Skipping entry without student_id/unit/stage: {key}")
+        return None
+    return (entry['student_id'], entry['unit'], entry['stage'])
+
+
+try:
+    session_store.migrate_from_map(SESSION_STORAGE_FILE, _session_shard_parts)
+except Exception as e:
+    print(f"[INIT] Session storage migration failed: {e}")
+
+def _session_queue_key(student_id, unit, stage):
+    return f"session:{student_id}_{unit}_{stage}"
 
 def save_session_to_db(student_id, unit, stage, conversation_data):
-    """セッションデータをデータベースに保存（GCS優先、ローカルはフォールバック）"""
+    """セッションデータをデータベースに保存（GCS優先、ローカルはフォールバック）
+
+    書き込みはライトビハインドキューに積み、同じキーの未処理スナップショットは
+    最新のものだけを書き込む。
+    """
     session_entry = {
         'timestamp': datetime.now().isoformat(),
         'student_id': student_id,
         'unit': unit,
         'stage': stage,  # 'prediction' or 'reflection'
-        'conversation': conversation_data
+        'conversation': list(conversation_data or [])
     }
+    if _persist_in_background():
+        persistence_queue.submit_keyed(_session_queue_key(student_id, unit, stage), _persist_session_entry, session_entry)
+    else:
+        _persist_session_entry(session_entry)
+
+def _persist_session_entry(session_entry):
+    """セッションエントリを Firestore → GCS → ローカルの順で保存"""
+    student_id = session_entry['student_id']
+    unit = session_entry['unit']
+    stage = session_entry['stage']
     # Firestore 優先（環境変数で有効化されている場合）
     if USE_FIRESTORE and firestore_client:
         try:
@@ -437,15 +727,22 @@ def save_session_to_db(student_id, unit, stage, conversation_data):
     _save_session_local(session_entry)
 
 def _save_session_local(session_entry):
-    """セッションをローカルファイルに保存"""
+    """セッションをローカルのシャード（student_id/unit/stage ごとの1ファイル）に保存"""
     try:
-        sessions = _read_json_file(SESSION_STORAGE_FILE) or {}
         student_id = session_entry['student_id']
         unit = session_entry['unit']
         stage = session_entry['stage']
         key = f"{student_id}_{unit}_{stage}"
-        sessions[key] = session_entry
-        _atomic_write_json(SESSION_STORAGE_FILE, sessions)
+
+        def _newer(current):
+            # 別プロセスがより新しいスナップショットを書いていれば上書きしない
+            if current and current.get('timestamp', '') > session_entry['timestamp']:
+                return None
+            return session_entry
+
+        if session_store.update((student_id, unit, stage), _newer) is None:
+            print(f"[SESSION_SAVE] Local - {key} skipped (newer snapshot on disk)")
+            return
         print(f"[SESSION_SAVE] Local - {key}")
     except Exception as e:
         print(f"[SESSION_SAVE] Local Error: {e}")
@@ -472,6 +769,12 @@ def _save_session_gcs(session_entry):
 
 def load_session_from_db(student_id, unit, stage):
     """セッションデータをデータベースから復元（GCS優先）"""
+    # 書き込み待ち・書き込み中のスナップショットがあればそれが最新
+    pending = persistence_queue.pending_args(_session_queue_key(student_id, unit, stage))
+    if pending:
+        print(f"[SESSION_LOAD] Pending write - {student_id}_{unit}_{stage}")
+        return list(pending[0].get('conversation', []))
+
     # 本番環境: GCS優先
     if USE_GCS and bucket:
         try:
@@ -489,15 +792,12 @@ def load_session_from_db(student_id, unit, stage):
     return conversation
 
 def _load_session_local(student_id, unit, stage):
-    """セッションをローカルファイルから復元"""
+    """セッションをローカルのシャードから復元"""
     try:
-        sessions = _read_json_file(SESSION_STORAGE_FILE)
-        if not sessions:
-            return []
-        key = f"{student_id}_{unit}_{stage}"
-        if key in sessions:
-            print(f"[SESSION_LOAD] Local - {key}")
-            return sessions[key].get('conversation', [])
+        entry = session_store.get((student_id, unit, stage))
+        if entry:
+            print(f"[SESSION_LOAD] Local - {student_id}_{unit}_{stage}")
+            return entry.get('conversation', [])
     except Exception as e:
         print(f"[SESSION_LOAD] Local Error: {e}")
     
@@ -507,17 +807,200 @@ def _load_session_local(student_id, unit, stage):
 # -----------------------------
 # Background job queue (RQ + Redis) setup
 # -----------------------------
+# 接続確認は起動をブロックしないようバックグラウンドで行い（SERVICE_PROBE_INTERVAL 秒ごと）、
+# 結果に応じて redis_conn / rq_queue と Redis を使うストアを切り替える。
+# 確認が済むまで・停止中は None（同期処理・ローカル保存）。
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2))
+redis_conn = None
+rq_queue = None
+# redis_conn を保持するストア（Redis の状態が変わったら付け替える）
+_redis_consumers = []
+
+
+def _uses_redis(store):
+    _redis_consumers.append(store)
+    return store
+
+
+def _on_redis_change(available):
+    global redis_conn, rq_queue
+    conn = services.get('redis') if available else None
+    for store in _redis_consumers:
+        store.redis = conn
+    rq_queue = _rq.Queue('default', connection=conn) if conn is not None else None
+    redis_conn = conn
+    if conn is not None:
+        print(f"[INIT] Redis/RQ available at {REDIS_URL}")
+        try:
+            adopted = conversation_store.adopt_local()
+            if adopted:
+                print(f"[INIT] Moved {adopted} local conversations to Redis")
+        except Exception as e:
+            print(f"[INIT] Moving local conversations to Redis failed: {e}")
+    else:
+        print("[INIT] Redis/RQ not available. Will use synchronous processing.")
+
+
+services.register(
+    'redis',
+    lambda: _redis.from_url(REDIS_URL, socket_connect_timeout=REDIS_CONNECT_TIMEOUT),
+    probe=lambda conn: conn.ping(),
+    on_change=_on_redis_change,
+)
+
+
+# 同時ログイン検出用のセッション登録簿（Redis があれば全プロセス・全ホストで共有）
+SESSION_REGISTRY_TTL = int(os.environ.get('SESSION_REGISTRY_TTL', 8 * 3600))
+session_registry = _uses_redis(SessionRegistry(redis_conn=redis_conn, ttl=SESSION_REGISTRY_TTL))
+
+
+# ジョブ完了の通知（Redis pub/sub）。クライアントは /job_wait/<job_id> で完了を待ち、
+# 結果は完了時に1回だけ返る（/job_status の定期ポーリングを置き換える）
+JOB_WAIT_TIMEOUT = float(os.environ.get('JOB_WAIT_TIMEOUT', 25))
+# waitress のスレッド数。OpenAI の同時実行数は openai_scheduler が制限するので、
+# スレッドは 1 クラス全員のロングポーリングを受けられるだけ用意する
+WAITRESS_THREADS = int(os.environ.get('WAITRESS_THREADS', 40))
+# 1プロセスで同時に待機できるリクエスト数。既定は 1 クラス（30 人強）が同時に
+# まとめを待てる数とし、通常のリクエスト用に JOB_WAIT_RESERVED_THREADS 本を残す
+JOB_WAIT_RESERVED_THREADS = 8
+JOB_WAIT_MAX_WAITERS = int(os.environ.get(
+    'JOB_WAIT_MAX_WAITERS', max(5, WAITRESS_THREADS - JOB_WAIT_RESERVED_THREADS)
+))
+job_notifier = _uses_redis(JobNotifier(redis_conn, max_waiters=JOB_WAIT_MAX_WAITERS))
+
+
+def _notify_job_done(payload):
+    """RQ ワーカー内で実行中のジョブの完了を通知する（ワーカー外では何もしない）"""
+    job = _rq.get_current_job()
+    if job is not None:
+        if job_notifier.redis is None:
+            # ワーカーの起動直後で死活確認がまだなら、その場で確認する
+            services.probe('redis')
+        job_notifier.publish(job.id, payload)
+
+
+# -----------------------------
+# 会話履歴のサーバー側保存
+# -----------------------------
+# 会話履歴は Cookie セッションに入れず、セッション ID（session['_session_id']）・単元・
+# 段階ごとに conversation_store（Redis、無ければローカルファイル）へ保存する。
+# Cookie の肥大化（4KB 上限での切り捨て）と毎リクエストの再署名を避けるため。
+CONVERSATION_STORAGE_DIR = os.environ.get('CONVERSATION_STORAGE_DIR', 'conversation_storage')
+CONVERSATION_TTL = int(os.environ.get('CONVERSATION_TTL', 12 * 3600))
+conversation_store = _uses_redis(
+    ConversationStore(CONVERSATION_STORAGE_DIR, redis_conn=redis_conn, ttl=CONVERSATION_TTL)
+)
 try:
-    redis_conn = _redis.from_url(REDIS_URL)
-    # Test the connection before creating the queue
-    redis_conn.ping()
-    rq_queue = _rq.Queue('default', connection=redis_conn)
-    print(f"[INIT] Redis/RQ initialized successfully at {REDIS_URL}")
+    _purged = conversation_store.purge_expired()
+    if _purged:
+        print(f"[INIT] Purged {_purged} expired local conversations")
 except Exception as e:
-    print(f"[INIT] Redis/RQ not available: {e}. Will use synchronous processing.")
-    redis_conn = None
-    rq_queue = None
+    print(f"[INIT] Conversation purge failed: {e}")
+
+
+def _conversation_sid():
+    """会話履歴のキーにするセッション ID（無ければ発行する）"""
+    sid = session.get('_session_id')
+    if not sid:
+        sid = str(uuid.uuid4())
+        session['_session_id'] = sid
+    return sid
+
+
+def get_conversation(name, unit=None):
+    """会話履歴を取得する（name は 'conversation' または 'reflection_conversation'）"""
+    unit = unit if unit is not None else session.get('unit')
+    sid = _conversation_sid()
+    # 旧形式（Cookie に会話履歴を持っていたセッション）からの移行
+    legacy = session.pop(name, None)
+    if legacy:
+        conversation_store.set(sid, unit, name, legacy)
+        return list(legacy)
+    return conversation_store.get(sid, unit, name)
+
+
+def set_conversation(name, conversation, unit=None):
+    unit = unit if unit is not None else session.get('unit')
+    session.pop(name, None)
+    conversation_store.set(_conversation_sid(), unit, name, conversation)
+
+
+def append_conversation(name, *messages, unit=None, sid=None):
+    """会話履歴の末尾に追加する（sid を渡せばリクエスト外からも呼べる）"""
+    if sid is None:
+        sid = _conversation_sid()
+        unit = unit if unit is not None else session.get('unit')
+    conversation_store.append(sid, unit, name, *messages)
+
+
+# 対話ターンの再送対策: クライアントは1回の発言ごとに turn_id を付けて送り、再送時も同じ
+# turn_id を使う。同じ turn_id の要求は OpenAI 呼び出し・会話への追記・ログ保存を1回だけ行い、
+# 実行中の要求には相乗りし、完了済みなら CHAT_TURN_TTL 秒（既定 10 分）以内は保存済みの応答を返す。
+CHAT_TURN_TTL = int(os.environ.get('CHAT_TURN_TTL', 600))
+# 実行中の同じ turn_id の要求が完了を待つ最大秒数（ストリーミング版）
+CHAT_TURN_WAIT_TIMEOUT = float(os.environ.get('CHAT_TURN_WAIT_TIMEOUT', 90))
+chat_turn_cache = _uses_redis(MemoCache(os.path.join(CONVERSATION_STORAGE_DIR, '_turns'), redis_conn=redis_conn,
+                                        ttl=CHAT_TURN_TTL, lease_ttl=int(CHAT_TURN_WAIT_TIMEOUT) + 30,
+                                        key_prefix='chat_turn'))
+
+
+def _chat_turn_key(stage, turn_id):
+    """turn_id から再送判定用のキーを作る（turn_id が無ければ None）"""
+    if not isinstance(turn_id, str) or not turn_id or len(turn_id) > 128:
+        return None
+    return hashlib.sha256(f"{_conversation_sid()}|{stage}|{turn_id}".encode('utf-8')).hexdigest()
+
+
+def run_chat_turn(stage, turn_id, compute):
+    """対話1ターンを実行する（同じ turn_id の再送には同じ応答を返す）
+
+    Args:
+        compute: OpenAI 呼び出しと保存を行い、応答の dict（'response' を含む）を返す関数
+    """
+    key = _chat_turn_key(stage, turn_id)
+    if key is None:
+        return compute()
+    return chat_turn_cache.get_or_compute(key, compute, cacheable=lambda result: isinstance(result, dict) and 'response' in result)
+
+
+# -----------------------------
+# まとめ文のメモ化
+# -----------------------------
+# まとめ文は（単元, 段階, モデル, 正規化した会話のハッシュ）ごとに保存し、同じ会話に対する
+# 再読み込み・再試行・別ワーカーからの要求では OpenAI を呼び直さない。
+# 同時に来た同じ会話の要求は1回の呼び出しを共有する（Redis があればプロセス間でも）。
+SUMMARY_CACHE_DIR = os.environ.get('SUMMARY_CACHE_DIR', 'summary_cache')
+SUMMARY_CACHE_TTL = int(os.environ.get('SUMMARY_CACHE_TTL', 24 * 3600))
+summary_cache = _uses_redis(SummaryCache(SUMMARY_CACHE_DIR, redis_conn=redis_conn, ttl=SUMMARY_CACHE_TTL))
+
+
+def _is_openai_error_text(text):
+    """call_openai_with_retry が返す代表的なエラーメッセージかどうか"""
+    return isinstance(text, str) and (
+        'APIキー' in text or 'API利用制限' in text or 'ネットワーク接続' in text or '予期しないエラー' in text
+    )
+
+
+def generate_summary_text(messages, unit, summary_stage, conversation, **openai_kwargs):
+    """まとめ文を生成する（同じ会話のまとめは保存済みの結果・実行中の呼び出しを共有）
+
+    Args:
+        messages: OpenAI に渡すメッセージ
+        unit, summary_stage, conversation: メモ化のキー（summary_stage は 'prediction' / 'reflection'）
+        openai_kwargs: call_openai_with_retry に渡す引数（model_override, stage, class_key など）
+    """
+    model = openai_kwargs.get('model_override') or DEFAULT_OPENAI_MODEL
+    key = summary_cache.key(unit, summary_stage, conversation, model=model)
+
+    def compute():
+        response = call_openai_with_retry(messages, enable_cache=True, priority='summary', **openai_kwargs)
+        return extract_message_from_json_response(response)
+
+    # 空の応答や OpenAI のエラーメッセージは保存しない
+    return summary_cache.get_or_compute(
+        key, compute, cacheable=lambda text: isinstance(text, str) and bool(text.strip()) and not _is_openai_error_text(text)
+    )
 
 
 def perform_summary_job(conversation, unit, student_id, class_number, student_number, stage='prediction', model_override='gpt-4o-mini'):
@@ -541,8 +1024,8 @@ def perform_summary_job(conversation, unit, student_id, class_number, student_nu
         messages.append({"role": "user", "content": "これまでの話をもとに、予想をまとめてください。"})
 
         # Call OpenAI (existing helper)
-        summary_response = call_openai_with_retry(messages, model_override=model_override, enable_cache=True, stage=stage)
-        summary_text = extract_message_from_json_response(summary_response)
+        summary_text = generate_summary_text(messages, unit, stage, conversation,
+                                             model_override=model_override, stage=stage, class_key=class_number)
 
         # Persist summary
         _save_summary_to_db(student_id, unit, stage, summary_text)
@@ -558,11 +1041,102 @@ def perform_summary_job(conversation, unit, student_id, class_number, student_nu
         except Exception:
             pass
 
+        _notify_job_done({'status': 'finished', 'result': summary_text})
         return summary_text
     except Exception as e:
         print(f"[JOB_SUMMARY] Error: {e}")
+        _notify_job_done({'status': 'failed', 'error': str(e)})
         raise
 
+
+def _build_final_summary_messages(unit, reflection_conversation):
+    """考察まとめ用のメッセージを構築する"""
+    unit_prompt = load_unit_prompt(unit, stage='reflection')
+    messages = [
+        {"role": "system", "content": unit_prompt + "\n\n【重要】以下の会話内容のみをもとに、児童の話した言葉や考えを活かして、考察をまとめてください。会話に含まれていない内容は追加しないでください。"}
+    ]
+    # 対話履歴をメッセージフォーマットで追加
+    for msg in reflection_conversation:
+        messages.append({
+            "role": msg['role'],
+            "content": msg['content']
+        })
+    # 最後に考察作成を促すメッセージを追加
+    messages.append({
+        "role": "user",
+        "content": "児童が「考察をまとめる」ボタンを押しました。これまでの対話内容から、児童自身の言葉や気づきを活かして考察をまとめてください。"
+    })
+    return messages
+
+
+def perform_final_summary_job(reflection_conversation, prediction_summary, unit, class_number, student_number, model_override='gpt-4o-mini'):
+    """考察まとめの生成ジョブ（RQ ワーカーから呼ばれる。RQ が無い場合は同期で呼ぶ）
+
+    OpenAI で考察をまとめ、進捗・サマリー・学習ログの保存までワーカー内で行う。
+    """
+    student_id = f"{class_number}_{student_number}"
+    try:
+        messages = _build_final_summary_messages(unit, reflection_conversation)
+        final_summary_text = generate_summary_text(messages, unit, 'reflection', reflection_conversation,
+                                                   model_override=model_override, class_key=class_number)
+
+        # OpenAI 側のエラーメッセージはまとめとして保存しない
+        if _is_openai_error_text(final_summary_text):
+            raise RuntimeError('AI接続の混雑または通信エラーです。少し待ってもう一度押してください。')
+
+        # 考察完了フラグを設定
+        update_student_progress(
+            class_number=class_number,
+            student_number=student_number,
+            unit=unit,
+            reflection_summary_created=True
+        )
+        # 永続ストレージに保存（ローカル/GCS）
+        _save_summary_to_db(student_id, unit, 'reflection', final_summary_text)
+        # 最終考察のログを保存
+        save_learning_log(
+            student_number=student_number,
+            unit=unit,
+            log_type='final_summary',
+            data={
+                'final_summary': final_summary_text,
+                'prediction_summary': prediction_summary,
+                'reflection_conversation': reflection_conversation
+            },
+            class_number=class_number
+        )
+
+        _notify_job_done({'status': 'finished', 'result': final_summary_text})
+        return final_summary_text
+    except Exception as e:
+        import traceback
+        error_detail = traceback.format_exc()
+        print(f"[JOB_FINAL_SUMMARY] Error for {student_id}_{unit}: {e}")
+        try:
+            save_learning_log(
+                student_number=student_number,
+                unit=unit,
+                log_type='final_summary_error',
+                data={
+                    'error': str(e),
+                    'traceback': error_detail
+                },
+                class_number=class_number
+            )
+        except Exception:
+            pass
+        _notify_job_done({'status': 'failed', 'error': str(e)})
+        raise
+
+
+def _final_summary_job_id(student_id, unit, reflection_conversation):
+    """考察まとめジョブの冪等キー（学生・単元・段階・会話内容が同じなら同じ ID）"""
+    conversation_digest = hashlib.sha1(
+        json.dumps(reflection_conversation, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+    digest = hashlib.sha1(f"{student_id}|{unit}|reflection|{conversation_digest}".encode('utf-8')).hexdigest()[:16]
+    return f"final-summary-{digest}"
+
 def _load_session_gcs(student_id, unit, stage):
     """セッションをGCSから復元"""
     try:
@@ -587,12 +1161,10 @@ api_key = os.getenv('OPENAI_API_KEY')
 # デフォルトモデル（環境変数で変更可能）
 # gpt-4o-mini: 安定した軽量モデル + プロンプトキャッシング対応
 DEFAULT_OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
-try:
-    client = openai.OpenAI(api_key=api_key)
-    print(f"[INIT] OpenAI client initialized with model: {DEFAULT_OPENAI_MODEL}")
-except Exception as e:
-    client = None
-    print(f"[INIT] OpenAI client initialization failed: {e}")
+services.register('openai', lambda: openai.OpenAI(api_key=api_key))
+# 初回の API 呼び出し時に作成される（作成できないあいだは偽）
+client = services.lazy('openai')
+print(f"[INIT] OpenAI model: {DEFAULT_OPENAI_MODEL}")
 
 # マークダウン記法を除去する関数
 def remove_markdown_formatting(text):
@@ -630,113 +1202,240 @@ def remove_markdown_formatting(text):
     return text.strip()
 
 # 学習進行状況管理機能
-def load_learning_progress():
-    """学習進行状況を読み込み（ローカル JSON のみ）"""
-    # ローカルファイルから読み込み
-    data = _read_json_file(LEARNING_PROGRESS_FILE)
-    if not data:
-        return {}
-    return data
+# learning_progress.json。読み込みはファイルのバージョン（inode/mtime/サイズ）が
+# 変わったときだけ読み直し、書き込みはロックファイルで全プロセス間を直列化する。
+learning_progress_doc = JsonDocument(
+    LEARNING_PROGRESS_FILE, indent=2, local_lock=progress_file_locks.lock_for(LEARNING_PROGRESS_FILE)
+)
+
+def _cached_learning_progress():
+    """キャッシュ済みの進行状況マップ（読み取り専用として扱うこと）"""
+    return learning_progress_doc.read()
+
+
+class StudentProgress:
+    """1 人分の全単元の進行状況（リクエスト内スナップショット）
+
+    `units` は {単元名: 進行状況} の辞書。未保存の単元は `unit()` で初期値を返す。
+    """
+
+    def __init__(self, student_id, units):
+        self.student_id = student_id
+        self.units = units
+
+    def exists(self, unit):
+        return unit in self.units
 
-def save_learning_progress(progress_data):
-    """学習進行状況を保存（ローカル JSON のみ）"""
-    # まず Firestore に保存（環境変数で有効化されていれば）
+    def unit(self, unit):
+        if unit not in self.units:
+            return _default_unit_progress()
+        return self.units[unit]
+
+    def summary_flags(self, unit):
+        """(予想完了, 考察完了) を返す"""
+        stage_progress = self.unit(unit).get('stage_progress', {})
+        return (
+            stage_progress.get('prediction', {}).get('summary_created', False),
+            stage_progress.get('reflection', {}).get('summary_created', False),
+        )
+
+
+def _progress_student_id(class_number, student_number):
+    normalized_class = normalize_class_value(class_number)
+    class_number = normalized_class if normalized_class is not None else class_number
+    return class_number, f"{class_number}_{student_number}"
+
+def get_progress_snapshot(class_number, student_number):
+    """児童 1 人分の進行状況を読み込む（同一リクエスト内では 1 回だけ読む）"""
+    class_number, student_id = _progress_student_id(class_number, student_number)
+    snapshots = g.setdefault('_progress_snapshots', {}) if has_request_context() else {}
+    snapshot = snapshots.get(student_id)
+    if snapshot is not None:
+        return snapshot
+
+    progress_data = _cached_learning_progress()
+    student_progress = progress_data.get(student_id)
+    if student_progress is None and class_number == '5':
+        # 旧 ID（lab_番号）で保存されている研究室の児童を新 ID に移行
+        legacy_id = f"lab_{student_number}"
+        if legacy_id in progress_data:
+            student_progress = progress_data[legacy_id]
+            save_student_progress(student_id, student_progress, drop_ids=(legacy_id,))
+
+    snapshot = StudentProgress(student_id, copy.deepcopy(student_progress or {}))
+    snapshots[student_id] = snapshot
+    return snapshot
+
+def save_student_unit_progress(student_id, unit, unit_progress):
+    """1 人・1 単元分の進行状況だけを書き込む（他の児童のデータには触れない）
+
+    Firestore では該当児童のドキュメントの単元フィールドだけを merge で更新し、
+    ローカルでは該当キーだけを差し替える。
+    """
     if USE_FIRESTORE and firestore_client:
         try:
-            # progress_data は {student_id: {unit: {...}}}
+            doc_ref = firestore_client.collection('sb_learning_progress').document(str(student_id))
+            doc_ref.set({unit: unit_progress}, merge=True)
+            print(f"[PROGRESS_SAVE] Firestore: {student_id} / {unit}")
+            return
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Firestore failed: {e}, falling back to local file")
+
+    def _apply(progress_data):
+        # 読み込み側と共有しているため、児童の辞書はコピーしてから差し替える
+        student_progress = dict(progress_data.get(student_id, {}))
+        student_progress[unit] = unit_progress
+        progress_data[student_id] = student_progress
+
+    try:
+        learning_progress_doc.update(_apply)
+        print(f"[PROGRESS_SAVE] Local: {student_id} / {unit}")
+    except Exception as e:
+        print(f"[PROGRESS_SAVE] Error: {e}")
+
+def save_student_progress(student_id, student_progress, drop_ids=()):
+    """1 人分の進行状況を丸ごと書き込み、旧 ID（drop_ids）のエントリを削除する"""
+    if USE_FIRESTORE and firestore_client:
+        try:
+            collection = firestore_client.collection('sb_learning_progress')
             batch = firestore_client.batch()
-            count = 0
-            for student_id, student_obj in progress_data.items():
-                doc_ref = firestore_client.collection('sb_learning_progress').document(str(student_id))
-                batch.set(doc_ref, student_obj)
-                count += 1
-                if count >= 500:
-                    batch.commit()
-                    batch = firestore_client.batch()
-                    count = 0
-            if count > 0:
-                batch.commit()
-            print(f"[PROGRESS_SAVE] Firestore: imported {len(progress_data)} student progress entries")
+            batch.set(collection.document(str(student_id)), student_progress)
+            for old_id in drop_ids:
+                batch.delete(collection.document(str(old_id)))
+            batch.commit()
+            print(f"[PROGRESS_SAVE] Firestore: {student_id} (dropped {list(drop_ids)})")
             return
         except Exception as e:
             print(f"[PROGRESS_SAVE] Firestore failed: {e}, falling back to local file")
 
-    # ローカルファイルに保存（フォールバック）
+    def _apply(progress_data):
+        progress_data[student_id] = student_progress
+        for old_id in drop_ids:
+            progress_data.pop(old_id, None)
+
     try:
-        _atomic_write_json(LEARNING_PROGRESS_FILE, progress_data)
-        print(f"[PROGRESS_SAVE] Local file saved successfully")
+        learning_progress_doc.update(_apply)
+        print(f"[PROGRESS_SAVE] Local: {student_id} (dropped {list(drop_ids)})")
     except Exception as e:
         print(f"[PROGRESS_SAVE] Error: {e}")
 
+def _default_unit_progress():
+    """単元の進行状況の初期値"""
+    return {
+        "current_stage": "prediction",
+        "last_access": datetime.now().isoformat(),
+        "stage_progress": {
+            "prediction": {
+                "started": False,
+                "conversation_count": 0,
+                "summary_created": False,
+                "last_message": ""
+            },
+            "experiment": {
+                "started": False,
+                "completed": False
+            },
+            "reflection": {
+                "started": False,
+                "conversation_count": 0,
+                "summary_created": False
+            }
+        },
+        "conversation_history": [],
+        "reflection_conversation_history": []
+    }
+
 def get_student_progress(class_number, student_number, unit):
     """特定の学習者の単元進行状況を取得"""
-    normalized_class = normalize_class_value(class_number)
-    class_number = normalized_class if normalized_class is not None else class_number
-    legacy_ids = []
-    if class_number == '5':
-        legacy_ids.append(f"lab_{student_number}")
-    student_id = f"{class_number}_{student_number}"
-    progress_data = load_learning_progress()
-    for legacy_id in legacy_ids:
-        if legacy_id in progress_data and student_id not in progress_data:
-            progress_data[student_id] = progress_data.pop(legacy_id)
-            save_learning_progress(progress_data)
-            break
-    
-    if student_id not in progress_data:
-        progress_data[student_id] = {}
-    
-    if unit not in progress_data[student_id]:
-        progress_data[student_id][unit] = {
-            "current_stage": "prediction",
-            "last_access": datetime.now().isoformat(),
-            "stage_progress": {
-                "prediction": {
-                    "started": False,
-                    "conversation_count": 0,
-                    "summary_created": False,
-                    "last_message": ""
-                },
-                "experiment": {
-                    "started": False,
-                    "completed": False
-                },
-                "reflection": {
-                    "started": False,
-                    "conversation_count": 0,
-                    "summary_created": False
-                }
-            },
-            "conversation_history": [],
-            "reflection_conversation_history": []
-        }
-    
-    return progress_data[student_id][unit]
+    return get_progress_snapshot(class_number, student_number).unit(unit)
+
+def mark_summary_created(student_id, unit, stages):
+    """指定した段階（'prediction' / 'reflection'）の summary_created を立てる
+
+    ローカルではロック内で読み直したデータに対してフラグを立てるため、
+    別スレッド・別プロセスが同じ単元を並行して更新しても書き込みが失われない。
+    Firestore では単元が無いときだけ初期値を書き込み、既存の単元のフラグは
+    フィールドパス指定の update で立てる（空のマップは merge しない。
+    merge すると既存のフラグが消えるため）。
+    更新後の単元の進行状況を返す（保存に失敗した場合は None）。
+    """
+    if USE_FIRESTORE and firestore_client:
+        try:
+            from google.cloud.firestore_v1.field_path import FieldPath
+            doc_ref = firestore_client.collection('sb_learning_progress').document(str(student_id))
+            doc = doc_ref.get()
+            unit_progress = (doc.to_dict() or {}).get(unit) if doc.exists else None
+            if unit_progress is None:
+                # 初回: 単元の初期値（＋指定のフラグ）を書き込む
+                unit_progress = _default_unit_progress()
+                for stage in stages:
+                    unit_progress['stage_progress'][stage]['summary_created'] = True
+                doc_ref.set({unit: unit_progress}, merge=True)
+            elif stages:
+                doc_ref.update({
+                    FieldPath(unit, 'stage_progress', stage, 'summary_created').to_api_repr(): True
+                    for stage in stages
+                })
+                stage_progress = unit_progress.setdefault('stage_progress', {})
+                for stage in stages:
+                    stage_progress.setdefault(stage, {})['summary_created'] = True
+            else:
+                return unit_progress
+            print(f"[PROGRESS_SAVE] Firestore: {student_id} / {unit} flags={list(stages)}")
+            return unit_progress
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Firestore failed: {e}, falling back to local file")
+
+    def _apply(progress_data):
+        # 読み込み側と共有しているため、変更する階層はすべてコピーしてから差し替える
+        student_progress = dict(progress_data.get(student_id, {}))
+        unit_progress = copy.deepcopy(student_progress.get(unit)) or _default_unit_progress()
+        stage_progress = unit_progress.setdefault('stage_progress', {})
+        for stage in stages:
+            stage_progress.setdefault(stage, {})['summary_created'] = True
+        student_progress[unit] = unit_progress
+        progress_data[student_id] = student_progress
+        return unit_progress
+
+    try:
+        unit_progress = learning_progress_doc.update(_apply)
+        print(f"[PROGRESS_SAVE] Local: {student_id} / {unit} flags={list(stages)}")
+        return unit_progress
+    except Exception as e:
+        print(f"[PROGRESS_SAVE] Error: {e}")
+        return None
 
 def update_student_progress(class_number, student_number, unit, prediction_summary_created=False, reflection_summary_created=False):
-    """学習者の進行状況を更新（フラグのみ保存）"""
-    normalized_class = normalize_class_value(class_number)
-    class_number = normalized_class if normalized_class is not None else class_number
-    progress_data = load_learning_progress()
-    student_id = f"{class_number}_{student_number}"
-    
-    # 現在の進行状況を取得
-    current_progress = get_student_progress(class_number, student_number, unit)
-    
-    # 予想・考察の完了フラグのみ更新
-    if prediction_summary_created:
-        current_progress["stage_progress"]["prediction"]["summary_created"] = True
-    if reflection_summary_created:
-        current_progress["stage_progress"]["reflection"]["summary_created"] = True
-    
-    # 進行状況を保存
-    if student_id not in progress_data:
-        progress_data[student_id] = {}
-    progress_data[student_id][unit] = current_progress
-    
-    save_learning_progress(progress_data)
-    return current_progress
+    """学習者の進行状況を更新（フラグのみ保存）
 
+    変更のあった児童・単元のエントリだけを書き込む。既存エントリでフラグにも
+    変化がない場合は書き込み自体を省略する。フラグの書き込みはロック内で
+    最新データに対して行う（mark_summary_created）。
+    """
+    snapshot = get_progress_snapshot(class_number, student_number)
+    
+    # 現在の進行状況を取得（未保存の単元は初期値を書き込む）
+    current_progress = snapshot.unit(unit)
+    stage_progress = current_progress["stage_progress"]
+    
+    # 予想・考察の完了フラグのうち、まだ立っていないものだけを更新
+    stages = []
+    if prediction_summary_created and not stage_progress["prediction"]["summary_created"]:
+        stages.append("prediction")
+    if reflection_summary_created and not stage_progress["reflection"]["summary_created"]:
+        stages.append("reflection")
+    if not stages and snapshot.exists(unit):
+        return current_progress
+    
+    # 進行状況を保存（該当エントリのみ、ロック内で適用）
+    updated = mark_summary_created(snapshot.student_id, unit, stages)
+    if updated is None:
+        # 保存に失敗した場合もこのリクエストの間はスナップショット側に反映する
+        updated = copy.deepcopy(current_progress)
+        for stage in stages:
+            updated["stage_progress"][stage]["summary_created"] = True
+    snapshot.units[unit] = updated
+    return updated
 
 def check_resumption_needed(class_number, student_number, unit):
     """復帰が必要かチェック（現在は常にFalse。セッションリセット方針のため）"""
@@ -855,8 +1554,11 @@ def has_substantive_content(text):
     except Exception:
         return False
 
+# /chat・/reflect_chat のストリーミング版（SSE）を有効にするか
+STREAMING_CHAT_ENABLED = os.environ.get('STREAMING_CHAT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+
 # APIコール用のリトライ関数
-def call_openai_with_retry(prompt, max_retries=5, delay=3, unit=None, stage=None, model_override=None, enable_cache=False, temperature=None):
+def call_openai_with_retry(prompt, max_retries=5, delay=3, unit=None, stage=None, model_override=None, enable_cache=False, temperature=None, priority='chat', class_key=None):
     """OpenAI APIを呼び出し、エラー時はリトライする
     
     Args:
@@ -868,31 +1570,30 @@ def call_openai_with_retry(prompt, max_retries=5, delay=3, unit=None, stage=None
         model_override: モデルオーバーライド
         enable_cache: プロンプトキャッシング有効化（システムメッセージに対して有効）
         temperature: 生成の多様性パラメータ (指定がない場合はstageから自動決定)
+        priority: スケジューラの優先度（'chat' / 'summary' / 'analytics'）
+        class_key: 公平キューのクラス（省略時はセッションのクラス番号）
     
     改善点:
     - Windows/デザリング環境での通信エラーに対応するため、timeout を 60秒に延長
     - リトライ回数を 5 回に増加し、指数バックオフで待機
-    - Semaphore で同時実行数を制限（OpenAI rate limit 回避）
+    - openai_scheduler で同時実行数・RPM/TPM を制限（permit は 1 回の呼び出し分だけ保持）
     - 500番台エラーをより詳細に記録・診断
     """
-    if client is None:
+    if not client:
         return "AI システムの初期化に問題があります。管理者に連絡してください。"
     
-    # ========================================================================
-    # Semaphore: OpenAI API への同時リクエスト数を制限
-    # （30 人同時接続でも rate limit に引っかからないようにするため）
-    # ========================================================================
-    print(f"[OPENAI_QUEUE] Request waiting in queue... (limit: {OPENAI_CONCURRENT_LIMIT})")
-    with openai_request_semaphore:
-        print(f"[OPENAI_QUEUE] Request acquired, calling OpenAI API...")
-        return _call_openai_impl(prompt, max_retries, delay, unit, stage, model_override, enable_cache, temperature)
+    if class_key is None:
+        class_key = _current_class_key()
+    return _call_openai_impl(prompt, max_retries, delay, unit, stage, model_override, enable_cache, temperature,
+                             priority=priority, class_key=class_key)
 
 
-def _call_openai_impl(prompt, max_retries=5, delay=3, unit=None, stage=None, model_override=None, enable_cache=False, temperature=None):
-    """Internal OpenAI API caller (called within Semaphore context)"""
-    if client is None:
-        return "AI システムの初期化に問題があります。管理者に連絡してください。"
-    
+def _build_openai_request(prompt, stage=None, model_override=None, enable_cache=False, temperature=None):
+    """chat.completions.create に渡すメッセージとパラメータを組み立てる
+
+    Returns:
+        (model_name, messages, params) のタプル
+    """
     # promptがリストの場合（メッセージフォーマット）
     if isinstance(prompt, list):
         messages = prompt.copy()  # 元のリストを変更しないようにコピー
@@ -911,48 +1612,62 @@ def _call_openai_impl(prompt, max_retries=5, delay=3, unit=None, stage=None, mod
                     'cache_control': {'type': 'ephemeral'}
                 }
     
+    # temperatureが指定されていない場合、stage（学習段階）に応じて設定
+    if temperature is None:
+        # 予想段階: より創造的で多様な回答 (1.0)
+        # 考察段階: より創造的で多様な回答 (1.0) - 実験後の新しい気づきを促す
+        if stage == 'prediction':
+            temperature = 1.0
+        elif stage == 'reflection':
+            temperature = 1.0  # 実験結果との比較から新しい視点を引き出すため
+        else:
+            temperature = 0.5  # デフォルト
+    
+    # モデル選択: model_override > DEFAULT_OPENAI_MODEL > gpt-4o-mini
+    model_name = model_override if model_override else DEFAULT_OPENAI_MODEL
+    
+    # プロンプトキャッシングの状態をログ出力
+    cache_enabled = any(msg.get('cache_control') for msg in messages)
+    if cache_enabled:
+        print(f"[OPENAI_CACHE] Prompt caching enabled for model: {model_name}")
+
+    # モデルによってトークン制限パラメータを切り替え
+    # gpt-4o-2024-08-06以降のモデルはmax_completion_tokensを使用
+    params = {'temperature': temperature}
+    if 'o1' in model_name or '2024-08' in model_name or '2025' in model_name:
+        params['max_completion_tokens'] = 2000
+    else:
+        params['max_tokens'] = 2000
+
+    # タイムアウトをデザリング環境向けに拡張（60秒）
+    params['timeout'] = int(os.environ.get('OPENAI_API_TIMEOUT', 60))
+    return model_name, messages, params
+
+
+def _call_openai_impl(prompt, max_retries=5, delay=3, unit=None, stage=None, model_override=None, enable_cache=False, temperature=None, priority='chat', class_key=None):
+    """Internal OpenAI API caller
+
+    試行ごとに openai_scheduler の permit を取得し、リトライ待ちの sleep は
+    permit を返却してから行う。
+    """
+    if not client:
+        return "AI システムの初期化に問題があります。管理者に連絡してください。"
+    
+    model_name, messages, params = _build_openai_request(prompt, stage, model_override, enable_cache, temperature)
+    estimated_tokens = _estimate_tokens(messages, params.get('max_tokens') or params.get('max_completion_tokens'))
+    
     for attempt in range(max_retries):
         try:
-            import time
-            start_time = time.time()
-            
-            # temperatureが指定されていない場合、stage（学習段階）に応じて設定
-            if temperature is None:
-                # 予想段階: より創造的で多様な回答 (1.0)
-                # 考察段階: より創造的で多様な回答 (1.0) - 実験後の新しい気づきを促す
-                if stage == 'prediction':
-                    temperature = 1.0
-                elif stage == 'reflection':
-                    temperature = 1.0  # 実験結果との比較から新しい視点を引き出すため
-                else:
-                    temperature = 0.5  # デフォルト
-            
-            # モデル選択: model_override > DEFAULT_OPENAI_MODEL > gpt-4o-mini
-            model_name = model_override if model_override else DEFAULT_OPENAI_MODEL
-            
-            # プロンプトキャッシングの状態をログ出力
-            cache_enabled = any(msg.get('cache_control') for msg in messages)
-            if cache_enabled:
-                print(f"[OPENAI_CACHE] Prompt caching enabled for model: {model_name}")
-
-            # モデルによってトークン制限パラメータを切り替え
-            # gpt-4o-2024-08-06以降のモデルはmax_completion_tokensを使用
-            token_param = {}
-            if 'o1' in model_name or '2024-08' in model_name or '2025' in model_name:
-                token_param['max_completion_tokens'] = 2000
-            else:
-                token_param['max_tokens'] = 2000
-
-            # タイムアウトをデザリング環境向けに拡張（60秒）
-            openai_timeout = int(os.environ.get('OPENAI_API_TIMEOUT', 60))
-            
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                timeout=openai_timeout,
-                **token_param
-            )
+            print(f"[OPENAI_QUEUE] Request waiting in queue... (priority: {priority}, class: {class_key})")
+            with openai_scheduler.slot(priority, class_key, estimated_tokens, timeout=OPENAI_QUEUE_TIMEOUT) as reservation:
+                response = client.chat.completions.create(
+                    model=model_name,
+                    messages=messages,
+                    **params
+                )
+                usage = getattr(response, 'usage', None)
+                if usage is not None and isinstance(getattr(usage, 'total_tokens', None), int):
+                    reservation['total_tokens'] = usage.total_tokens
             
             # トークン使用状況とキャッシュヒット率をログ出力
             if hasattr(response, 'usage'):
@@ -979,6 +1694,9 @@ def _call_openai_impl(prompt, max_retries=5, delay=3, unit=None, stage=None, mod
             else:
                 raise Exception("空の応答が返されました")
                 
+        except OpenAIQueueTimeout as e:
+            print(f"[OPENAI_QUEUE] {e}")
+            return "現在アクセスが集中しています。しばらく待ってから再度お試しください。"
         except Exception as e:
             error_msg = str(e)
             
@@ -1013,6 +1731,48 @@ def _call_openai_impl(prompt, max_retries=5, delay=3, unit=None, stage=None, mod
                     
     return "複数回の試行後もAPIに接続できませんでした。しばらく待ってから再度お試しください。"
 
+
+def stream_openai_with_retry(prompt, max_retries=3, delay=3, unit=None, stage=None, model_override=None, enable_cache=False, temperature=None, priority='chat', class_key=None):
+    """OpenAI のストリーミング API を呼び出し、生成されたテキストの差分を順に yield する
+
+    最初のトークンを受け取る前の失敗はリトライする。途中で失敗した場合や
+    リトライが尽きた場合は例外を送出する（呼び出し側でエラーイベントにする）。
+    permit はストリームを読み切るまで保持し、リトライ待ちの間は返却する。
+    """
+    if not client:
+        raise RuntimeError("OpenAI client is not initialized")
+
+    if class_key is None:
+        class_key = _current_class_key()
+    model_name, messages, params = _build_openai_request(prompt, stage, model_override, enable_cache, temperature)
+    estimated_tokens = _estimate_tokens(messages, params.get('max_tokens') or params.get('max_completion_tokens'))
+    for attempt in range(max_retries):
+        started = False
+        try:
+            print(f"[OPENAI_QUEUE] Stream request waiting in queue... (priority: {priority}, class: {class_key})")
+            with openai_scheduler.slot(priority, class_key, estimated_tokens, timeout=OPENAI_QUEUE_TIMEOUT):
+                stream = client.chat.completions.create(
+                    model=model_name,
+                    messages=messages,
+                    stream=True,
+                    **params
+                )
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        started = True
+                        yield delta
+            if not started:
+                raise Exception("空の応答が返されました")
+            return
+        except Exception as e:
+            print(f"[OPENAI_STREAM_ERROR] attempt {attempt + 1}/{max_retries}: {type(e).__name__}: {e}")
+            if started or isinstance(e, OpenAIQueueTimeout) or attempt >= max_retries - 1:
+                raise
+        time.sleep(delay * (attempt + 1))
+
 # 学習単元のデータ
 UNITS = [
     "金属のあたたまり方",
@@ -1021,24 +1781,123 @@ UNITS = [
     "水を冷やし続けた時の温度と様子"
 ]
 
+# ============================================================================
+# プロンプト・課題文レジストリ
+# prompts/ と tasks/ のファイルを起動時にすべて読み込み、読み取り専用の
+# スナップショットとしてメモリに保持する（チャット処理中はファイルを読まない）。
+# バックグラウンドのスレッドが PROMPT_RELOAD_INTERVAL 秒ごとに更新時刻を確認し、
+# 変更があればスナップショットを丸ごと差し替える。教員画面から手動で再読み込みもできる。
+# ============================================================================
+import types as _types
+
+TASKS_DIR = Path('tasks')
+PROMPT_RELOAD_INTERVAL = float(os.environ.get('PROMPT_RELOAD_INTERVAL', 10))  # 0 で監視しない
+
+
+class PromptRegistry:
+    """プロンプト・課題文ファイルのインメモリキャッシュ"""
+
+    def __init__(self, directories):
+        self.directories = [Path(d) for d in directories]
+        self._lock = threading.Lock()
+        self._texts = _types.MappingProxyType({})
+        self._stamps = {}
+        self.version = 0
+        self.loaded_at = None
+
+    def _scan(self):
+        """{パス文字列: (mtime_ns, size)} を返す"""
+        stamps = {}
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                st = entry.stat()
+                stamps[str(directory / entry.name)] = (st.st_mtime_ns, st.st_size)
+        return stamps
+
+    def reload(self, force=False):
+        """変更があったファイルだけ読み直してスナップショットを差し替える
+
+        Returns:
+            変更（追加・更新・削除）されたファイル数
+        """
+        with self._lock:
+            stamps = self._scan()
+            if not force and stamps == self._stamps:
+                return 0
+            texts = {}
+            changed = 0
+            for path, stamp in stamps.items():
+                if not force and self._stamps.get(path) == stamp and path in self._texts:
+                    texts[path] = self._texts[path]
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        texts[path] = f.read()
+                    changed += 1
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"[PROMPTS] Could not read {path}: {e}")
+            changed += len(set(self._texts) - set(texts))
+            self._texts = _types.MappingProxyType(texts)
+            self._stamps = stamps
+            self.version += 1
+            self.loaded_at = datetime.now().isoformat()
+            print(f"[PROMPTS] Loaded {len(texts)} files ({changed} changed, version {self.version})")
+            return changed
+
+    def get(self, path):
+        """ファイルの内容（未登録なら None）"""
+        return self._texts.get(str(path))
+
+    def stats(self):
+        return {'files': len(self._texts), 'version': self.version, 'loaded_at': self.loaded_at}
+
+    def start_watcher(self, interval):
+        if interval <= 0:
+            return
+
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    print(f"[PROMPTS] Reload check failed: {e}")
+
+        threading.Thread(target=watch, name='prompt-registry-watcher', daemon=True).start()
+
+
+prompt_registry = PromptRegistry([PROMPTS_DIR, TASKS_DIR])
+prompt_registry.reload(force=True)
+prompt_registry.start_watcher(PROMPT_RELOAD_INTERVAL)
+
+
 # 課題文を読み込む関数
 def load_task_content(unit_name):
-    try:
-        with open(f'tasks/{unit_name}.txt', 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except FileNotFoundError:
+    text = prompt_registry.get(TASKS_DIR / f"{unit_name}.txt")
+    if text is None:
         return f"{unit_name}について実験を行います。どのような結果になると予想しますか？"
+    return text.strip()
 
 INITIAL_MESSAGES_FILE = PROMPTS_DIR / 'initial_messages.json'
 
-@lru_cache(maxsize=1)
 def _load_initial_messages():
-    try:
-        with open(INITIAL_MESSAGES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
+    return _parse_initial_messages(prompt_registry.version)
+
+@lru_cache(maxsize=2)
+def _parse_initial_messages(version):
+    """レジストリのバージョンごとに initial_messages.json を 1 回だけ解析する"""
+    text = prompt_registry.get(INITIAL_MESSAGES_FILE)
+    if text is None:
         print(f"[INIT_MSG] Warning: {INITIAL_MESSAGES_FILE} not found.")
         return {}
+    try:
+        return json.loads(text)
     except json.JSONDecodeError as e:
         print(f"[INIT_MSG] JSON decode error: {e}")
         return {}
@@ -1082,8 +1941,10 @@ def load_unit_prompt(unit_name, stage=None):
             # 従来の単一プロンプトにフォールバック
             prompt_path = PROMPTS_DIR / f"{unit_name}.md"
         
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+        text = prompt_registry.get(prompt_path)
+        if text is None:
+            raise FileNotFoundError(prompt_path)
+        return text.strip()
     except FileNotFoundError:
         return "児童の発言をよく聞いて、適切な質問で考えを引き出してください。"
 
@@ -1091,8 +1952,10 @@ def load_prompt_template(filename):
     """汎用テンプレートを読み込み"""
     try:
         template_path = PROMPTS_DIR / filename
-        with open(template_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        text = prompt_registry.get(template_path)
+        if text is None:
+            raise FileNotFoundError(template_path)
+        return text
     except FileNotFoundError:
         print(f"[PROMPTS] Warning: template '{filename}' not found")
         return ""
@@ -1105,6 +1968,63 @@ def render_prompt_template(template: str, **placeholders):
     return rendered
 
 
+# 学習ログの保存先（日次・追記専用セグメント）
+# 1 件ごとに日次配列を読み直して書き戻すのをやめ、NDJSON レコードを
+# ローテーションするセグメントへ追記する。
+LOG_SEGMENT_MAX_BYTES = int(os.environ.get('LOG_SEGMENT_MAX_BYTES', DEFAULT_SEGMENT_MAX_BYTES))
+learning_log_store = SegmentedLogStore(
+    base_dir='logs',
+    prefix='learning_log',
+    bucket=bucket if USE_GCS else None,
+    gcs_prefix='logs',
+    segment_max_bytes=LOG_SEGMENT_MAX_BYTES,
+)
+# (日付, 単元, クラス, 出席番号) ごとのバイト位置の索引。エクスポートやログ一覧は
+# 該当するパーティションだけを読む（索引は読み込み時に追記分だけ更新される）
+LOG_INDEX_DIR = os.environ.get('LOG_INDEX_DIR', os.path.join('logs', '_index'))
+learning_log_index = LogIndex(learning_log_store, LOG_INDEX_DIR)
+
+# ログがある日付の一覧（ローカル + GCS の一覧を TTL 付きでキャッシュし、書き込み時に追加する）
+LOG_DATE_CACHE_TTL = float(os.environ.get('LOG_DATE_CACHE_TTL', 300))
+
+
+def _date_sources(local_source, gcs_prefix):
+    sources = [local_source]
+    if USE_GCS:
+        # バケットは一覧取得時に作成する（作成できなければ GCS 分は空）
+        sources.append(lambda: list_gcs_dates(bucket, gcs_prefix) if bucket else [])
+    return sources
+
+
+learning_log_dates = LogDateCatalog(
+    'learning_log', _date_sources(learning_log_store.local_dates, 'logs/learning_log_'), ttl=LOG_DATE_CACHE_TTL
+)
+# エラーログも日次・追記専用セグメントに書き込む（GCS は error_logs/ 以下）。
+# 終わった日のセグメントは定期的に従来の日次ファイル error_log_YYYYMMDD.json へまとめる。
+error_log_store = SegmentedLogStore(
+    base_dir='logs',
+    prefix='error_log',
+    bucket=bucket if USE_GCS else None,
+    gcs_prefix='error_logs',
+    segment_max_bytes=LOG_SEGMENT_MAX_BYTES,
+)
+error_log_dates = LogDateCatalog(
+    'error_log', _date_sources(error_log_store.local_dates, 'error_logs/error_log_'), ttl=LOG_DATE_CACHE_TTL
+)
+
+
+def _append_learning_log_batch(items):
+    """キューに溜まった (日付, エントリ) をまとめて日付ごとに追記"""
+    by_date = {}
+    for log_date, entry in items:
+        by_date.setdefault(log_date, []).append(entry)
+    for log_date, entries in by_date.items():
+        learning_log_store.append_many(entries, date=log_date)
+        learning_log_dates.note_write(log_date)
+
+
+persistence_queue.register_batch_handler('learning_log', _append_learning_log_batch)
+
 # 学習ログを保存する関数
 def save_learning_log(student_number, unit, log_type, data, class_number=None):
     """学習ログをGCSまたはローカルJSONに保存
@@ -1150,51 +2070,14 @@ def save_learning_log(student_number, unit, log_type, data, class_number=None):
         'data': data
     }
     
-    if USE_GCS and bucket:
-        # 本番環境: GCSにも保存する（ローカル保存は必ず実施）
-        try:
-            log_date = datetime.now().strftime('%Y%m%d')
-            log_filename = f"logs/learning_log_{log_date}.json"
-            
-            print(f"[LOG_SAVE] GCS START - path: {log_filename}, class: {class_display}, unit: {unit}, type: {log_type}")
-            
-            blob = bucket.blob(log_filename)
-            logs = []
-            try:
-                content = blob.download_as_string()
-                logs = json.loads(content.decode('utf-8'))
-            except Exception:
-                logs = []
-            
-            logs.append(log_entry)
-            
-            blob.upload_from_string(
-                json.dumps(logs, ensure_ascii=False, indent=2).encode('utf-8'),
-                content_type='application/json'
-            )
-            print(f"[LOG_SAVE] GCS SUCCESS - saved to GCS (local copy will also be written)")
-        except Exception as e:
-            print(f"[LOG_SAVE] GCS ERROR - {type(e).__name__}: {str(e)}, continue with local save")
-            import traceback
-            traceback.print_exc()
-    
-    # ローカルファイルにも必ず保存
-    log_filename = f"learning_log_{datetime.now().strftime('%Y%m%d')}.json"
-    os.makedirs('logs', exist_ok=True)
-    log_file = f"logs/{log_filename}"
-    
-    logs = []
-    if os.path.exists(log_file):
-        try:
-            with open(log_file, 'r', encoding='utf-8') as f:
-                logs = json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            logs = []
-    
-    logs.append(log_entry)
-    
-    with open(log_file, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, ensure_ascii=False, indent=2)
+    # 追記専用セグメントに1レコードだけ書き込む（GCS が有効なら GCS にも追記）
+    # 通常はキューに積み、同時に溜まったエントリはまとめて1回で追記する
+    print(f"[LOG_SAVE] START - class: {class_display}, unit: {unit}, type: {log_type}, gcs: {bool(USE_GCS and bucket)}")
+    log_date = log_entry['timestamp'][:10].replace('-', '')
+    if _persist_in_background():
+        persistence_queue.submit_batch('learning_log', (log_date, log_entry))
+    else:
+        learning_log_store.append(log_entry, date=log_date)
 
 # 学習ログを読み込む関数
 def load_learning_logs(date=None):
@@ -1202,60 +2085,43 @@ def load_learning_logs(date=None):
     if date is None:
         date = datetime.now().strftime('%Y%m%d')
     
-    # 本番環境: GCS優先
-    if USE_GCS and bucket:
-        # GCS から読み込み
-        try:
-            log_filename = f"logs/learning_log_{date}.json"
-            print(f"[LOG_LOAD] GCS START - loading logs from: {log_filename}")
-            
-            blob = bucket.blob(log_filename)
-            try:
-                content = blob.download_as_string()
-                logs = json.loads(content.decode('utf-8'))
-                log_count = len(logs)
-                print(f"[LOG_LOAD] GCS SUCCESS - loaded {log_count} logs from {date}")
-                return logs
-            except Exception as e:
-                print(f"[LOG_LOAD] GCS file not found: {log_filename}")
-        except Exception as e:
-            print(f"[LOG_LOAD] GCS ERROR - {type(e).__name__}: {str(e)}")
-            import traceback
-            traceback.print_exc()
-    
-    # 開発環境またはGCS失敗時: ローカルファイルから読み込み
-    log_filename = f"learning_log_{date}.json"
-    log_file = f"logs/{log_filename}"
-    
-    if not os.path.exists(log_file):
-        return []
-    
+    # GCS 優先で、旧形式の日次配列ファイルと追記セグメントの両方を読み込む
+    logs = learning_log_store.load(date)
+    print(f"[LOG_LOAD] loaded {len(logs)} logs from {date}")
+    return logs
+
+def query_learning_logs(date, unit=None, class_num=None, seat_num=None):
+    """指定日の学習ログのうち、単元・クラス・出席番号が一致するものだけを読み込む
+
+    None の条件は絞り込まない。索引が使えない場合は日全体を読み込んで絞り込む。
+    """
     try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+        return learning_log_index.query(date, unit=unit or None, class_num=class_num, seat_num=seat_num)
+    except Exception as e:
+        print(f"[LOG_INDEX] query failed for {date}, falling back to full load: {type(e).__name__}: {e}")
+    logs = load_learning_logs(date)
+    return [
+        log for log in logs
+        if (not unit or log.get('unit') == unit)
+        and (class_num is None or log.get('class_num') == class_num)
+        and (seat_num is None or log.get('seat_num') == seat_num)
+    ]
 
 def get_available_log_dates():
-    """利用可能な全ログの日付リストを取得"""
-    import glob
-    import os
-    
-    # ローカルファイル
-    dates = []
-    log_files = glob.glob("logs/learning_log_*.json")
-    for file in log_files:
-        filename = os.path.basename(file)
-        if filename.startswith('learning_log_') and filename.endswith('.json'):
-            date_str = filename[13:-5]
-            if len(date_str) == 8 and date_str.isdigit():
-                dates.append(date_str)
-    
-    dates.sort(reverse=True)  # 新しい順
+    """利用可能な全ログの日付リストを取得（新しい順）
+
+    ローカルファイル（旧形式の .json と追記セグメントの .jsonl）と GCS の logs/ を
+    合わせた一覧を learning_log_dates にキャッシュしている。
+    """
+    dates = learning_log_dates.dates()
     print(f"[DATES] Found {len(dates)} log dates: {dates[:5]}")
     
     return dates
 
+def get_available_error_log_dates():
+    """エラーログがある日付のリストを取得（新しい順、ローカルと GCS の error_logs/）"""
+    return error_log_dates.dates()
+
 # エラーログ管理機能
 def save_error_log(student_number, class_number, error_message, error_type, stage, unit, additional_info=None):
     """児童のエラーをログに記録
@@ -1278,6 +2144,7 @@ def save_error_log(student_number, class_number, error_message, error_type, stag
         class_display = str(student_number)
     
     error_entry = {
+        'id': uuid.uuid4().hex,
         'timestamp': datetime.now().isoformat(),
         'student_number': student_number,
         'class_number': class_number,
@@ -1289,103 +2156,141 @@ def save_error_log(student_number, class_number, error_message, error_type, stag
         'additional_info': additional_info or {}
     }
     
-    # GCSに保存
-    if USE_GCS and bucket:
+    # 同じエラーが一斉に報告された場合は最初の数件だけ記録し、残りは件数のまとめにする
+    for entry in error_log_sampler.record(error_entry):
+        _queue_error_entry(entry)
+    print(f"[ERROR_LOG] Queued - {class_display}: {error_type}")
+
+
+# エラーログの書き込み: エントリはバッファに溜め、ERROR_LOG_FLUSH_INTERVAL 秒ごとに
+# まとめて 1 回で追記する（障害時にエラー報告が殺到しても GCS への書き込みは増えない）
+ERROR_LOG_FLUSH_INTERVAL = float(os.environ.get('ERROR_LOG_FLUSH_INTERVAL', 1.0))
+# 同じ error_type + error_message は ERROR_LOG_SAMPLE_WINDOW 秒ごとに ERROR_LOG_SAMPLE_KEEP 件まで記録
+ERROR_LOG_SAMPLE_WINDOW = float(os.environ.get('ERROR_LOG_SAMPLE_WINDOW', 60))
+ERROR_LOG_SAMPLE_KEEP = int(os.environ.get('ERROR_LOG_SAMPLE_KEEP', 5))
+# 終わった日のセグメントを日次ファイルへまとめる間隔（0 で無効）
+ERROR_LOG_COMPACT_INTERVAL = float(os.environ.get('ERROR_LOG_COMPACT_INTERVAL', 3600))
+# 最後の書き込みからこの秒数が経ったセグメントだけをまとめる
+ERROR_LOG_COMPACT_MIN_IDLE = 15 * 60
+
+error_log_sampler = BurstSampler(window=ERROR_LOG_SAMPLE_WINDOW, keep=ERROR_LOG_SAMPLE_KEEP)
+error_log_queue = WriteBehindQueue(
+    name='error_log',
+    max_size=int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 2000)),
+    workers=1,
+    batch_size=500,
+    batch_wait=ERROR_LOG_FLUSH_INTERVAL,
+)
+atexit.register(error_log_queue.shutdown)
+
+
+def _append_error_log_batch(items):
+    """溜まった (日付, エントリ) を日付ごとにまとめて追記"""
+    by_date = {}
+    for log_date, entry in items:
+        by_date.setdefault(log_date, []).append(entry)
+    for log_date, entries in by_date.items():
+        error_log_store.append_many(entries, date=log_date)
+        error_log_dates.note_write(log_date)
+    print(f"[ERROR_LOG] Appended {len(items)} entries")
+
+
+error_log_queue.register_batch_handler('error_log', _append_error_log_batch)
+
+
+def _queue_error_entry(entry):
+    log_date = str(entry.get('timestamp', ''))[:10].replace('-', '') or datetime.now().strftime('%Y%m%d')
+    if _persist_in_background():
+        error_log_queue.submit_batch('error_log', (log_date, entry))
+    else:
+        _append_error_log_batch([(log_date, entry)])
+
+
+# まとめ終わった日付（プロセス内で記録し、次回以降は調べない）
+_compacted_error_log_dates = set()
+
+
+def compact_error_logs():
+    """今日より前の日のエラーログのセグメントを日次ファイルへまとめる"""
+    today = datetime.now().strftime('%Y%m%d')
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y%m%d')
+    compacted = 0
+    for date in get_available_error_log_dates():
+        if date >= today or date in _compacted_error_log_dates:
+            continue
         try:
-            _save_error_log_gcs(error_entry)
-            print(f"[ERROR_LOG] GCS saved - {class_display}")
+            if error_log_store.compact(date, min_idle=ERROR_LOG_COMPACT_MIN_IDLE, id_field='id'):
+                compacted += 1
+            # 前日分は日付が変わった直後の書き込みがありうるので次回も調べる
+            if date < yesterday:
+                _compacted_error_log_dates.add(date)
         except Exception as e:
-            print(f"[ERROR_LOG] GCS save failed: {e}")
-    
-    # ローカルにも保存
-    try:
-        _save_error_log_local(error_entry)
-        print(f"[ERROR_LOG] Local saved - {class_display}")
-    except Exception as e:
-        print(f"[ERROR_LOG] Local save failed: {e}")
+            print(f"[ERROR_LOG] Compaction failed for {date}: {type(e).__name__}: {e}")
+    return compacted
 
-def _save_error_log_local(error_entry):
-    """エラーログをローカルファイルに保存"""
-    os.makedirs('logs', exist_ok=True)
-    error_log_file = f"logs/error_log_{datetime.now().strftime('%Y%m%d')}.json"
-    
-    logs = []
-    if os.path.exists(error_log_file):
-        try:
-            with open(error_log_file, 'r', encoding='utf-8') as f:
-                logs = json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            logs = []
-    
-    logs.append(error_entry)
-    
-    with open(error_log_file, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, ensure_ascii=False, indent=2)
 
-def _save_error_log_gcs(error_entry):
-    """エラーログをGCSに保存"""
-    try:
-        from google.cloud import storage
-        
-        date = datetime.now().strftime('%Y%m%d')
-        gcs_path = f"error_logs/error_log_{date}.json"
-        blob = bucket.blob(gcs_path)
-        
-        # 既存のエラーログを読み込み
-        logs = []
-        if blob.exists():
-            try:
-                content = blob.download_as_string().decode('utf-8')
-                logs = json.loads(content)
-            except:
-                logs = []
-        
-        # 新しいエラーを追加
-        logs.append(error_entry)
-        
-        # GCSに保存
-        blob.upload_from_string(
-            json.dumps(logs, ensure_ascii=False, indent=2),
-            content_type='application/json'
-        )
-        
-        print(f"[ERROR_LOG_GCS] {gcs_path} saved")
-    except Exception as e:
-        print(f"[ERROR_LOG_GCS] Error: {e}")
+def _compact_error_logs_once():
+    """compact_error_logs を全プロセスのうち 1 つだけで実行する
+
+    Web プロセスと RQ ワーカーのすべてが保守スレッドを持つため、Redis があれば
+    ERROR_LOG_COMPACT_INTERVAL 秒有効なキーを SET NX で取れたプロセスだけが実行する
+    （間隔ごとに全体で 1 回）。Redis が無ければ同じホストのプロセス同士で
+    ロックファイルを取れたものだけが実行する。
+    """
+    if redis_conn is not None:
+        try:
+            owner = f"{socket.gethostname()}:{os.getpid()}"
+            ttl = max(60, int(ERROR_LOG_COMPACT_INTERVAL))
+            if not redis_conn.set('error_log:compaction', owner, nx=True, ex=ttl):
+                return 0
+            return compact_error_logs()
+        except _redis.RedisError as e:
+            print(f"[ERROR_LOG] Compaction lock unavailable, using local lock: {e}")
+    with try_file_lock(os.path.join('logs', 'error_log_compaction')) as locked:
+        return compact_error_logs() if locked else 0
+
+
+def _flush_error_log_samples(force=False):
+    for entry in error_log_sampler.drain(force=force):
+        _queue_error_entry(entry)
+
+
+def _start_error_log_maintenance():
+    """サンプリング窓の締めと日次ファイルへのまとめを定期的に行う"""
+    interval = max(1.0, min(ERROR_LOG_SAMPLE_WINDOW, 60.0))
+
+    def run():
+        last_compact = 0.0
+        while True:
+            time.sleep(interval)
+            try:
+                _flush_error_log_samples()
+                if ERROR_LOG_COMPACT_INTERVAL > 0 and time.monotonic() - last_compact >= ERROR_LOG_COMPACT_INTERVAL:
+                    last_compact = time.monotonic()
+                    _compact_error_logs_once()
+            except Exception as e:
+                print(f"[ERROR_LOG] Maintenance failed: {type(e).__name__}: {e}")
+
+    threading.Thread(target=run, name='error-log-maintenance', daemon=True).start()
+
+
+_start_error_log_maintenance()
+# 終了時は締めていないサンプリングのまとめを書いてからキューを止める（atexit は登録の逆順に実行）
+atexit.register(_flush_error_log_samples, True)
+
 
 def load_error_logs(date=None):
-    """エラーログを読み込み（GCS優先）"""
+    """エラーログを読み込み（GCS優先）
+
+    日次ファイル error_log_YYYYMMDD.json と追記セグメントの両方を読み、
+    まとめ処理の途中で重複したエントリは id で取り除く。
+    """
     if date is None:
         date = datetime.now().strftime('%Y%m%d')
     
-    # 本番環境: GCS優先
-    if USE_GCS and bucket:
-        try:
-            gcs_path = f"error_logs/error_log_{date}.json"
-            blob = bucket.blob(gcs_path)
-            
-            if blob.exists():
-                content = blob.download_as_string().decode('utf-8')
-                logs = json.loads(content)
-                print(f"[ERROR_LOAD] GCS - {gcs_path} loaded ({len(logs)} entries)")
-                return logs
-            else:
-                print(f"[ERROR_LOAD] GCS - {gcs_path} not found, trying local")
-        except Exception as e:
-            print(f"[ERROR_LOAD] GCS Error: {e}, trying local")
-    
-    # 開発環境またはGCS失敗時: ローカルから読み込み
-    error_log_file = f"logs/error_log_{date}.json"
-    if not os.path.exists(error_log_file):
-        return []
-    
-    try:
-        with open(error_log_file, 'r', encoding='utf-8') as f:
-            logs = json.load(f)
-            print(f"[ERROR_LOAD] Local - {error_log_file} loaded ({len(logs)} entries)")
-            return logs
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+    logs = dedupe_entries(error_log_store.load(date), 'id')
+    print(f"[ERROR_LOAD] loaded {len(logs)} entries from {date}")
+    return logs
 
 def perform_clustering_analysis(unit_logs, unit_name, class_num):
     """学生の対話をエンベディング＆クラスタリング分析
@@ -1432,14 +2337,12 @@ def perform_clustering_analysis(unit_logs, unit_name, class_num):
             
             print(f"[CLUSTERING] Getting embeddings for {len(student_ids)} students...")
             
-            # OpenAI Embedding API を使用
-            client = openai.OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-            embeddings_response = client.embeddings.create(
-                input=student_texts,
-                model="text-embedding-3-small"
-            )
+            # OpenAI Embedding API を使用（埋め込みサービス経由でキャッシュを共有）
+            vectors = embed_texts(student_texts, class_key=class_num)
+            if any(vector is None for vector in vectors):
+                raise RuntimeError("埋め込みの取得に失敗しました")
             
-            embeddings = np.array([e.embedding for e in embeddings_response.data])
+            embeddings = np.array(vectors)
             
             # クラスタ数を決定（学生数に基づいて、最大5クラスタ）
             n_clusters = min(max(2, len(student_ids) // 3), 5)
@@ -1594,10 +2497,11 @@ def select_unit():
     session['_session_id'] = session_id
     register_session(student_id, session_id)
     
-    # 各単元の進行状況をチェック
+    # 各単元の進行状況をチェック（進行状況ファイルの読み込みは 1 回だけ）
+    progress_snapshot = get_progress_snapshot(class_number, student_number)
     unit_progress = {}
     for unit in UNITS:
-        progress = get_student_progress(class_number, student_number, unit)
+        progress = progress_snapshot.unit(unit)
         needs_resumption = check_resumption_needed(class_number, student_number, unit)
         stage_progress = progress.get('stage_progress', {})
         
@@ -1636,9 +2540,7 @@ def prediction():
     current_unit = session.get('unit')
     if current_unit and current_unit != unit:
         print(f"[PREDICTION] 単元変更: {current_unit} → {unit}")
-        session.pop('conversation', None)
         session.pop('prediction_summary', None)
-        session.pop('reflection_conversation', None)
         session.pop('reflection_summary', None)
     
     session['class_number'] = class_number
@@ -1648,25 +2550,23 @@ def prediction():
     task_content = load_task_content(unit) if unit else ''
     session['task_content'] = task_content
     session['current_stage'] = 'reflection'
-    # 予想段階の対話履歴と混在しないように会話履歴もクリアしておく
-    session['conversation'] = []
     session.modified = True
     
-    task_content = load_task_content(unit)
-    session['task_content'] = task_content
-    
     # 進行状況をチェック
     progress = get_student_progress(class_number, student_number, unit)
     
     # 常に新規開始 - セッションを完全にリセット
     # (中断・リロード時に会話履歴は復元しない)
+    # セッション ID は会話履歴のキーと同時セッション管理に使うので引き継ぐ
+    session_id = session.get('_session_id')
     session.clear()
+    if session_id:
+        session['_session_id'] = session_id
     session['class_number'] = class_number
     session['student_number'] = student_number
     session['unit'] = unit
     session['task_content'] = task_content
     session['current_stage'] = 'prediction'
-    session['conversation'] = []
     session['prediction_summary'] = ''
     session['prediction_summary_created'] = False
     
@@ -1678,18 +2578,123 @@ def prediction():
     # 単元に応じた最初のAIメッセージを取得
     initial_ai_message = get_initial_ai_message(unit, stage='prediction')
     
-    # 初期メッセージを会話履歴に追加
-    conversation_history = session.get('conversation', [])
-    if not conversation_history:
-        # 新規セッション時のみ、初期メッセージを会話履歴に追加
-        conversation_history = [{'role': 'assistant', 'content': initial_ai_message}]
-        session['conversation'] = conversation_history
+    # 初期メッセージを会話履歴に追加（常に新規開始なので会話履歴はここで作り直す）
+    conversation_history = [{'role': 'assistant', 'content': initial_ai_message}]
+    set_conversation('conversation', conversation_history, unit)
     
     return render_template('prediction.html', unit=unit, task_content=task_content, 
                          prediction_summary_created=session.get('prediction_summary_created', False), 
                          initial_ai_message=initial_ai_message,
                          conversation_history=conversation_history)
 
+def _prediction_chat_messages(conversation, unit):
+    """予想段階の対話用に OpenAI へ送るメッセージを組み立てる"""
+    # 単元ごとのプロンプトを読み込み（stage指定で段階別プロンプト）
+    unit_prompt = load_unit_prompt(unit, stage='prediction')
+    
+    # 対話履歴を含めてプロンプト作成
+    # OpenAI APIに送信するためにメッセージ形式で構築
+    messages = [
+        {"role": "system", "content": unit_prompt}
+    ]
+    
+    # 対話履歴をメッセージフォーマットで追加
+    # 初期メッセージは既に conversation に含まれているので、そのまま追加
+    for msg in conversation:
+        messages.append({
+            "role": msg['role'],
+            "content": msg['content']
+        })
+    return messages
+
+def _reflection_chat_messages(reflection_conversation, unit, prediction_summary):
+    """考察段階の対話用に OpenAI へ送るメッセージを組み立てる"""
+    # プロンプトファイルからベースプロンプトを取得（考察段階用）
+    unit_prompt = load_unit_prompt(unit, stage='reflection')
+    
+    # 考察段階のシステムプロンプトを構築
+    reflection_system_prompt = f"""
+あなたは小学4年生の理科学習を支援するAIアシスタントです。現在、児童が実験後の「考察段階」に入っています。
+
+## 重要な役割
+児童は実験を終え、その結果と自分の予想を比較しながら、「なぜそうなったのか」，日常生活や既習事項との関連を自分の言葉で考える段階です。
+
+## あなたが守ること（絶対ルール）
+1. **子どもの発言を最優先する**
+   - 子どもの話した内容をそのまま受け止める
+   - 「〜なんだね」「〜だったんだね」と整理する
+   - 子どもの表現を活かす
+
+2. **自然で短い対話を心がける**
+   - 1往復ごとに1つの応答を返す
+   - 一度に3つ以上の質問をしない
+   - やさしく、短く、日常的な言葉を使う
+
+3. **無理に続けない**
+   - 児童が短い応答をした場合でも、それを受け止めて終わることもある
+   - 「もっと話して」と促し続けない
+   - 児童が充分に答えたと感じたら、その内容を認める
+   - 児童がまとめボタンを押すのを待つ
+
+4. **絶対にしてはいけないこと**
+   - ❌ 長文のまとめを途中で出さない（児童が「まとめボタン」を押すまで対話を続ける）
+   - ❌ 難しい専門用語を使わない
+   - ❌ 子どもの考えを否定しない
+   - ❌ 科学的な正確性よりも子どもの気づきを優先する
+   - ❌ 児童の応答が完璧でなくても、無理に続けさせる
+
+## 対話の進め方（ただしムリは禁物）
+1. 実験結果を聞く：「じっけんではどんなけっかになった？」
+2. 予想との簡単な確認：「さいしょの予そうと同じだった？」
+3. 子どもの考え・気づきを軽く引き出す：「それってなぜだと思う？」
+4. 児童の返答を受け止めて、必要に応じて次の質問へ
+5. 児童が「もう話す事がない」という雰囲気なら、そこで終了でOK
+
+## 単元の指導内容
+{unit_prompt}
+
+## 児童の予想
+{prediction_summary or '予想がまだ記録されていません。'}
+
+## 大事なこと
+- 子どもが何を考えたか、気づいたかを最優先に引き出す
+- 膜の変化（ふくらむ / 凹む）から体積の変化（大きくなる / 小さくなる）を自然に導く
+- 予想との比較は簡単な確認程度
+- **充分な対話ができたら、児童がまとめボタンを押すのを待つ（促し続けない）**
+"""
+    
+    # メッセージフォーマットで対話履歴を構築
+    messages = [
+        {"role": "system", "content": reflection_system_prompt}
+    ]
+    
+    # 対話履歴をメッセージフォーマットで追加
+    for msg in reflection_conversation:
+        messages.append({
+            "role": msg['role'],
+            "content": msg['content']
+        })
+    return messages
+
+def _record_chat_turn(stage, class_number, student_number, unit, conversation, user_message, ai_message):
+    """1 往復分の対話をセッション保存と学習ログに記録する"""
+    # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
+    student_id = f"{class_number}_{student_number}"
+    save_session_to_db(student_id, unit, stage, conversation)
+    
+    # 学習ログを保存
+    save_learning_log(
+        student_number=student_number,
+        unit=unit,
+        log_type=f'{stage}_chat',
+        data={
+            'user_message': user_message,
+            'ai_response': ai_message
+        },
+        class_number=class_number
+    )
+
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -1708,8 +2713,9 @@ def chat():
             return jsonify({'error': 'メッセージが指定されていません'}), 400
             
         input_metadata = request.json.get('metadata', {})
+        turn_id = request.json.get('turn_id')
         
-        conversation = session.get('conversation', [])
+        conversation = get_conversation('conversation')
         unit = session.get('unit')
         task_content = session.get('task_content')
         student_number = session.get('student_number')
@@ -1726,24 +2732,9 @@ def chat():
     # 対話履歴に追加
     conversation.append({'role': 'user', 'content': user_message})
     
-    # 単元ごとのプロンプトを読み込み（stage指定で段階別プロンプト）
-    unit_prompt = load_unit_prompt(unit, stage='prediction')
-    
-    # 対話履歴を含めてプロンプト作成
-    # OpenAI APIに送信するためにメッセージ形式で構築
-    messages = [
-        {"role": "system", "content": unit_prompt}
-    ]
-    
-    # 対話履歴をメッセージフォーマットで追加
-    # 初期メッセージは既に conversation に含まれているので、そのまま追加
-    for msg in conversation:
-        messages.append({
-            "role": msg['role'],
-            "content": msg['content']
-        })
+    messages = _prediction_chat_messages(conversation, unit)
     
-    try:
+    def compute_turn():
         ai_response = call_openai_with_retry(messages, unit=unit, stage='prediction', enable_cache=True)
         
         # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
@@ -1753,23 +2744,11 @@ def chat():
         # ai_message = remove_markdown_formatting(ai_message)
         
         conversation.append({'role': 'assistant', 'content': ai_message})
-        session['conversation'] = conversation
+        append_conversation('conversation', conversation[-2], conversation[-1])
         
-        # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
-        student_id = f"{session.get('class_number')}_{session.get('student_number')}"
-        save_session_to_db(student_id, unit, 'prediction', conversation)
-        
-        # 学習ログを保存
-        save_learning_log(
-            student_number=session.get('student_number'),
-            unit=unit,
-            log_type='prediction_chat',
-            data={
-                'user_message': user_message,
-                'ai_response': ai_message
-            },
-            class_number=session.get('class_number')
-        )
+        # セッションのDB保存と学習ログの保存
+        _record_chat_turn('prediction', session.get('class_number'), session.get('student_number'),
+                          unit, conversation, user_message, ai_message)
         
         # 対話が2回以上あれば、予想のまとめを作成可能
         # user + AI で最低2セット（2往復）= 4メッセージ以上必要
@@ -1777,12 +2756,15 @@ def chat():
         user_messages_count = sum(1 for msg in conversation if msg['role'] == 'user')
         suggest_summary = user_messages_count >= 2  # ユーザーメッセージが2回以上
         
-        response_data = {
+        print(f"[CHAT] AI response success, user_messages: {user_messages_count}")
+        return {
             'response': ai_message,
             'suggest_summary': suggest_summary
         }
-        
-        print(f"[CHAT] AI response success, user_messages: {user_messages_count}")
+    
+    try:
+        # 同じ turn_id の再送には保存済みの応答を返す（OpenAI 呼び出し・ログ保存は1回だけ）
+        response_data = run_chat_turn('prediction', turn_id, compute_turn)
         return jsonify(response_data)
         
     except Exception as e:
@@ -1828,7 +2810,7 @@ def report_error():
 @app.route('/summary', methods=['POST'])
 def summary():
     # セッションから安全に値を取得
-    conversation = session.get('conversation') or []
+    conversation = get_conversation('conversation')
     unit = session.get('unit')
 
     # 既存サマリーがあれば即返す（冪等）
@@ -1909,8 +2891,8 @@ def summary():
         # If FORCE_SYNC_SUMMARY is enabled, perform synchronous generation here
         if force_sync:
             try:
-                summary_response = call_openai_with_retry(messages, model_override="gpt-4o-mini", enable_cache=True, stage='prediction')
-                summary_text = extract_message_from_json_response(summary_response)
+                summary_text = generate_summary_text(messages, unit, 'prediction', normalized_conv,
+                                                     model_override="gpt-4o-mini", stage='prediction', class_key=class_number)
                 session['prediction_summary'] = summary_text
                 session['prediction_summary_created'] = True
                 session.modified = True
@@ -1930,14 +2912,12 @@ def summary():
             print(f"[SUMMARY] RQ queue not available, using synchronous processing")
             try:
                 print(f"[SUMMARY] Step 1: Calling OpenAI API...")
-                summary_response = call_openai_with_retry(messages, model_override="gpt-4o-mini", enable_cache=True, stage='prediction')
-                print(f"[SUMMARY] Step 2: Extracting message from response...")
-                summary_text = extract_message_from_json_response(summary_response)
+                summary_text = generate_summary_text(messages, unit, 'prediction', normalized_conv,
+                                                     model_override="gpt-4o-mini", stage='prediction', class_key=class_number)
+                print(f"[SUMMARY] Step 2: Summary text ready")
 
                 # OpenAI 側の代表的なエラーメッセージを検出したら 503 を返す（保存しない）
-                if isinstance(summary_text, str) and (
-                    'APIキー' in summary_text or 'API利用制限' in summary_text or 'ネットワーク接続' in summary_text or '予期しないエラー' in summary_text
-                ):
+                if _is_openai_error_text(summary_text):
                     print(f"[SUMMARY] OpenAI error-like response detected, not saving. text={summary_text[:60]}...")
                     return jsonify({'error': 'AI接続の混雑または通信エラーです。少し待ってもう一度押してください。'}), 503
                 print(f"[SUMMARY] Step 3: Saving to session... (length: {len(summary_text)})")
@@ -2015,6 +2995,43 @@ def job_status(job_id):
         print(f"[JOB_STATUS] Error fetching job {job_id}: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/job_wait/<job_id>', methods=['GET'])
+def job_wait(job_id):
+    """ジョブの完了を待って結果を返す（ロングポーリング）
+
+    完了通知が届くまで最大 JOB_WAIT_TIMEOUT 秒待つ。時間内に終わらなければ
+    {'status': 'pending'} を返すので、クライアントはすぐに待ち直す。
+    待機中のリクエストが多すぎるときは {'status': 'busy', 'retry_after': 秒} を返す。
+    """
+    if rq_queue is None:
+        return jsonify({'error': 'Job queue not available'}), 503
+    try:
+        timeout = min(float(request.args.get('timeout', JOB_WAIT_TIMEOUT)), JOB_WAIT_TIMEOUT)
+    except (TypeError, ValueError):
+        timeout = JOB_WAIT_TIMEOUT
+
+    try:
+        payload = job_notifier.wait(job_id, max(timeout, 0))
+    except WaiterLimitReached:
+        return jsonify({'status': 'busy', 'retry_after': 3})
+    except Exception as e:
+        print(f"[JOB_WAIT] Notifier error for {job_id}: {e}")
+        payload = None
+    if payload is not None:
+        return jsonify(payload)
+
+    # 通知が届かなかった（通知前に完了したジョブなど）ときは RQ の状態を1回だけ確認する
+    try:
+        job = _RQJob.fetch(job_id, connection=rq_queue.connection)
+    except Exception as e:
+        print(f"[JOB_WAIT] Error fetching job {job_id}: {e}")
+        return jsonify({'status': 'failed', 'error': 'ジョブが見つかりません'}), 404
+    if job.is_finished:
+        return jsonify({'status': 'finished', 'result': job.result})
+    if job.is_failed:
+        return jsonify({'status': 'failed', 'error': str(job.exc_info) if job.exc_info else 'Unknown error'})
+    return jsonify({'status': 'pending'})
+
 @app.route('/api/sync-session', methods=['POST'])
 def sync_session():
     """クライアント側のlocalStorageデータをサーバーに同期（GCS/ローカル保存）"""
@@ -2053,6 +3070,18 @@ def sync_session():
             'details': str(e)
         }), 500
 
+# サマリーのローカル保存先。student_id/unit/stage ごとに1ファイルで保存し、
+# 読み込みはメモリ上のインデックスから返す。
+# 旧形式（全サマリーを1つの JSON マップに保存）のファイル。起動時にシャードへ移行する。
+SUMMARY_STORAGE_FILE = os.environ.get('SUMMARY_STORAGE_FILE', 'summary_storage.json')
+SUMMARY_STORAGE_DIR = os.environ.get('SUMMARY_STORAGE_DIR', 'summary_storage')
+summary_repository = SummaryRepository(SUMMARY_STORAGE_DIR, lock_for=summary_file_locks.lock_for)
+
+try:
+    summary_repository.migrate_from_map(SUMMARY_STORAGE_FILE)
+except Exception as e:
+    print(f"[INIT] Summary storage migration failed: {e}")
+
 def _save_summary_to_db(student_id, unit, stage, summary_text):
     """サマリーを永続ストレージに保存（GCS優先、ローカルはフォールバック）"""
     # Firestore 優先
@@ -2088,34 +3117,10 @@ def _save_summary_to_db(student_id, unit, stage, summary_text):
         print(f"[SUMMARY_SAVE] Local failed: {e}")
 
 def _save_summary_local(student_id, unit, stage, summary_text):
-    """サマリーをローカルファイルに保存"""
+    """サマリーをローカルのリポジトリに保存（1件1ファイル、アトミックに置き換え）"""
     try:
-        summary_file = 'summary_storage.json'
-        
-        # 既存のファイルを読み込む
-        if os.path.exists(summary_file):
-            with open(summary_file, 'r', encoding='utf-8') as f:
-                summaries = json.load(f)
-        else:
-            summaries = {}
-        
-        # キーを作成
-        key = f"{student_id}_{unit}_{stage}"
-        
-        # 新しいサマリーを追加
-        summaries[key] = {
-            'summary': summary_text,
-            'saved_at': datetime.now().isoformat(),
-            'student_id': student_id,
-            'unit': unit,
-            'stage': stage
-        }
-        
-        # ファイルに保存
-        with open(summary_file, 'w', encoding='utf-8') as f:
-            json.dump(summaries, f, ensure_ascii=False, indent=2)
-        
-        print(f"[SUMMARY_SAVE_LOCAL] {key} saved to {summary_file}")
+        summary_repository.put(student_id, unit, stage, summary_text)
+        print(f"[SUMMARY_SAVE_LOCAL] {student_id}_{unit}_{stage} saved to {SUMMARY_STORAGE_DIR}")
     except Exception as e:
         print(f"[SUMMARY_SAVE_LOCAL] Error: {e}")
 
@@ -2194,22 +3199,11 @@ def _load_summary_from_db(student_id, unit, stage):
     return summary
 
 def _load_summary_local(student_id, unit, stage):
-    """サマリーをローカルファイルから取得"""
+    """サマリーをローカルのリポジトリから取得（メモリ上のインデックスを参照）"""
     try:
-        summary_file = 'summary_storage.json'
-        if not os.path.exists(summary_file):
-            return ''
-        
-        with open(summary_file, 'r', encoding='utf-8') as f:
-            summaries = json.load(f)
-        
-        key = f"{student_id}_{unit}_{stage}"
-        if key in summaries:
-            print(f"[SUMMARY_LOAD] Local - {key}")
-            return summaries[key].get('summary', '')
+        return summary_repository.get_summary(student_id, unit, stage)
     except Exception as e:
         print(f"[SUMMARY_LOAD] Local Error: {e}")
-    
     return ''
 
 def _load_summary_gcs(student_id, unit, stage):
@@ -2254,26 +3248,23 @@ def reflection():
     current_unit = session.get('unit')
     if current_unit and current_unit != unit:
         print(f"[REFLECTION] 単元変更: {current_unit} → {unit}")
-        session.pop('reflection_conversation', None)
         session.pop('reflection_summary', None)
-        session.pop('conversation', None)
         session.pop('prediction_summary', None)
     
     session['unit'] = unit
     
     # 常に新規開始 - セッションを完全にリセット
     # (中断・リロード時に会話履歴は復元しない)
-    session.pop('reflection_conversation', None)
     session.pop('reflection_summary', None)
     session.pop('reflection_summary_created', None)
-    session['reflection_conversation'] = []
+    set_conversation('reflection_conversation', [], unit)
 
     # 明示的にセッションの状態を初期化して、前の段階のプロンプトや会話が残らないようにする
     task_content = load_task_content(unit) if unit else ''
     session['task_content'] = task_content
     session['current_stage'] = 'reflection'
     # 予想段階の対話履歴と混在しないように会話履歴もクリアしておく
-    session['conversation'] = []
+    set_conversation('conversation', [], unit)
     session.modified = True
     
     # 予想まとめがセッションに存在しない場合はストレージから復元
@@ -2306,7 +3297,7 @@ def reflection():
     initial_ai_message = get_initial_ai_message(unit, stage='reflection')
     
     # セッションデータをテンプレートに明示的に渡す
-    reflection_conversation_history = session.get('reflection_conversation', [])
+    reflection_conversation_history = get_conversation('reflection_conversation', unit)
     
     return render_template('reflection.html', 
                          unit=unit,
@@ -2319,80 +3310,17 @@ def reflection():
 @app.route('/reflect_chat', methods=['POST'])
 def reflect_chat():
     user_message = request.json.get('message')
-    reflection_conversation = session.get('reflection_conversation', [])
+    turn_id = request.json.get('turn_id')
+    reflection_conversation = get_conversation('reflection_conversation')
     unit = session.get('unit')
     prediction_summary = session.get('prediction_summary', '')
     
     # 反省対話履歴に追加
     reflection_conversation.append({'role': 'user', 'content': user_message})
     
-    # プロンプトファイルからベースプロンプトを取得（考察段階用）
-    unit_prompt = load_unit_prompt(unit, stage='reflection')
-    
-    # 考察段階のシステムプロンプトを構築
-    reflection_system_prompt = f"""
-あなたは小学4年生の理科学習を支援するAIアシスタントです。現在、児童が実験後の「考察段階」に入っています。
-
-## 重要な役割
-児童は実験を終え、その結果と自分の予想を比較しながら、「なぜそうなったのか」，日常生活や既習事項との関連を自分の言葉で考える段階です。
-
-## あなたが守ること（絶対ルール）
-1. **子どもの発言を最優先する**
-   - 子どもの話した内容をそのまま受け止める
-   - 「〜なんだね」「〜だったんだね」と整理する
-   - 子どもの表現を活かす
-
-2. **自然で短い対話を心がける**
-   - 1往復ごとに1つの応答を返す
-   - 一度に3つ以上の質問をしない
-   - やさしく、短く、日常的な言葉を使う
-
-3. **無理に続けない**
-   - 児童が短い応答をした場合でも、それを受け止めて終わることもある
-   - 「もっと話して」と促し続けない
-   - 児童が充分に答えたと感じたら、その内容を認める
-   - 児童がまとめボタンを押すのを待つ
-
-4. **絶対にしてはいけないこと**
-   - ❌ 長文のまとめを途中で出さない（児童が「まとめボタン」を押すまで対話を続ける）
-   - ❌ 難しい専門用語を使わない
-   - ❌ 子どもの考えを否定しない
-   - ❌ 科学的な正確性よりも子どもの気づきを優先する
-   - ❌ 児童の応答が完璧でなくても、無理に続けさせる
-
-## 対話の進め方（ただしムリは禁物）
-1. 実験結果を聞く：「じっけんではどんなけっかになった？」
-2. 予想との簡単な確認：「さいしょの予そうと同じだった？」
-3. 子どもの考え・気づきを軽く引き出す：「それってなぜだと思う？」
-4. 児童の返答を受け止めて、必要に応じて次の質問へ
-5. 児童が「もう話す事がない」という雰囲気なら、そこで終了でOK
-
-## 単元の指導内容
-{unit_prompt}
-
-## 児童の予想
-{prediction_summary or '予想がまだ記録されていません。'}
-
-## 大事なこと
-- 子どもが何を考えたか、気づいたかを最優先に引き出す
-- 膜の変化（ふくらむ / 凹む）から体積の変化（大きくなる / 小さくなる）を自然に導く
-- 予想との比較は簡単な確認程度
-- **充分な対話ができたら、児童がまとめボタンを押すのを待つ（促し続けない）**
-"""
-    
-    # メッセージフォーマットで対話履歴を構築
-    messages = [
-        {"role": "system", "content": reflection_system_prompt}
-    ]
-    
-    # 対話履歴をメッセージフォーマットで追加
-    for msg in reflection_conversation:
-        messages.append({
-            "role": msg['role'],
-            "content": msg['content']
-        })
+    messages = _reflection_chat_messages(reflection_conversation, unit, prediction_summary)
     
-    try:
+    def compute_turn():
         ai_response = call_openai_with_retry(messages, unit=unit, stage='reflection', enable_cache=True)
         
         # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
@@ -2402,33 +3330,25 @@ def reflect_chat():
         # ai_message = remove_markdown_formatting(ai_message)
         
         reflection_conversation.append({'role': 'assistant', 'content': ai_message})
-        session['reflection_conversation'] = reflection_conversation
-        
-        # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
-        student_id = f"{session.get('class_number')}_{session.get('student_number')}"
-        save_session_to_db(student_id, unit, 'reflection', reflection_conversation)
+        append_conversation('reflection_conversation', reflection_conversation[-2], reflection_conversation[-1])
         
-        # 考察チャットのログを保存
-        save_learning_log(
-            student_number=session.get('student_number'),
-            unit=unit,
-            log_type='reflection_chat',
-            data={
-                'user_message': user_message,
-                'ai_response': ai_message
-            },
-            class_number=session.get('class_number')
-        )
+        # セッションのDB保存と考察チャットのログ保存
+        _record_chat_turn('reflection', session.get('class_number'), session.get('student_number'),
+                          unit, reflection_conversation, user_message, ai_message)
         
         # 対話が2往復以上あれば、考察のまとめを作成可能
         # ユーザーメッセージが2回以上必要
         user_messages_count = sum(1 for msg in reflection_conversation if msg['role'] == 'user')
         suggest_final_summary = user_messages_count >= 2
         
-        return jsonify({
+        return {
             'response': ai_message,
             'suggest_final_summary': suggest_final_summary
-        })
+        }
+    
+    try:
+        # 同じ turn_id の再送には保存済みの応答を返す（OpenAI 呼び出し・ログ保存は1回だけ）
+        return jsonify(run_chat_turn('reflection', turn_id, compute_turn))
         
     except Exception as e:
         import traceback
@@ -2436,9 +3356,128 @@ def reflect_chat():
         print(error_msg, file=sys.stderr)
         return jsonify({'error': f'AI接続エラーが発生しました。しばらく待ってから再度お試しください。\nDebug: {str(e)}'}), 500
 
+# ===== ストリーミング応答（Server-Sent Events） =====
+# SSE はレスポンスヘッダー（Cookie）を送った後に本文を生成するが、会話履歴は
+# サーバー側（conversation_store）にあるため、生成完了時にそのまま追記できる。
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _stream_chat_turn(stage, messages, conversation, user_message, turn_id=None):
+    """OpenAI の差分を SSE で中継し、完了後に保存とログ記録を 1 回だけ行う
+
+    完了済みの turn_id で再送された場合は、保存済みの応答を done イベントだけで返す。
+    同じ turn_id の要求が実行中なら、モデルは呼ばずにその完了を待って同じ応答を返す。
+    ストリームの途中で切断されても、残りの応答を受け取って保存とログ記録は行う。
+    """
+    unit = session.get('unit')
+    class_number = session.get('class_number')
+    student_number = session.get('student_number')
+    sid = _conversation_sid()
+    conversation_name = 'conversation' if stage == 'prediction' else 'reflection_conversation'
+    suggest_key = 'suggest_summary' if stage == 'prediction' else 'suggest_final_summary'
+    turn_key = _chat_turn_key(stage, turn_id)
+
+    def generate():
+        claim = None
+        if turn_key:
+            replay = chat_turn_cache.get(turn_key)
+            if replay is None:
+                # 生成の権利は本文の中で取る（送信前に切断されても取りっぱなしにならない）
+                claim = chat_turn_cache.begin(turn_key)
+                if claim is None:
+                    replay = chat_turn_cache.wait(turn_key, CHAT_TURN_WAIT_TIMEOUT)
+                    if replay is None:
+                        yield _sse_event('error', {'error': '同じ発言を処理中です。しばらく待ってから再度お試しください。',
+                                                   'status': 'in_progress'})
+                        return
+            if replay is not None:
+                yield _sse_event('done', replay)
+                return
+
+        result = None
+        disconnected = False
+        try:
+            parts = []
+            try:
+                stream = stream_openai_with_retry(messages, unit=unit, stage=stage, enable_cache=True,
+                                                  class_key=class_number)
+                for delta in stream:
+                    parts.append(delta)
+                    try:
+                        yield _sse_event('delta', {'text': delta})
+                    except GeneratorExit:
+                        # 途中で切断された（close() が呼ばれた）。応答は課金済みなので、
+                        # 残りを受け取って会話・ログに保存してから終了する
+                        disconnected = True
+                        break
+                if disconnected:
+                    print(f"[STREAM] {stage} client disconnected, finishing the turn without streaming")
+                    parts.extend(stream)
+            except Exception as e:
+                print(f"[STREAM] {stage} stream error: {type(e).__name__}: {e}")
+                if not disconnected:
+                    yield _sse_event('error', {'error': 'AI接続エラーが発生しました。しばらく待ってから再度お試しください。'})
+                return
+
+            ai_message = extract_message_from_json_response(''.join(parts))
+            full_conversation = conversation + [{'role': 'assistant', 'content': ai_message}]
+            append_conversation(conversation_name, {'role': 'user', 'content': user_message},
+                                {'role': 'assistant', 'content': ai_message}, unit=unit, sid=sid)
+            _record_chat_turn(stage, class_number, student_number, unit, full_conversation, user_message, ai_message)
+
+            user_messages_count = sum(1 for msg in full_conversation if msg['role'] == 'user')
+            result = {'response': ai_message, suggest_key: user_messages_count >= 2}
+        finally:
+            # done を送る前に保存しておき、受信前に切断されても再送で同じ応答を返せるようにする
+            if claim is not None:
+                chat_turn_cache.finish(claim, result)
+        if disconnected:
+            # 切断後は何も送れない（close() には return で応える）
+            return
+        yield _sse_event('done', result)
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """予想段階の対話（ストリーミング版）"""
+    if not STREAMING_CHAT_ENABLED:
+        return jsonify({'error': 'streaming disabled'}), 404
+    data = request.get_json(silent=True) or {}
+    user_message = data.get('message')
+    if not user_message:
+        return jsonify({'error': 'メッセージが指定されていません'}), 400
+
+    conversation = get_conversation('conversation') + [{'role': 'user', 'content': user_message}]
+    messages = _prediction_chat_messages(conversation, session.get('unit'))
+    return _stream_chat_turn('prediction', messages, conversation, user_message, turn_id=data.get('turn_id'))
+
+
+@app.route('/reflect_chat/stream', methods=['POST'])
+def reflect_chat_stream():
+    """考察段階の対話（ストリーミング版）"""
+    if not STREAMING_CHAT_ENABLED:
+        return jsonify({'error': 'streaming disabled'}), 404
+    data = request.get_json(silent=True) or {}
+    user_message = data.get('message')
+    if not user_message:
+        return jsonify({'error': 'メッセージが指定されていません'}), 400
+
+    reflection_conversation = get_conversation('reflection_conversation') + [{'role': 'user', 'content': user_message}]
+    messages = _reflection_chat_messages(reflection_conversation, session.get('unit'), session.get('prediction_summary', ''))
+    return _stream_chat_turn('reflection', messages, reflection_conversation, user_message, turn_id=data.get('turn_id'))
+
 @app.route('/final_summary', methods=['POST'])
 def final_summary():
-    reflection_conversation = session.get('reflection_conversation', [])
+    reflection_conversation = get_conversation('reflection_conversation')
     prediction_summary = session.get('prediction_summary', '')
     unit = session.get('unit')
     
@@ -2468,83 +3507,48 @@ def final_summary():
                 'is_insufficient': True
             }), 400
     
-    # 単元のプロンプトを読み込み（考察段階用）
-    unit_prompt = load_unit_prompt(unit, stage='reflection')
-    
-    # メッセージフォーマットで構築
-    messages = [
-        {"role": "system", "content": unit_prompt + "\n\n【重要】以下の会話内容のみをもとに、児童の話した言葉や考えを活かして、考察をまとめてください。会話に含まれていない内容は追加しないでください。"}
-    ]
-    
-    # 対話履歴をメッセージフォーマットで追加
-    for msg in reflection_conversation:
-        messages.append({
-            "role": msg['role'],
-            "content": msg['content']
-        })
-    
-    # 最後に考察作成を促すメッセージを追加
-    messages.append({
-        "role": "user",
-        "content": "児童が「考察をまとめる」ボタンを押しました。これまでの対話内容から、児童自身の言葉や気づきを活かして考察をまとめてください。"
-    })
-    
-    try:
-        final_summary_response = call_openai_with_retry(messages, model_override="gpt-4o-mini", enable_cache=True)
-        
-        # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
-        final_summary_text = extract_message_from_json_response(final_summary_response)
-        
-        # 要約段階ではマークダウン除去をスキップ（MDファイルのプロンプトに従う）
-        # final_summary_text = remove_markdown_formatting(final_summary_text)
-        
+    class_number = session.get('class_number')
+    student_number = session.get('student_number')
+    student_id = f"{class_number}_{student_number}"
+    force_sync = os.environ.get('FORCE_SYNC_SUMMARY', 'false').lower() in ('1', 'true', 'yes')
+
+    if rq_queue is None or force_sync:
+        # RQ が無い場合は同期で生成する
+        try:
+            final_summary_text = perform_final_summary_job(reflection_conversation, prediction_summary, unit, class_number, student_number)
+        except Exception as e:
+            print(f"【ERROR】/final_summary エラー: {str(e)}")
+            return jsonify({'error': f'最終まとめ生成中にエラーが発生しました: {str(e)}'}), 500
         # セッションに保存（フロントの復元用）
         session['reflection_summary'] = final_summary_text
         session['reflection_summary_created'] = True
         session.modified = True
-        
-        # 考察完了フラグを設定
-        update_student_progress(
-            class_number=session.get('class_number'),
-            student_number=session.get('student_number'),
-            unit=session.get('unit'),
-            reflection_summary_created=True
-        )
-        
-        # 永続ストレージに保存（ローカル/GCS）
-        student_id = f"{session.get('class_number')}_{session.get('student_number')}"
-        _save_summary_to_db(student_id, unit, 'reflection', final_summary_text)
-        
-        # 最終考察のログを保存
-        save_learning_log(
-            student_number=session.get('student_number'),
-            unit=session.get('unit'),
-            log_type='final_summary',
-            data={
-                'final_summary': final_summary_text,
-                'prediction_summary': prediction_summary,
-                'reflection_conversation': reflection_conversation
-            },
-            class_number=session.get('class_number')
-        )
-        
         return jsonify({'summary': final_summary_text})
+
+    # 同じ会話に対するジョブが待機中・実行中ならそれを返し、完了済みなら結果をそのまま返す
+    # （二重クリックや複数タブから押された場合に OpenAI 呼び出しと保存を重複させない）
+    job_id = _final_summary_job_id(student_id, unit, reflection_conversation)
+    try:
+        job = _RQJob.fetch(job_id, connection=rq_queue.connection)
+        status = job.get_status()
+        if status == 'finished' and job.result:
+            print(f"[FINAL_SUMMARY] Reusing finished job {job_id} for {student_id}_{unit}")
+            return jsonify({'summary': job.result})
+        if status in ('queued', 'started', 'deferred', 'scheduled'):
+            print(f"[FINAL_SUMMARY] Job already in progress: {job_id} for {student_id}_{unit}")
+            return jsonify({'job_id': job_id, 'status': status})
+    except Exception:
+        pass
+
+    try:
+        rq_queue.enqueue(perform_final_summary_job,
+                         args=(reflection_conversation, prediction_summary, unit, class_number, student_number),
+                         job_id=job_id, job_timeout=600)
     except Exception as e:
-        import traceback
-        error_detail = traceback.format_exc()
-        print(f"【ERROR】/final_summary エラー: {str(e)}")
-        print(error_detail)
-        save_learning_log(
-            student_number=session.get('student_number'),
-            unit=session.get('unit'),
-            log_type='final_summary_error',
-            data={
-                'error': str(e),
-                'traceback': error_detail
-            },
-            class_number=session.get('class_number')
-        )
+        print(f"【ERROR】/final_summary enqueue エラー: {str(e)}")
         return jsonify({'error': f'最終まとめ生成中にエラーが発生しました: {str(e)}'}), 500
+    print(f"[FINAL_SUMMARY] Enqueued job: {job_id} for {student_id}_{unit}")
+    return jsonify({'job_id': job_id, 'status': 'queued'})
 
 @app.route('/get_prediction_summary', methods=['GET'])
 def get_prediction_summary():
@@ -2646,26 +3650,14 @@ def teacher_logs():
             class_filter_int = None
     student = request.args.get('student', '')
     
-    logs = load_learning_logs(date)
-    
-    # フィルタリング
-    if unit:
-        logs = [log for log in logs if log.get('unit') == unit]
-    
-    # クラスと出席番号でフィルター（両方を組み合わせる）
-    if class_filter_int is not None and student:
-        # クラスと出席番号の両方が指定された場合
-        logs = [log for log in logs 
-                if log.get('class_num') == class_filter_int 
-                and log.get('seat_num') == int(student)]
-    elif class_filter_int is not None:
-        # クラスのみ指定された場合
-        logs = [log for log in logs 
-                if log.get('class_num') == class_filter_int]
-    elif student:
-        # 出席番号のみ指定された場合（全クラスから該当番号を検索）
-        logs = [log for log in logs 
-                if log.get('seat_num') == int(student)]
+    # 単元・クラス・出席番号で絞り込んだパーティションだけを読み込む
+    # （出席番号のみ指定された場合は全クラスから該当番号を検索）
+    logs = query_learning_logs(
+        date,
+        unit=unit or None,
+        class_num=class_filter_int,
+        seat_num=int(student) if student else None,
+    )
     
     # 児童ごとにグループ化（クラスと出席番号の組み合わせで識別）
     students_data = {}
@@ -2731,130 +3723,81 @@ def teacher_logs():
 @app.route('/teacher/export')
 @require_teacher_auth
 def teacher_export():
-    """ログをCSVでエクスポート - ダウンロード日までのすべてのログ"""
-    from io import StringIO, BytesIO
-    import csv
+    """ログをCSVでエクスポート - ダウンロード日までのすべてのログ
+
+    日付ごとに読み込み・絞り込みを行い、行単位でエンコードしてストリーミングで返す
+    （全件をメモリに溜めないため、長期間のエクスポートでもメモリ使用量は一定）。
+    """
+    from io import StringIO
     
     download_date_str = request.args.get('date', datetime.now().strftime('%Y%m%d'))
-    
-    # ダウンロード日までのすべてのログを取得
-    all_logs = []
-    available_dates = get_available_log_dates()
+    # フロントのフィルタ（現在の表示）に合わせて絞り込み可能にする
+    filters = _export_filters(request.args)
     
     print(f"[EXPORT] START - exporting logs up to date: {download_date_str}")
-    print(f"[EXPORT] Available dates: {available_dates}")
     
-    for date_str in available_dates:
-        # date_str は文字列 (YYYYMMDD format)
-        current_date_raw = date_str if isinstance(date_str, str) else date_str.get('raw', '')
-        # ダウンロード日以下の日付のみを対象
-        if current_date_raw <= download_date_str:
-            try:
-                logs = load_learning_logs(current_date_raw)
-                all_logs.extend(logs)
-                print(f"[EXPORT] Loaded {len(logs)} logs from {current_date_raw}")
-            except Exception as e:
-                print(f"[EXPORT] ERROR loading logs from {current_date_raw}: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                continue
-
-    # フロントのフィルタ（現在の表示）に合わせて絞り込み可能にする
-    unit_filter = request.args.get('unit', '')
-    class_filter = request.args.get('class', '')
-    student_filter = request.args.get('student', '')
+    fieldnames = ['timestamp', 'class_display', 'student_number', 'unit', 'log_type', 'content']
 
-    def matches_filters(log):
-        if unit_filter and log.get('unit') != unit_filter:
-            return False
-        if class_filter:
-            try:
-                cf_int = normalize_class_value_int(class_filter)
-                if cf_int is not None and log.get('class_num') != cf_int:
-                    return False
-            except Exception:
-                pass
-        if student_filter:
-            try:
-                if int(student_filter) != int(log.get('seat_num') or -1):
-                    return False
-            except Exception:
-                if str(student_filter) != str(log.get('student_number')):
-                    return False
-        return True
+    def generate():
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+
+        def take():
+            # 書き込まれた分だけを取り出してバッファを空にする
+            data = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            return data.encode('utf-8')
+
+        # UTF-8 BOM を先頭に付ける（Excel での文字化け防止）
+        writer.writeheader()
+        yield '\ufeff'.encode('utf-8') + take()
+
+        total = 0
+        for _, logs in _iter_export_logs(download_date_str, filters, 'EXPORT'):
+            for log in logs:
+                writer.writerow({
+                    'timestamp': log.get('timestamp', ''),
+                    'class_display': log.get('class_display', ''),
+                    'student_number': log.get('student_number', ''),
+                    'unit': log.get('unit', ''),
+                    'log_type': log.get('log_type', ''),
+                    'content': _export_log_content(log)
+                })
+            total += len(logs)
+            # 1 日分ずつまとめて送る
+            chunk = take()
+            if chunk:
+                yield chunk
 
-    filtered_logs = [log for log in all_logs if matches_filters(log)]
-    
-    # CSVをメモリに作成（UTF-8 BOM付き）
-    output = StringIO()
-    fieldnames = ['timestamp', 'class_display', 'student_number', 'unit', 'log_type', 'content']
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    
-    for log in filtered_logs:
-        content = ""
-        if log.get('log_type') == 'prediction_chat':
-            content = f"Q: {log['data'].get('user_message', '')}\nA: {log['data'].get('ai_response', '')}"
-        elif log.get('log_type') == 'prediction_summary':
-            content = log['data'].get('summary', '')
-        elif log.get('log_type') == 'reflection_chat':
-            content = f"Q: {log['data'].get('user_message', '')}\nA: {log['data'].get('ai_response', '')}"
-        elif log.get('log_type') == 'final_summary':
-            content = log['data'].get('final_summary', '')
-        
-        writer.writerow({
-            'timestamp': log.get('timestamp', ''),
-            'class_display': log.get('class_display', ''),
-            'student_number': log.get('student_number', ''),
-            'unit': log.get('unit', ''),
-            'log_type': log.get('log_type', ''),
-            'content': content
-        })
-    
-    # StringIOをUTF-8 BOM付きバイナリにエンコード
-    csv_string = output.getvalue()
-    csv_bytes = '\ufeff'.encode('utf-8') + csv_string.encode('utf-8')  # UTF-8 BOM追加
+        print(f"[EXPORT] SUCCESS - exported {total} total logs")
     
     filename = f"all_learning_logs_up_to_{download_date_str}.csv"
     
-    print(f"[EXPORT] SUCCESS - exported {len(filtered_logs)} total logs, size: {len(csv_bytes)} bytes")
-    
     return Response(
-        csv_bytes,
+        generate(),
         mimetype="text/csv; charset=utf-8",
         headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
     )
 
-@app.route('/teacher/export_json')
-@require_teacher_auth
-def teacher_export_json():
-    """対話内容をJSONでエクスポート - 単元ごとのディレクトリ構造でzip出力"""
-    from io import BytesIO
-    
-    download_date_str = request.args.get('date', datetime.now().strftime('%Y%m%d'))
-    
-    # ダウンロード日までのすべてのログを取得
-    all_logs = []
-    available_dates = get_available_log_dates()
-    
-    print(f"[EXPORT_JSON] START - exporting logs up to date: {download_date_str}")
-    
-    for date_str in available_dates:
-        # date_str は文字列 (YYYYMMDD format)
-        current_date_raw = date_str if isinstance(date_str, str) else date_str.get('raw', '')
-        if current_date_raw <= download_date_str:
-            try:
-                logs = load_learning_logs(current_date_raw)
-                all_logs.extend(logs)
-                print(f"[EXPORT_JSON] Loaded {len(logs)} logs from {current_date_raw}")
-            except Exception as e:
-                print(f"[EXPORT_JSON] ERROR loading logs from {current_date_raw}: {str(e)}")
-                continue
 
-    # フィルタリング（テンプレートの現在の表示に合わせる）
-    unit_filter = request.args.get('unit', '')
-    class_filter = request.args.get('class', '')
-    student_filter = request.args.get('student', '')
+def _export_filters(args):
+    """エクスポートの絞り込み条件（単元・クラス・出席番号）をクエリから取り出す"""
+    return {
+        'unit': args.get('unit', ''),
+        'class': args.get('class', ''),
+        'student': args.get('student', ''),
+    }
+
+
+def _iter_export_logs(download_date_str, filters, tag):
+    """ダウンロード日までの各日付について (日付, 絞り込み済みログ) を 1 日ずつ yield する
+
+    日付の順序は get_available_log_dates() と同じ（新しい順）。
+    """
+    unit_filter = filters['unit']
+    class_filter = filters['class']
+    student_filter = filters['student']
 
     def matches_filters(log):
         if unit_filter and log.get('unit') != unit_filter:
@@ -2875,54 +3818,152 @@ def teacher_export_json():
                     return False
         return True
 
-    filtered_logs = [log for log in all_logs if matches_filters(log)]
-    
-    # 児童ごと・単元ごとにグループ化
-    # 構造: {unit: {student_id: [logs]}}
-    structured_logs = {}
-    
-    for log in filtered_logs:
-        unit = log.get('unit', 'unknown')
-        student_id = log.get('student_number', 'unknown')
-        
-        if unit not in structured_logs:
-            structured_logs[unit] = {}
-        if student_id not in structured_logs[unit]:
-            structured_logs[unit][student_id] = []
-        
-        structured_logs[unit][student_id].append(log)
-    
-    # Zipファイルをメモリに作成
-    zip_buffer = BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for unit in sorted(structured_logs.keys()):
-            for student_id in sorted(structured_logs[unit].keys()):
-                logs_for_student = structured_logs[unit][student_id]
-                
-                # JSON データの作成
-                json_data = {
-                    'unit': unit,
-                    'student_id': student_id,
-                    'class_display': logs_for_student[0].get('class_display', '') if logs_for_student else '',
-                    'export_date': datetime.now().isoformat(),
-                    'logs': logs_for_student
-                }
-                
-                # ファイルパス: talk/{unit}/student_{student_id}.json
-                file_path = f"talk/{unit}/student_{student_id}.json"
-                
-                # JSONファイルをzipに追加
-                json_string = json.dumps(json_data, ensure_ascii=False, indent=2)
-                zip_file.writestr(file_path, json_string.encode('utf-8'))
+    index_filters = {
+        'unit': unit_filter or None,
+        'class_num': normalize_class_value_int(class_filter) if class_filter else None,
+        'seat_num': int(student_filter) if str(student_filter).isdigit() else None,
+    }
+
+    for date_str in get_available_log_dates():
+        # date_str は文字列 (YYYYMMDD format)
+        current_date_raw = date_str if isinstance(date_str, str) else date_str.get('raw', '')
+        # ダウンロード日以下の日付のみを対象
+        if current_date_raw > download_date_str:
+            continue
+        try:
+            # 索引で該当パーティションだけを読み、残りの条件は matches_filters で確認する
+            logs = [log for log in query_learning_logs(current_date_raw, **index_filters) if matches_filters(log)]
+            print(f"[{tag}] Loaded {len(logs)} logs from {current_date_raw}")
+        except Exception as e:
+            print(f"[{tag}] ERROR loading logs from {current_date_raw}: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            continue
+        yield current_date_raw, logs
+
+
+def _export_log_content(log):
+    """CSV の content 列（対話は Q/A 形式、まとめは本文）"""
+    data = log.get('data') or {}
+    if log.get('log_type') in ('prediction_chat', 'reflection_chat'):
+        return f"Q: {data.get('user_message', '')}\nA: {data.get('ai_response', '')}"
+    if log.get('log_type') == 'prediction_summary':
+        return data.get('summary', '')
+    if log.get('log_type') == 'final_summary':
+        return data.get('final_summary', '')
+    return ""
+
+class _ZipStreamSink:
+    """zipfile の書き込み先（シーク不可のストリーム）
+
+    zipfile はシークできない出力に対してデータディスクリプタ付きで書き込むため、
+    書かれたバイト列を溜めておき、レスポンスの generator から順に取り出す。
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _write_export_member(member, unit, student_id, spool_path):
+    """スプールしたログから talk/{unit}/student_{id}.json の中身を書き出す
+
+    出力は json.dumps(..., ensure_ascii=False, indent=2) と同じ形式で、
+    ログは 1 件ずつ書き込むため児童 1 人分を丸ごとメモリに載せない。
+    """
+    with open(spool_path, 'r', encoding='utf-8') as spool:
+        first_line = spool.readline()
+        first_log = json.loads(first_line)
+        head = json.dumps({
+            'unit': unit,
+            'student_id': student_id,
+            'class_display': first_log.get('class_display', ''),
+            'export_date': datetime.now().isoformat(),
+        }, ensure_ascii=False, indent=2)
+        member.write((head[:-2] + ',\n  "logs": [\n').encode('utf-8'))
+        separator = ''
+        for line in itertools.chain([first_line], spool):
+            piece = textwrap.indent(json.dumps(json.loads(line), ensure_ascii=False, indent=2), '    ')
+            member.write((separator + piece).encode('utf-8'))
+            separator = ',\n'
+        member.write('\n  ]\n}'.encode('utf-8'))
+
+
+@app.route('/teacher/export_json')
+@require_teacher_auth
+def teacher_export_json():
+    """対話内容をJSONでエクスポート - 単元ごとのディレクトリ構造でzip出力
+
+    日付ごとに読み込んだログを児童ごとの一時ファイルに振り分け、その後
+    talk/{unit}/student_{id}.json を 1 件ずつ zip に書き込んでストリーミングで返す
+    （アーカイブ全体をメモリに作らない）。振り分け中は zip 先頭の export_info.txt に
+    日付ごとの件数を書きながら送るので、最初のバイトは振り分けの完了を待たない。
+    """
+    download_date_str = request.args.get('date', datetime.now().strftime('%Y%m%d'))
+    # フィルタリング（テンプレートの現在の表示に合わせる）
+    filters = _export_filters(request.args)
     
-    zip_buffer.seek(0)
+    print(f"[EXPORT_JSON] START - exporting logs up to date: {download_date_str}")
+
+    def generate():
+        total = 0
+        sink = _ZipStreamSink()
+        with tempfile.TemporaryDirectory(prefix='export_json_') as spool_dir:
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                # 全日付の振り分けが終わるまで児童ごとのファイルは書けないため、先に
+                # 無圧縮の export_info.txt を開いて 1 日分読むごとに 1 行書き出し、
+                # 最初のバイトをすぐ返して振り分け中も応答を途切れさせない
+                info = zipfile.ZipInfo('export_info.txt', date_time=datetime.now().timetuple()[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                # 児童ごと・単元ごとに振り分け
+                # 構造: {(unit, student_id): スプールファイル}
+                spools = {}
+                with zip_file.open(info, 'w') as progress:
+                    conditions = ', '.join(f"{k}={v}" for k, v in filters.items() if v) or 'なし'
+                    progress.write(f"対象: {download_date_str} までのログ（絞り込み: {conditions}）\n".encode('utf-8'))
+                    yield sink.take()
+                    for date_str, logs in _iter_export_logs(download_date_str, filters, 'EXPORT_JSON'):
+                        by_member = {}
+                        for log in logs:
+                            key = (log.get('unit', 'unknown'), log.get('student_number', 'unknown'))
+                            by_member.setdefault(key, []).append(log)
+                        for key, member_logs in by_member.items():
+                            if key not in spools:
+                                spools[key] = os.path.join(spool_dir, f"{len(spools)}.jsonl")
+                            with open(spools[key], 'a', encoding='utf-8') as spool:
+                                for log in member_logs:
+                                    spool.write(json.dumps(log, ensure_ascii=False) + '\n')
+                        total += len(logs)
+                        progress.write(f"{date_str}: {len(logs)} 件\n".encode('utf-8'))
+                        yield sink.take()
+                    progress.write(f"合計: {total} 件\n".encode('utf-8'))
+
+                for unit, student_id in sorted(spools):
+                    # ファイルパス: talk/{unit}/student_{student_id}.json
+                    file_path = f"talk/{unit}/student_{student_id}.json"
+                    with zip_file.open(file_path, 'w') as member:
+                        _write_export_member(member, unit, student_id, spools[(unit, student_id)])
+                    yield sink.take()
+            # セントラルディレクトリ
+            yield sink.take()
+
+        print(f"[EXPORT_JSON] SUCCESS - exported JSON with {total} total logs")
+
     filename = f"dialogue_logs_up_to_{download_date_str}.zip"
     
-    print(f"[EXPORT_JSON] SUCCESS - exported JSON with {len(filtered_logs)} total logs")
-    
     return Response(
-        zip_buffer.getvalue(),
+        generate(),
         mimetype="application/zip",
         headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
     )
@@ -3013,8 +4054,7 @@ def api_students_by_class():
     # learning_progress.jsonから児童情報を取得
     if os.path.exists(LEARNING_PROGRESS_FILE):
         try:
-            with open(LEARNING_PROGRESS_FILE, 'r', encoding='utf-8') as f:
-                progress_data = json.load(f)
+            progress_data = _cached_learning_progress()
             
             for class_num in ['1', '2', '3', '4', '5', '6']:
                 students_by_class[class_num] = []
@@ -3041,30 +4081,147 @@ def analysis_dashboard():
     return render_template('teacher/analysis_dashboard.html', units=UNITS)
 
 
+# 分析結果の事前集計（materialization）
+# /teacher/analysis は保存済みの結果をすぐに返し、集計は RQ ジョブ（Redis が無い場合は同期）で行う。
+# 結果は (日付, 単元, クラス) ごとに analysis_storage/ に 1 ファイルずつ保存する。
+ANALYSIS_STORAGE_DIR = os.environ.get('ANALYSIS_STORAGE_DIR', 'analysis_storage')
+analysis_store = ShardedJsonStore(ANALYSIS_STORAGE_DIR)
+ANALYSIS_ALL = '_all'
+
+
+def _analysis_parts(date, unit, class_number):
+    return [date, unit or ANALYSIS_ALL, normalize_class_value(class_number) or ANALYSIS_ALL]
+
+
+def _analysis_job_id(date, unit, class_number):
+    digest = hashlib.sha1('|'.join(_analysis_parts(date, unit, class_number)).encode('utf-8')).hexdigest()[:16]
+    return f"analysis-{digest}"
+
+
+def _filter_analysis_logs(logs, unit, class_number):
+    if unit:
+        logs = [log for log in logs if log.get('unit') == unit]
+    class_int = normalize_class_value_int(class_number)
+    if class_int is not None:
+        logs = [log for log in logs if log.get('class_num') == class_int]
+    return logs
+
+
+def _logs_fingerprint(date):
+    """その日の学習ログの指紋（セグメントの保存先・名前・サイズから作る）
+
+    learning_log_store.segments() と同じく GCS を優先して一覧するため、
+    どのインスタンスが応答しても同じ値になる。追記があれば変わる。
+    """
+    source, segments = learning_log_store.segments(date)
+    material = json.dumps([source, [[index, name, size] for index, name, size in segments]], ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def _analysis_errors(analysis):
+    """分析結果に含まれるエラー（OpenAI・埋め込みの一時的な失敗など）を列挙する"""
+    if 'error' in analysis:
+        return [analysis['error']]
+    errors = []
+    for unit, result in analysis.get('embeddings_analysis', {}).items():
+        if isinstance(result, dict) and result.get('error'):
+            errors.append(f"{unit}: {result['error']}")
+    for unit, stages in analysis.get('text_analysis', {}).items():
+        for stage, result in (stages or {}).items():
+            if isinstance(result, dict) and result.get('error'):
+                errors.append(f"{unit}/{stage}: {result['error']}")
+    return errors
+
+
+def perform_analysis_job(date, unit='', class_number=None):
+    """Background job: analyse one (date, unit, class) slice of the learning logs
+    and store the result in analysis_store. Importable by RQ workers.
+
+    A result with errors (e.g. a failed embedding batch) is not stored; the job
+    raises instead, so RQ marks it failed and the previous result, if any, stays.
+    """
+    try:
+        # 読み込む前に取るので、読み込み中の追記は「集計後に新しいログがある」側に数える
+        fingerprint = _logs_fingerprint(date)
+        logs = _filter_analysis_logs(load_learning_logs(date), unit, class_number)
+        analysis = analyze_predictions_and_reflections(logs)
+        errors = _analysis_errors(analysis)
+        if errors:
+            raise RuntimeError(f"Analysis of {date}/{unit or ANALYSIS_ALL} failed: {'; '.join(errors)}")
+    except Exception as e:
+        print(f"[ANALYSIS] Error: {e}")
+        _notify_job_done({'status': 'failed', 'error': str(e)})
+        raise
+    record = {
+        'date': date,
+        'unit': unit or '',
+        'class': normalize_class_value(class_number) or '',
+        'computed_at': datetime.now().isoformat(),
+        'log_count': len(logs),
+        'logs_fingerprint': fingerprint,
+        'analysis': analysis,
+    }
+    analysis_store.put(_analysis_parts(date, unit, class_number), record)
+    print(f"[ANALYSIS] Materialized {date}/{unit or ANALYSIS_ALL}/{record['class'] or ANALYSIS_ALL} ({len(logs)} logs)")
+    result = {'computed_at': record['computed_at'], 'log_count': record['log_count']}
+    # /job_wait で待っている分析画面を起こす
+    _notify_job_done({'status': 'finished', 'result': result})
+    return result
+
+
+def _schedule_analysis(date, unit, class_number):
+    """集計ジョブを投入する。同じ対象のジョブが待機中・実行中ならそれを返す。
+
+    Returns:
+        job_id（RQ が使えない場合は同期で集計して None）
+    """
+    if rq_queue is None:
+        perform_analysis_job(date, unit, class_number)
+        return None
+    job_id = _analysis_job_id(date, unit, class_number)
+    try:
+        job = _RQJob.fetch(job_id, connection=rq_queue.connection)
+        if job.get_status() in ('queued', 'started', 'deferred', 'scheduled'):
+            return job_id
+    except Exception:
+        pass
+    rq_queue.enqueue(perform_analysis_job, date, unit, class_number, job_id=job_id, job_timeout=600)
+    return job_id
+
+
+def _analysis_response(record):
+    return {
+        'success': True,
+        'status': 'ready',
+        'date': record['date'],
+        'unit': record['unit'],
+        'class': record['class'],
+        'analysis': record['analysis'],
+        'log_count': record['log_count'],
+        'computed_at': record['computed_at'],
+        # 集計後に対象日のログが増えたか（指紋の無い古い結果は判定しない）
+        'logs_changed': bool(record.get('logs_fingerprint'))
+                        and record['logs_fingerprint'] != _logs_fingerprint(record['date']),
+    }
+
+
 @app.route('/teacher/analysis')
 @require_teacher_auth
 def teacher_analysis():
-    """教員用分析ダッシュボード"""
+    """教員用分析ダッシュボード（保存済みの集計結果を返す）"""
     unit = request.args.get('unit', '')
     date = request.args.get('date', datetime.now().strftime('%Y%m%d'))
+    class_number = normalize_class_value(request.args.get('class', ''))
     
     try:
-        # ログを読み込み
-        logs = load_learning_logs(date)
-        
-        if unit:
-            logs = [log for log in logs if log.get('unit') == unit]
-        
-        # 分析を実行
-        analysis_result = analyze_predictions_and_reflections(logs)
-        
-        return jsonify({
-            'success': True,
-            'date': date,
-            'unit': unit,
-            'analysis': analysis_result,
-            'log_count': len(logs)
-        })
+        record = analysis_store.get(_analysis_parts(date, unit, class_number))
+        if record is None:
+            job_id = _schedule_analysis(date, unit, class_number)
+            if job_id is not None:
+                return jsonify({'success': True, 'status': 'pending', 'job_id': job_id,
+                                'date': date, 'unit': unit, 'class': class_number or ''}), 202
+            record = analysis_store.get(_analysis_parts(date, unit, class_number))
+        return jsonify(_analysis_response(record))
     except Exception as e:
         print(f"[ANALYSIS] Error: {e}")
         import traceback
@@ -3072,6 +4229,37 @@ def teacher_analysis():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/teacher/analysis/recompute', methods=['POST'])
+@require_teacher_auth
+def teacher_analysis_recompute():
+    """指定した (日付, 単元, クラス) の分析を再集計する"""
+    data = request.get_json(silent=True) or {}
+    unit = data.get('unit', '')
+    date = data.get('date') or datetime.now().strftime('%Y%m%d')
+    class_number = normalize_class_value(data.get('class', ''))
+    
+    try:
+        job_id = _schedule_analysis(date, unit, class_number)
+        if job_id is not None:
+            return jsonify({'success': True, 'status': 'pending', 'job_id': job_id}), 202
+        return jsonify(_analysis_response(analysis_store.get(_analysis_parts(date, unit, class_number))))
+    except Exception as e:
+        print(f"[ANALYSIS] Recompute error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/teacher/prompts/reload', methods=['POST'])
+@require_teacher_auth
+def teacher_reload_prompts():
+    """prompts/・tasks/ のファイルを読み直す（編集をすぐに反映したいとき用）"""
+    try:
+        changed = prompt_registry.reload(force=True)
+        return jsonify({'success': True, 'changed': changed, **prompt_registry.stats()})
+    except Exception as e:
+        print(f"[PROMPTS] Reload error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 def analyze_predictions_and_reflections(logs):
     """予想と考察のテキスト分析 + 埋め込み + クラスタリング"""
     try:
@@ -3169,17 +4357,21 @@ def analyze_with_embeddings(prediction_messages, reflection_messages, unit):
         if len(all_messages) < 2:
             return {'clusters': [], 'cluster_count': 0}
         
-        # テキスト埋め込みを取得
-        embeddings = []
-        for msg in all_messages:
-            if msg.strip():
-                embedding = get_text_embedding(msg)
-                if embedding:
-                    embeddings.append({
-                        'text': msg,
-                        'embedding': embedding,
-                        'stage': 'prediction' if msg in prediction_messages else 'reflection'
-                    })
+        # テキスト埋め込みを取得（まとめて埋め込み、キャッシュ済みは再利用）
+        tagged = [(msg, 'prediction') for msg in prediction_messages if msg.strip()]
+        prediction_set = set(prediction_messages)
+        tagged += [(msg, 'prediction' if msg in prediction_set else 'reflection')
+                   for msg in reflection_messages if msg.strip()]
+        vectors = embed_texts([msg for msg, _ in tagged]) if tagged else []
+        failed = sum(1 for vector in vectors if not vector)
+        if failed:
+            # 一部だけでクラスタリングすると結果が偏るので、分析全体を失敗として扱う
+            raise RuntimeError(f"{failed} of {len(vectors)} embeddings failed")
+        embeddings = [
+            {'text': msg, 'embedding': vector, 'stage': stage}
+            for (msg, stage), vector in zip(tagged, vectors)
+            if vector
+        ]
         
         if len(embeddings) < 2:
             return {'clusters': [], 'cluster_count': 0}
@@ -3225,14 +4417,77 @@ def analyze_with_embeddings(prediction_messages, reflection_messages, unit):
         return {'clusters': [], 'cluster_count': 0, 'error': str(e)}
 
 
+# ============================================================================
+# 埋め込みサービス
+# 入力をまとめて embeddings.create に渡し（複数入力）、バッチを並行実行する。
+# ベクトルは本文のハッシュをキーに embedding_cache（Redis またはローカル）へ保存し、
+# 再分析時は新しいメッセージだけを埋め込む。
+# ============================================================================
+from concurrent.futures import ThreadPoolExecutor
+from storage.embedding_cache import EmbeddingCache, content_hash
+
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'text-embedding-3-small')
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 100))
+EMBEDDING_MAX_WORKERS = int(os.environ.get('EMBEDDING_MAX_WORKERS', 4))
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', 'embedding_cache')
+
+embedding_cache = _uses_redis(EmbeddingCache(EMBEDDING_CACHE_DIR, redis_conn=redis_conn))
+
+
+def _embed_batch(texts, model, class_key):
+    with openai_scheduler.slot('analytics', class_key, _estimate_tokens(' '.join(texts)),
+                               timeout=OPENAI_QUEUE_TIMEOUT):
+        response = client.embeddings.create(model=model, input=texts)
+    # data は入力順だが、念のため index で並べ直す
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def embed_texts(texts, model=None, class_key=None):
+    """テキストのリストを埋め込みベクトルのリストに変換する（入力と同じ順序）
+
+    重複するテキストは 1 回だけ、キャッシュ済みのものは API を呼ばずに返す。
+    失敗したバッチのテキストは None になる。
+    """
+    model = model or EMBEDDING_MODEL
+    if class_key is None:
+        class_key = _current_class_key()
+    keys = [content_hash(model, text) for text in texts]
+    vectors = embedding_cache.get_many(set(keys))
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+            missing[key] = text
+    if missing:
+        if not client:
+            raise RuntimeError("OpenAI client is not initialized")
+        items = list(missing.items())
+        batches = [items[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(items), EMBEDDING_BATCH_SIZE)]
+        print(f"[EMBEDDING] {len(texts)} texts, {len(texts) - len(missing)} cached, "
+              f"{len(missing)} to embed in {len(batches)} batches")
+
+        def run(batch):
+            try:
+                return batch, _embed_batch([text for _, text in batch], model, class_key)
+            except Exception as e:
+                print(f"[EMBEDDING_ERROR] batch of {len(batch)} failed: {e}")
+                return batch, None
+
+        fresh = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(EMBEDDING_MAX_WORKERS, len(batches)))) as pool:
+            for batch, result in pool.map(run, batches):
+                if result is not None:
+                    fresh.update({key: vector for (key, _), vector in zip(batch, result)})
+        embedding_cache.put_many(fresh)
+        vectors.update(fresh)
+
+    return [vectors.get(key) for key in keys]
+
+
 def get_text_embedding(text):
     """テキストの埋め込みを取得（OpenAI Embeddings API）"""
     try:
-        response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
+        return embed_texts([text])[0]
     except Exception as e:
         print(f"[EMBEDDING_ERROR] {e}")
         return None
@@ -3487,6 +4742,10 @@ def detect_patterns(messages):
         return {}
 
 
+# Redis の死活確認を開始（初回はすぐに実行し、以後は定期的に）
+services.start_health_checks(SERVICE_PROBE_INTERVAL)
+
+
 if __name__ == '__main__':
     # 環境変数からポート番号を取得（CloudRun用）
     port = int(os.environ.get('PORT', 5014))
@@ -3496,9 +4755,9 @@ if __name__ == '__main__':
     # ============================================================================
     # Windows / デザリング環境向けスレッド・タイムアウト設定
     # ============================================================================
-    # デザリング環境での 500 エラー軽減: スレッド数を 15 程度に設定
-    # (参考: デフォルトは 4 threads。高さすぎるとレート制限に達する)
-    threads = int(os.environ.get('WAITRESS_THREADS', 15))
+    # スレッド数は WAITRESS_THREADS（既定 40、/job_wait のロングポーリング分を含む）
+    # (参考: waitress のデフォルトは 4 threads。OpenAI のレート制限は openai_scheduler が守る)
+    threads = WAITRESS_THREADS
     channel_timeout = int(os.environ.get('WAITRESS_CHANNEL_TIMEOUT', 120))
     
     print(f"[INIT] Starting ScienceBuddy with:")
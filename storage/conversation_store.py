@@ -0,0 +1,146 @@
+"""Server-side storage for in-progress chat conversations.
+
+Conversations are keyed by ``(session_id, unit, name)`` so the browser cookie
+only has to carry a short session id.  With Redis each conversation is a list
+of JSON messages (``RPUSH`` appends are atomic across processes and the key
+expires ``ttl`` seconds after the last write).  Without Redis the store falls
+back to one JSON file per conversation under ``local_dir``; appends are
+serialised within the process.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from storage.shard_store import ShardedJsonStore
+
+DEFAULT_TTL = 12 * 3600
+
+
+class ConversationStore:
+    """Conversation lists keyed by session id.
+
+    Args:
+        local_dir: directory for the file fallback.
+        redis_conn: optional Redis connection (preferred when set).
+        ttl: seconds a conversation is kept after its last write.
+        key_prefix: Redis key prefix.
+    """
+
+    def __init__(self, local_dir: str, redis_conn=None, ttl: int = DEFAULT_TTL, key_prefix: str = 'conv'):
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._local = ShardedJsonStore(local_dir, fsync=False)
+        self._lock = threading.Lock()
+
+    def _key(self, sid: str, unit: Optional[str], name: str) -> str:
+        return f"{self.key_prefix}:{sid}:{unit or ''}:{name}"
+
+    @staticmethod
+    def _parts(sid: str, unit: Optional[str], name: str):
+        return [sid, unit or '_', name]
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+    def get(self, sid: str, unit: Optional[str], name: str) -> List[Dict[str, Any]]:
+        if self.redis is not None:
+            try:
+                return [json.loads(raw) for raw in self.redis.lrange(self._key(sid, unit, name), 0, -1)]
+            except Exception as e:
+                print(f"[CONVERSATION_STORE] Redis read failed, using local store: {e}")
+        record = self._local.get(self._parts(sid, unit, name))
+        if not record or record.get('expires_at', 0) < time.time():
+            return []
+        return record.get('messages', [])
+
+    def set(self, sid: str, unit: Optional[str], name: str, messages: List[Dict[str, Any]]):
+        if self.redis is not None:
+            try:
+                key = self._key(sid, unit, name)
+                pipe = self.redis.pipeline()
+                pipe.delete(key)
+                if messages:
+                    pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+                    pipe.expire(key, self.ttl)
+                pipe.execute()
+                return
+            except Exception as e:
+                print(f"[CONVERSATION_STORE] Redis write failed, using local store: {e}")
+        with self._lock:
+            self._put_local(sid, unit, name, list(messages))
+
+    def append(self, sid: str, unit: Optional[str], name: str, *messages: Dict[str, Any]):
+        if not messages:
+            return
+        if self.redis is not None:
+            try:
+                key = self._key(sid, unit, name)
+                pipe = self.redis.pipeline()
+                pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+                return
+            except Exception as e:
+                print(f"[CONVERSATION_STORE] Redis append failed, using local store: {e}")
+        with self._lock:
+            record = self._local.get(self._parts(sid, unit, name)) or {}
+            current = record.get('messages', []) if record.get('expires_at', 0) >= time.time() else []
+            self._put_local(sid, unit, name, current + list(messages))
+
+    def clear(self, sid: str, unit: Optional[str], name: str):
+        self.set(sid, unit, name, [])
+
+    def _put_local(self, sid, unit, name, messages):
+        parts = self._parts(sid, unit, name)
+        if not messages:
+            self._local.delete(parts)
+            return
+        self._local.put(parts, {'messages': messages, 'expires_at': time.time() + self.ttl})
+
+    def adopt_local(self) -> int:
+        """Move unexpired local conversations into Redis; returns how many moved.
+
+        Called when Redis becomes available after running without it, so
+        conversations written to the file fallback in the meantime stay
+        visible.  The local copy is newer and replaces any Redis list.
+        """
+        if self.redis is None:
+            return 0
+        moved = 0
+        now = time.time()
+        root = self._local.root_dir
+        for path, record in list(self._local.iter_records()):
+            parts = os.path.relpath(path, root)[:-len('.json')].split(os.sep)
+            if len(parts) != 3 or 'messages' not in record:
+                continue
+            remaining = int(record.get('expires_at', 0) - now)
+            if remaining > 0 and record['messages']:
+                sid, unit, name = parts
+                key = self._key(sid, '' if unit == '_' else unit, name)
+                pipe = self.redis.pipeline()
+                pipe.delete(key)
+                pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in record['messages']])
+                pipe.expire(key, remaining)
+                pipe.execute()
+                moved += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return moved
+
+    def purge_expired(self) -> int:
+        """Delete expired local conversation files; returns how many were removed."""
+        removed = 0
+        now = time.time()
+        for path, record in self._local.iter_records():
+            if record.get('expires_at', 0) < now:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
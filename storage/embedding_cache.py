@@ -0,0 +1,113 @@
+"""Content-addressed cache for text embedding vectors.
+
+Vectors are keyed by ``sha256(model + text)`` and stored as raw float32
+bytes, either in Redis (shared by every process) or, when Redis is not
+available, as one small file per vector under a local directory.  Vectors
+for a given model and text never change, so entries are never invalidated;
+Redis entries only carry a TTL to bound memory.
+"""
+import hashlib
+import os
+import tempfile
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+DEFAULT_REDIS_TTL = 30 * 24 * 3600
+
+
+def content_hash(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Embedding vector cache.
+
+    Args:
+        local_dir: directory for the file-backed cache.
+        redis_conn: optional Redis connection; when set it is used instead of
+            the local directory.
+        key_prefix: Redis key prefix.
+        ttl: Redis entry lifetime in seconds.
+    """
+
+    def __init__(self, local_dir: str, redis_conn=None, key_prefix: str = 'embedding',
+                 ttl: int = DEFAULT_REDIS_TTL):
+        self.local_dir = local_dir
+        self.redis = redis_conn
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+
+    # ------------------------------------------------------------------
+    # encoding
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _encode(vector) -> bytes:
+        return np.asarray(vector, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def _decode(raw: bytes) -> List[float]:
+        return np.frombuffer(raw, dtype=np.float32).tolist()
+
+    def _local_path(self, key: str) -> str:
+        return os.path.join(self.local_dir, key[:2], f"{key}.f32")
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+    def get_many(self, keys: Iterable[str]) -> Dict[str, List[float]]:
+        """Return ``{key: vector}`` for the keys that are cached."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        if self.redis is not None:
+            try:
+                raws = self.redis.mget([f"{self.key_prefix}:{k}" for k in keys])
+                return {k: self._decode(raw) for k, raw in zip(keys, raws) if raw}
+            except Exception as e:
+                print(f"[EMBEDDING_CACHE] Redis read failed, using local cache: {e}")
+        found = {}
+        for key in keys:
+            try:
+                with open(self._local_path(key), 'rb') as f:
+                    found[key] = self._decode(f.read())
+            except (FileNotFoundError, ValueError):
+                continue
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]):
+        if not vectors:
+            return
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline()
+                for key, vector in vectors.items():
+                    pipe.set(f"{self.key_prefix}:{key}", self._encode(vector), ex=self.ttl)
+                pipe.execute()
+                return
+            except Exception as e:
+                print(f"[EMBEDDING_CACHE] Redis write failed, using local cache: {e}")
+        for key, vector in vectors.items():
+            self._put_local(key, vector)
+
+    def _put_local(self, key: str, vector):
+        path = self._local_path(key)
+        dirpath = os.path.dirname(path)
+        os.makedirs(dirpath, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=dirpath)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._encode(vector))
+            os.replace(tmp, path)
+            tmp = None
+        except OSError as e:
+            print(f"[EMBEDDING_CACHE] Local write failed for {key}: {e}")
+        finally:
+            if tmp and os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def get(self, key: str) -> Optional[List[float]]:
+        return self.get_many([key]).get(key)
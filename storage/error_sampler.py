@@ -0,0 +1,121 @@
+"""Sampling of repeated error reports.
+
+During an outage every student reports the same error within seconds.  The
+sampler keeps the first ``keep`` reports of each ``(error_type,
+error_message)`` pair per ``window`` seconds and counts the rest.  When the
+window closes, one summary entry records how many reports were suppressed and
+which students sent them, so the log keeps the full picture at a fraction of
+the writes.
+"""
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_WINDOW = 60.0
+DEFAULT_KEEP = 5
+# Students listed in one summary entry.
+MAX_LISTED = 50
+
+
+class _Burst:
+    __slots__ = ('started', 'kept', 'suppressed', 'sample', 'students', 'first_suppressed', 'last_suppressed')
+
+    def __init__(self, started: float, sample: Dict[str, Any]):
+        self.started = started
+        self.kept = 0
+        self.suppressed = 0
+        self.sample = sample
+        self.students: List[str] = []
+        self.first_suppressed: Optional[str] = None
+        self.last_suppressed: Optional[str] = None
+
+
+class BurstSampler:
+    """Per-message sampler for error log entries.
+
+    Args:
+        window: seconds of one sampling window per message.
+        keep: entries written in full per window.
+    """
+
+    def __init__(self, window: float = DEFAULT_WINDOW, keep: int = DEFAULT_KEEP):
+        self.window = window
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._bursts: Dict[Tuple[str, str], _Burst] = {}
+
+    @staticmethod
+    def _key(entry: Dict[str, Any]) -> Tuple[str, str]:
+        return str(entry.get('error_type')), str(entry.get('error_message'))
+
+    def record(self, entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Return the entries to write now for a new report.
+
+        That is the report itself unless it was suppressed, preceded by the
+        summary of this message's previous window when that window has closed.
+        """
+        if self.keep <= 0 or self.window <= 0:
+            return [entry]
+        now = time.monotonic()
+        key = self._key(entry)
+        out = []
+        with self._lock:
+            burst = self._bursts.get(key)
+            if burst is not None and now - burst.started >= self.window:
+                summary = self._summary(burst)
+                if summary is not None:
+                    out.append(summary)
+                burst = None
+            if burst is None:
+                burst = self._bursts[key] = _Burst(now, entry)
+            if burst.kept < self.keep:
+                burst.kept += 1
+                out.append(entry)
+            else:
+                burst.suppressed += 1
+                burst.first_suppressed = burst.first_suppressed or entry.get('timestamp')
+                burst.last_suppressed = entry.get('timestamp')
+                student = entry.get('class_display')
+                if student and student not in burst.students and len(burst.students) < MAX_LISTED:
+                    burst.students.append(student)
+        return out
+
+    def drain(self, force: bool = False) -> List[Dict[str, Any]]:
+        """Close finished windows (all windows with ``force``) and return their summaries."""
+        now = time.monotonic()
+        out = []
+        with self._lock:
+            for key in list(self._bursts):
+                burst = self._bursts[key]
+                if force or now - burst.started >= self.window:
+                    del self._bursts[key]
+                    summary = self._summary(burst)
+                    if summary is not None:
+                        out.append(summary)
+        return out
+
+    @staticmethod
+    def _summary(burst: _Burst) -> Optional[Dict[str, Any]]:
+        if not burst.suppressed:
+            return None
+        sample = burst.sample
+        return {
+            'id': uuid.uuid4().hex,
+            'timestamp': burst.last_suppressed or datetime.now().isoformat(),
+            'student_number': None,
+            'class_number': None,
+            'class_display': f"ほか{burst.suppressed}件",
+            'error_message': sample.get('error_message'),
+            'error_type': sample.get('error_type'),
+            'stage': sample.get('stage'),
+            'unit': sample.get('unit'),
+            'additional_info': {
+                'sampled': True,
+                'suppressed_count': burst.suppressed,
+                'first_timestamp': burst.first_suppressed,
+                'last_timestamp': burst.last_suppressed,
+                'students': burst.students,
+            },
+        }
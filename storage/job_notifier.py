@@ -0,0 +1,181 @@
+"""Completion notifications for background jobs over Redis pub/sub.
+
+A job calls :meth:`JobNotifier.publish` when it finishes (or fails).  The
+payload is published on ``<prefix>:<job_id>`` and also kept under the same key
+for ``result_ttl`` seconds, so a waiter that arrives after the publish still
+sees it with one ``GET``.
+
+Web processes wait with :meth:`JobNotifier.wait`.  Each process runs a single
+pattern subscription (``<prefix>:*``) in a background thread and wakes the
+matching waiters, so a waiting request costs no Redis round trips beyond the
+initial check.  The number of concurrent waiters is bounded so long-polls
+cannot occupy every server thread.
+"""
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_RESULT_TTL = 600
+DEFAULT_MAX_WAITERS = 8
+# Seconds between reconnect attempts of the listener.
+_RECONNECT_DELAY = 2.0
+# Longest a waiter waits for the listener's subscription to be confirmed.
+_SUBSCRIBE_TIMEOUT = 5.0
+
+
+class WaiterLimitReached(Exception):
+    """Raised by :meth:`JobNotifier.wait` when too many requests are waiting."""
+
+
+class _Waiter:
+    __slots__ = ('event', 'payload')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.payload = None
+
+
+class JobNotifier:
+    """Publish and await job completion payloads.
+
+    Args:
+        redis_conn: Redis connection (required for cross-process delivery).
+        prefix: channel / key prefix.
+        result_ttl: seconds the last payload of a job is kept.
+        max_waiters: concurrent :meth:`wait` calls allowed in this process.
+    """
+
+    def __init__(self, redis_conn, prefix: str = 'job_done', result_ttl: int = DEFAULT_RESULT_TTL,
+                 max_waiters: int = DEFAULT_MAX_WAITERS):
+        self.redis = redis_conn
+        self.prefix = prefix
+        self.result_ttl = result_ttl
+        self.max_waiters = max_waiters
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, List[_Waiter]] = {}
+        self._waiting = 0
+        self._listener: Optional[threading.Thread] = None
+        self._subscribed = threading.Event()
+
+    def _key(self, job_id: str) -> str:
+        return f"{self.prefix}:{job_id}"
+
+    # ------------------------------------------------------------------
+    # publishing (job side)
+    # ------------------------------------------------------------------
+    def publish(self, job_id: str, payload: Dict[str, Any]):
+        if self.redis is None or not job_id:
+            return
+        raw = json.dumps(payload, ensure_ascii=False)
+        try:
+            pipe = self.redis.pipeline()
+            pipe.set(self._key(job_id), raw, ex=self.result_ttl)
+            pipe.publish(self._key(job_id), raw)
+            pipe.execute()
+        except Exception as e:
+            print(f"[JOB_NOTIFY] Publish failed for {job_id}: {e}")
+
+    def result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the stored payload of ``job_id`` if it has completed."""
+        if self.redis is None:
+            return None
+        raw = self.redis.get(self._key(job_id))
+        return json.loads(raw) if raw else None
+
+    # ------------------------------------------------------------------
+    # waiting (web side)
+    # ------------------------------------------------------------------
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Block until ``job_id`` completes; ``None`` on timeout.
+
+        Raises :class:`WaiterLimitReached` when ``max_waiters`` requests are
+        already waiting in this process.
+        """
+        waiter = _Waiter()
+        with self._lock:
+            if self._waiting >= self.max_waiters:
+                raise WaiterLimitReached()
+            self._waiting += 1
+            self._waiters.setdefault(job_id, []).append(waiter)
+        try:
+            self._ensure_listener()
+            # Registered before the check, so a publish in between still wakes us.
+            payload = self.result(job_id)
+            if payload is not None:
+                return payload
+            if waiter.event.wait(timeout):
+                return waiter.payload
+            return None
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                waiters = self._waiters.get(job_id)
+                if waiters is not None:
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[job_id]
+
+    def waiting(self) -> int:
+        with self._lock:
+            return self._waiting
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None:
+                self._subscribed.clear()
+                self._listener = threading.Thread(target=self._listen, name='job-notifier', daemon=True)
+                self._listener.start()
+        # Wait for the subscription to be confirmed so no publish is missed.
+        self._subscribed.wait(_SUBSCRIBE_TIMEOUT)
+
+    def _listen(self):
+        pattern = f"{self.prefix}:*"
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.psubscribe(pattern)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        with self._lock:
+                            # Stop when idle; the next wait() starts a new listener.
+                            if not self._waiters:
+                                self._listener = None
+                                return
+                        continue
+                    if message.get('type') == 'psubscribe':
+                        self._subscribed.set()
+                    elif message.get('type') == 'pmessage':
+                        self._dispatch(message)
+            except Exception as e:
+                print(f"[JOB_NOTIFY] Listener error, reconnecting: {e}")
+                self._subscribed.clear()
+                time.sleep(_RECONNECT_DELAY)
+                with self._lock:
+                    if not self._waiters:
+                        self._listener = None
+                        return
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def _dispatch(self, message):
+        channel = message.get('channel')
+        if isinstance(channel, bytes):
+            channel = channel.decode('utf-8')
+        job_id = channel[len(self.prefix) + 1:]
+        try:
+            payload = json.loads(message.get('data'))
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            waiters = self._waiters.pop(job_id, [])
+        for waiter in waiters:
+            waiter.payload = payload
+            waiter.event.set()
@@ -0,0 +1,203 @@
+"""Cross-process read-modify-write transactions on local JSON files.
+
+Files are only ever replaced atomically (temp file + fsync + ``os.replace``),
+so readers need no lock: they see either the old or the new file.  Writers
+serialize on a sidecar lockfile (``<path>.lock``) with ``fcntl.flock``.  The
+sidecar is never replaced, so every process locks the same inode; locking the
+data file itself would not work because each write swaps it for a new one.
+
+A file's *version* is ``(inode, mtime_ns, size)``.  Since every write creates
+a new inode, a version that still matches under the lock proves that no other
+process has written since, which lets :class:`JsonDocument` reuse its parsed
+copy instead of re-reading the file inside the critical section.
+"""
+import copy
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Optional, Tuple
+
+try:  # POSIX only; elsewhere the in-process lock is all we have.
+    import fcntl as _fcntl
+except ImportError:  # pragma: no cover - Windows
+    _fcntl = None
+
+Version = Tuple[int, int, int]
+
+LOCK_SUFFIX = '.lock'
+
+
+def file_version(path: str) -> Optional[Version]:
+    """Return ``(inode, mtime_ns, size)`` of ``path`` or ``None`` if it is missing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+@contextmanager
+def file_lock(path: str, local_lock=None):
+    """Hold the exclusive cross-process lock of ``path``.
+
+    ``local_lock`` (a ``threading`` lock) is taken first, so threads of one
+    process queue on it instead of on the file lock.
+    """
+    if local_lock is not None:
+        local_lock.acquire()
+    try:
+        if _fcntl is None:
+            yield
+            return
+        lock_path = path + LOCK_SUFFIX
+        dirpath = os.path.dirname(lock_path)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            _fcntl.flock(fd, _fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the flock.
+            os.close(fd)
+    finally:
+        if local_lock is not None:
+            local_lock.release()
+
+
+@contextmanager
+def try_file_lock(path: str):
+    """Take the cross-process lock of ``path`` without waiting.
+
+    Yields ``True`` while holding it, ``False`` if another process holds it.
+    """
+    if _fcntl is None:
+        yield True
+        return
+    lock_path = path + LOCK_SUFFIX
+    dirpath = os.path.dirname(lock_path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            _fcntl.flock(fd, _fcntl.LOCK_EX | _fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+def read_json(path: str, default: Any = None) -> Any:
+    """Parse ``path``; ``default`` when it is missing or invalid."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json_atomic(path: str, data: Any, indent: Optional[int] = None, fsync: bool = True):
+    """Replace ``path`` with ``data`` via a temp file in the same directory."""
+    dirpath = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=dirpath)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            if indent is None:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            else:
+                json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        tmp = None
+        if fsync:
+            try:
+                dirfd = os.open(dirpath, os.O_DIRECTORY)
+                try:
+                    os.fsync(dirfd)
+                finally:
+                    os.close(dirfd)
+            except (OSError, AttributeError):
+                pass
+    finally:
+        if tmp and os.path.exists(tmp):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+class JsonDocument:
+    """A JSON object file shared by threads and processes.
+
+    :meth:`read` returns a cached parse that is refreshed when the file's
+    version changes (one ``stat`` per call, no lock).  :meth:`update` runs a
+    read-modify-write under the sidecar lock.
+
+    Args:
+        path: the JSON file.
+        indent: ``json.dump`` indent of written files.
+        fsync: fsync the file and its directory on every write.
+        local_lock: in-process lock serializing this process's writers.
+    """
+
+    def __init__(self, path: str, indent: Optional[int] = 2, fsync: bool = True, local_lock=None):
+        self.path = path
+        self.indent = indent
+        self.fsync = fsync
+        self.local_lock = local_lock if local_lock is not None else threading.RLock()
+        self._cache_lock = threading.Lock()
+        self._version: Optional[Version] = None
+        self._data: dict = {}
+
+    def _publish(self, version: Optional[Version], data: dict):
+        with self._cache_lock:
+            self._version = version
+            self._data = data
+
+    def read(self) -> dict:
+        """Current contents.  Shared with other callers: treat as read-only."""
+        version = file_version(self.path)
+        with self._cache_lock:
+            if version is not None and version == self._version:
+                return self._data
+        data = read_json(self.path, {}) if version is not None else {}
+        if not isinstance(data, dict):
+            data = {}
+        self._publish(version, data)
+        return data
+
+    def update(self, mutate: Callable[[dict], Any]) -> Any:
+        """Apply ``mutate(data)`` and write the result; returns what ``mutate`` returns.
+
+        ``data`` is a copy of the current contents whose top level may be
+        changed freely; nested objects are shared with :meth:`read` callers,
+        so ``mutate`` must replace them rather than modify them in place.
+        """
+        with file_lock(self.path, self.local_lock):
+            version = file_version(self.path)
+            with self._cache_lock:
+                cached = self._data if version is not None and version == self._version else None
+            if cached is None:
+                cached = read_json(self.path, {}) if version is not None else {}
+                if not isinstance(cached, dict):
+                    cached = {}
+            data = dict(cached)
+            result = mutate(data)
+            write_json_atomic(self.path, data, self.indent, self.fsync)
+            self._publish(file_version(self.path), data)
+            return result
+
+    def replace(self, data: dict):
+        """Overwrite the whole document."""
+        data = copy.deepcopy(data)
+        with file_lock(self.path, self.local_lock):
+            write_json_atomic(self.path, data, self.indent, self.fsync)
+            self._publish(file_version(self.path), data)
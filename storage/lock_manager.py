@@ -0,0 +1,146 @@
+"""In-process locks keyed by file path, with bounded memory and metrics.
+
+Two modes:
+
+- reference counted (``stripes=0``): one re-entrant lock per key, created on
+  the first acquire and dropped when the last holder or waiter releases it,
+  so the registry only holds keys that are in use right now;
+- striped (``stripes=N``): keys hash onto ``N`` fixed locks.  Memory is
+  constant whatever the number of paths, at the price of unrelated keys
+  occasionally sharing a lock.
+
+Every acquire is counted; when it had to wait, the wait time and the key are
+recorded so :meth:`LockManager.stats` shows how contended a store is and which
+keys are hot.
+"""
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import Any, Dict, Optional
+
+# Contended keys remembered for the hot-key report.
+_HOT_KEYS_LIMIT = 1000
+_HOT_KEYS_KEEP = 100
+
+
+class _Entry:
+    __slots__ = ('lock', 'refs')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.refs = 0
+
+
+class PathLock:
+    """Lock handle for one key; ``acquire``/``release`` or ``with``."""
+
+    __slots__ = ('_manager', 'key')
+
+    def __init__(self, manager: 'LockManager', key: str):
+        self._manager = manager
+        self.key = key
+
+    def acquire(self):
+        self._manager._acquire(self.key)
+        return True
+
+    def release(self):
+        self._manager._release(self.key)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class LockManager:
+    """Registry of per-key locks.
+
+    Args:
+        name: label used in metrics and log messages.
+        stripes: number of striped locks; ``0`` for reference-counted per-key locks.
+    """
+
+    def __init__(self, name: str, stripes: int = 0):
+        self.name = name
+        self.stripes = max(0, int(stripes))
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = {}
+        self._stripes = [threading.RLock() for _ in range(self.stripes)]
+        self.acquired = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self._hot = Counter()
+
+    def lock_for(self, key: str) -> PathLock:
+        return PathLock(self, key)
+
+    # ------------------------------------------------------------------
+    # internals
+    # ------------------------------------------------------------------
+    def _stripe(self, key: str) -> threading.RLock:
+        return self._stripes[zlib.crc32(key.encode('utf-8')) % self.stripes]
+
+    def _acquire(self, key: str):
+        if self.stripes:
+            lock = self._stripe(key)
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = _Entry()
+                entry.refs += 1
+            lock = entry.lock
+        if lock.acquire(blocking=False):
+            waited = None
+        else:
+            started = time.monotonic()
+            lock.acquire()
+            waited = time.monotonic() - started
+        with self._lock:
+            self.acquired += 1
+            if waited is not None:
+                self.contended += 1
+                self.wait_seconds += waited
+                self.max_wait = max(self.max_wait, waited)
+                self._hot[key] += 1
+                if len(self._hot) > _HOT_KEYS_LIMIT:
+                    self._hot = Counter(dict(self._hot.most_common(_HOT_KEYS_KEEP)))
+
+    def _release(self, key: str):
+        if self.stripes:
+            self._stripe(key).release()
+            return
+        with self._lock:
+            entry = self._entries[key]
+            entry.lock.release()
+            entry.refs -= 1
+            if entry.refs == 0:
+                del self._entries[key]
+
+    # ------------------------------------------------------------------
+    # metrics
+    # ------------------------------------------------------------------
+    def stats(self, top: int = 5) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'mode': f'striped({self.stripes})' if self.stripes else 'refcounted',
+                'live_keys': len(self._entries),
+                'acquired': self.acquired,
+                'contended': self.contended,
+                'wait_seconds': round(self.wait_seconds, 4),
+                'max_wait_seconds': round(self.max_wait, 4),
+                'hot_keys': [{'key': k, 'contended': n} for k, n in self._hot.most_common(top)],
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+def collect_stats(*managers: Optional[LockManager]) -> Dict[str, Dict[str, Any]]:
+    """``{name: stats}`` for the given managers."""
+    return {m.name: m.stats() for m in managers if m is not None}
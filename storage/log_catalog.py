@@ -0,0 +1,104 @@
+"""Cached catalog of the dates that have log files.
+
+Dates are collected from every configured source (e.g. a log store's
+``local_dates`` and a GCS listing) and cached for ``ttl`` seconds, so page
+views do not list the bucket each time.  Writers call :meth:`LogDateCatalog.note_write` with the
+date they appended to; a date that is not in the cached list is added in
+place, which keeps the catalog exact for this process without a relist.
+Writes from other processes show up when the TTL expires.
+"""
+import re
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Sequence
+
+DEFAULT_TTL = 300
+# Cache a degraded (partially failed) listing only briefly.
+FAILURE_TTL = 30
+
+_DATE_RE = re.compile(r'_(\d{8})(?:\.\d+\.jsonl|\.json)$')
+
+
+def _date_of(name: str) -> Optional[str]:
+    m = _DATE_RE.search(name)
+    return m.group(1) if m else None
+
+
+def list_gcs_dates(bucket, prefix: str) -> List[str]:
+    """Dates of objects directly under ``prefix`` (e.g. ``logs/learning_log_``).
+
+    Uses a ``/`` delimiter so nested prefixes such as ``logs/_parts/`` are not
+    walked, and reads the listing page by page.
+    """
+    dates = set()
+    iterator = bucket.list_blobs(prefix=prefix, delimiter='/')
+    for page in iterator.pages:
+        for blob in page:
+            date = _date_of(blob.name)
+            if date:
+                dates.add(date)
+    return list(dates)
+
+
+class LogDateCatalog:
+    """TTL-cached union of dates from several sources.
+
+    Args:
+        name: label used in log messages.
+        sources: callables returning iterables of ``YYYYMMDD`` strings.  A
+            source that raises is skipped for that refresh.
+        ttl: seconds to keep a successful listing.
+    """
+
+    def __init__(self, name: str, sources: Sequence[Callable[[], Iterable[str]]], ttl: float = DEFAULT_TTL):
+        self.name = name
+        self.sources = list(sources)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._dates: Optional[List[str]] = None
+        self._expires = 0.0
+        # Dates written while a refresh is listing; merged into its result.
+        self._noted = set()
+
+    def dates(self) -> List[str]:
+        """Return the known dates, newest first."""
+        with self._lock:
+            if self._dates is not None and time.monotonic() < self._expires:
+                return list(self._dates)
+        # One refresh at a time; concurrent callers wait and reuse its result.
+        with self._refresh_lock:
+            with self._lock:
+                if self._dates is not None and time.monotonic() < self._expires:
+                    return list(self._dates)
+                self._noted = set()
+            dates, ok = self._collect()
+            with self._lock:
+                if self._noted - set(dates):
+                    dates = sorted(set(dates) | self._noted, reverse=True)
+                self._dates = dates
+                self._expires = time.monotonic() + (self.ttl if ok else min(self.ttl, FAILURE_TTL))
+                return list(dates)
+
+    def _collect(self):
+        found = set()
+        ok = True
+        for source in self.sources:
+            try:
+                found.update(source())
+            except Exception as e:
+                ok = False
+                print(f"[LOG_CATALOG] {self.name} source failed: {type(e).__name__}: {e}")
+        return sorted(found, reverse=True), ok
+
+    def note_write(self, date: str):
+        """Record that ``date`` now has data (called after appends)."""
+        with self._lock:
+            self._noted.add(date)
+            if self._dates is not None and date not in self._dates:
+                self._dates = sorted(self._dates + [date], reverse=True)
+
+    def invalidate(self):
+        with self._lock:
+            self._dates = None
+            self._expires = 0.0
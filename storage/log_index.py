@@ -0,0 +1,257 @@
+"""Secondary index over a :class:`SegmentedLogStore`.
+
+For every day the index maps a partition ``(unit, class_num, seat_num)`` to
+the byte ranges of its entries inside the day's segments::
+
+    {"unit\\tclass\\tseat": [[segment_index, offset, length], ...]}
+
+Queries then read only the ranges of matching partitions (ranged GCS
+downloads or local ``seek`` + ``read``) instead of downloading and parsing the
+whole day.
+
+The index is maintained incrementally: each day's index remembers how many
+bytes of every segment it has scanned, and a refresh only scans the bytes
+appended since then.  Because segments are append-only (and GCS compose keeps
+the existing object as a prefix), recorded offsets never move.  Index files
+are a cache; deleting them just causes a rescan.
+
+Legacy whole-day array files are indexed by array position and are read in
+full when a query touches them.
+"""
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from storage.log_store import SegmentedLogStore, _decode_records
+
+INDEX_VERSION = 1
+# Ranges closer than this are fetched with one read.
+COALESCE_GAP = 64 * 1024
+# Day indexes kept in memory (older ones are re-read from disk on demand).
+CACHED_DAYS = 8
+
+
+def _partition_key(unit: Any, class_num: Any, seat_num: Any) -> str:
+    return '\t'.join('' if v is None else str(v) for v in (unit, class_num, seat_num))
+
+
+def _split_key(key: str) -> Tuple[str, str, str]:
+    unit, class_num, seat_num = key.split('\t')
+    return unit, class_num, seat_num
+
+
+class LogIndex:
+    """Per-day partition index for a segmented log store.
+
+    Args:
+        store: the :class:`SegmentedLogStore` to index.
+        index_dir: directory holding ``<prefix>_<date>.idx.json`` files.
+    """
+
+    def __init__(self, store: SegmentedLogStore, index_dir: str):
+        self.store = store
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._date_locks: Dict[str, threading.RLock] = {}
+        self._cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+
+    def _date_lock(self, date: str):
+        with self._lock:
+            lock = self._date_locks.get(date)
+            if lock is None:
+                lock = self._date_locks[date] = threading.RLock()
+            return lock
+
+    def _index_path(self, date: str) -> str:
+        return os.path.join(self.index_dir, f"{self.store.prefix}_{date}.idx.json")
+
+    # ------------------------------------------------------------------
+    # persistence
+    # ------------------------------------------------------------------
+    def _load_index(self, date: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._index_path(date), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                return index
+        except (OSError, json.JSONDecodeError):
+            pass
+        return None
+
+    def _save_index(self, date: str, index: Dict[str, Any]):
+        os.makedirs(self.index_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=self.index_dir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp, self._index_path(date))
+            tmp = None
+        except OSError as e:
+            print(f"[LOG_INDEX] Could not save index for {date}: {e}")
+        finally:
+            if tmp and os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _empty(source: str) -> Dict[str, Any]:
+        return {'version': INDEX_VERSION, 'source': source, 'segments': {}, 'partitions': {}}
+
+    # ------------------------------------------------------------------
+    # maintenance
+    # ------------------------------------------------------------------
+    def refresh(self, date: str) -> Dict[str, Any]:
+        """Bring the index for ``date`` up to date and return it."""
+        with self._date_lock(date):
+            source, segments = self.store.segments(date)
+            with self._lock:
+                index = self._cache.get(date)
+            if index is None:
+                index = self._load_index(date)
+            if index is None or index.get('source') != source:
+                index = self._empty(source)
+
+            changed = False
+            for seg_index, name, size in segments:
+                seg_key = str(seg_index)
+                state = index['segments'].get(seg_key)
+                if state is None or state.get('name') != name or state.get('indexed', 0) > size:
+                    if state is not None:
+                        # The segment was replaced (e.g. a different source); start over.
+                        index = self._empty(source)
+                        return self._rebuild(date, index, segments)
+                    state = {'name': name, 'indexed': 0}
+                    index['segments'][seg_key] = state
+                    changed = True
+                if seg_index < 0:
+                    if state['indexed'] == 0 and size:
+                        self._index_legacy(index, seg_index, source, name)
+                        state['indexed'] = size
+                        changed = True
+                    continue
+                if size > state['indexed']:
+                    self._index_tail(index, seg_index, source, name, state, size)
+                    changed = True
+
+            if changed:
+                self._save_index(date, index)
+            self._remember(date, index)
+            return index
+
+    def _remember(self, date: str, index: Dict[str, Any]):
+        with self._lock:
+            self._cache[date] = index
+            self._cache.move_to_end(date)
+            while len(self._cache) > CACHED_DAYS:
+                self._cache.popitem(last=False)
+
+    def _rebuild(self, date: str, index: Dict[str, Any], segments) -> Dict[str, Any]:
+        for seg_index, name, size in segments:
+            state = {'name': name, 'indexed': 0}
+            index['segments'][str(seg_index)] = state
+            if seg_index < 0:
+                self._index_legacy(index, seg_index, index['source'], name)
+                state['indexed'] = size
+            else:
+                self._index_tail(index, seg_index, index['source'], name, state, size)
+        self._save_index(date, index)
+        self._remember(date, index)
+        return index
+
+    @staticmethod
+    def _add(index: Dict[str, Any], entry: Dict[str, Any], location: List[int]):
+        key = _partition_key(entry.get('unit'), entry.get('class_num'), entry.get('seat_num'))
+        index['partitions'].setdefault(key, []).append(location)
+
+    def _index_legacy(self, index, seg_index, source, name):
+        for position, entry in enumerate(self.store.read_segment(source, name)):
+            if isinstance(entry, dict):
+                self._add(index, entry, [seg_index, position, 0])
+
+    def _index_tail(self, index, seg_index, source, name, state, size):
+        start = state['indexed']
+        raw = self.store.read_range(source, name, start, size)
+        # Only index complete lines; a partially written tail is picked up next time.
+        end = raw.rfind(b'\n') + 1
+        offset = 0
+        while offset < end:
+            nl = raw.index(b'\n', offset)
+            line = raw[offset:nl + 1]
+            records = _decode_records(line)
+            if records and isinstance(records[0], dict):
+                self._add(index, records[0], [seg_index, start + offset, len(line)])
+            offset = nl + 1
+        state['indexed'] = start + end
+
+    # ------------------------------------------------------------------
+    # queries
+    # ------------------------------------------------------------------
+    def partitions(self, date: str) -> List[Tuple[str, str, str]]:
+        """Return the ``(unit, class_num, seat_num)`` partitions of ``date``."""
+        with self._date_lock(date):
+            return [_split_key(key) for key in self.refresh(date)['partitions']]
+
+    def query(self, date: str, unit: Optional[str] = None, class_num: Optional[int] = None,
+              seat_num: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Return the entries of ``date`` matching the given partition fields.
+
+        ``None`` matches anything.  Entries are returned in write order.
+        """
+        return list(self.iter_query(date, unit, class_num, seat_num))
+
+    def iter_query(self, date: str, unit: Optional[str] = None, class_num: Optional[int] = None,
+                   seat_num: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        wanted = (
+            None if unit is None else str(unit),
+            None if class_num is None else str(class_num),
+            None if seat_num is None else str(seat_num),
+        )
+        # Snapshot the matching locations so a concurrent refresh cannot mutate them mid-read.
+        with self._date_lock(date):
+            index = self.refresh(date)
+            source = index['source']
+            names = {int(k): v['name'] for k, v in index['segments'].items()}
+            locations = []
+            for key, locs in index['partitions'].items():
+                fields = _split_key(key)
+                if all(w is None or w == f for w, f in zip(wanted, fields)):
+                    locations.extend(locs)
+        if not locations:
+            return
+        locations.sort()
+
+        by_segment: Dict[int, List[List[int]]] = {}
+        for loc in locations:
+            by_segment.setdefault(loc[0], []).append(loc)
+        for seg_index in sorted(by_segment):
+            name = names[seg_index]
+            locs = by_segment[seg_index]
+            if seg_index < 0:
+                entries = self.store.read_segment(source, name)
+                for _, position, _ in locs:
+                    if position < len(entries):
+                        yield entries[position]
+                continue
+            yield from self._read_ranges(source, name, locs)
+
+    def _read_ranges(self, source: str, name: str, locs: List[List[int]]) -> Iterator[Dict[str, Any]]:
+        group = [locs[0]]
+        for loc in locs[1:]:
+            last = group[-1]
+            if loc[1] - (last[1] + last[2]) <= COALESCE_GAP:
+                group.append(loc)
+                continue
+            yield from self._read_group(source, name, group)
+            group = [loc]
+        yield from self._read_group(source, name, group)
+
+    def _read_group(self, source: str, name: str, group: List[List[int]]) -> Iterator[Dict[str, Any]]:
+        base = group[0][1]
+        raw = self.store.read_range(source, name, base, group[-1][1] + group[-1][2])
+        for _, offset, length in group:
+            yield from _decode_records(raw[offset - base:offset - base + length])
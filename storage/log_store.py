@@ -0,0 +1,538 @@
+"""Append-only, segmented storage for daily log files.
+
+Entries are written as newline-delimited JSON records into rotating segment
+files (``<prefix>_<YYYYMMDD>.<NNN>.jsonl``) so that each append costs
+O(entry) instead of re-reading and re-writing the whole day's array.
+
+Local segments are appended under an exclusive ``flock`` on the segment;
+compaction holds the same locks while it folds and deletes the segments, and
+an appender that finds its segment deleted once it gets the lock re-opens the
+path instead of writing into the unlinked file.  On GCS, objects
+are immutable, so each batch is uploaded as a small part object and then
+composed onto the current segment with a generation precondition.
+
+Legacy ``<prefix>_<YYYYMMDD>.json`` array files are still read, so days that
+were written before the segmented layout keep working.  :meth:`compact` folds
+a finished day's segments back into that daily array file.
+"""
+import glob
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    import fcntl as _fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    _fcntl = None
+
+DEFAULT_SEGMENT_MAX_BYTES = 8 * 1024 * 1024
+# GCS compose accepts at most 32 sources per request; composite objects are
+# kept well below the historical 1024 component ceiling by rotating early.
+GCS_MAX_COMPONENTS = 1000
+GCS_COMPOSE_RETRIES = 5
+
+
+def _today():
+    return datetime.now().strftime('%Y%m%d')
+
+
+def _encode_records(entries: Iterable[Dict[str, Any]]) -> bytes:
+    return ''.join(
+        json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        for entry in entries
+    ).encode('utf-8')
+
+
+def _decode_records(raw: bytes) -> List[Dict[str, Any]]:
+    records = []
+    for line in raw.decode('utf-8', errors='replace').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # A torn trailing line (crash mid-append) is skipped, not fatal.
+            continue
+    return records
+
+
+def dedupe_entries(entries: Iterable[Dict[str, Any]], field: Optional[str]) -> List[Dict[str, Any]]:
+    """Drop entries whose ``field`` value was already seen (entries without it are kept)."""
+    if not field:
+        return list(entries)
+    seen = set()
+    unique = []
+    for entry in entries:
+        value = entry.get(field) if isinstance(entry, dict) else None
+        if value is not None:
+            if value in seen:
+                continue
+            seen.add(value)
+        unique.append(entry)
+    return unique
+
+
+def _is_precondition_failure(exc: Exception) -> bool:
+    return getattr(exc, 'code', None) == 412 or 'PreconditionFailed' in type(exc).__name__
+
+
+class SegmentedLogStore:
+    """Daily append-only log store backed by local segments and optional GCS.
+
+    Args:
+        base_dir: local directory holding the log files (e.g. ``logs``).
+        prefix: file name prefix (e.g. ``learning_log``).
+        bucket: optional GCS bucket; when set (and truthy, so a lazily built
+            bucket that is unavailable counts as unset), appends are mirrored
+            to GCS and reads prefer GCS, matching the previous GCS-first
+            behaviour.
+        gcs_prefix: object prefix inside the bucket (e.g. ``logs``).
+        segment_max_bytes: rotate to a new segment once the current one
+            reaches this size.
+    """
+
+    def __init__(self, base_dir: str, prefix: str, bucket=None, gcs_prefix: Optional[str] = None,
+                 segment_max_bytes: int = DEFAULT_SEGMENT_MAX_BYTES):
+        self.base_dir = base_dir
+        self.prefix = prefix
+        self.bucket = bucket
+        self.gcs_prefix = gcs_prefix if gcs_prefix is not None else base_dir
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.Lock()
+        self._local_index: Dict[str, int] = {}
+        # date -> {'index', 'generation', 'size', 'components'} for the GCS tail segment
+        self._gcs_state: Dict[str, Dict[str, int]] = {}
+        self._segment_re = re.compile(
+            r'^' + re.escape(prefix) + r'_(\d{8})(?:\.(\d+)\.jsonl|\.json)$'
+        )
+
+    # ------------------------------------------------------------------
+    # naming helpers
+    # ------------------------------------------------------------------
+    def legacy_filename(self, date: str) -> str:
+        return f"{self.prefix}_{date}.json"
+
+    def segment_filename(self, date: str, index: int) -> str:
+        return f"{self.prefix}_{date}.{index:03d}.jsonl"
+
+    def parse_filename(self, filename: str):
+        """Return ``(date, segment_index)`` for a store file name, or ``None``.
+
+        Legacy array files report a segment index of ``-1`` so they sort first.
+        """
+        m = self._segment_re.match(os.path.basename(filename))
+        if not m:
+            return None
+        return m.group(1), int(m.group(2)) if m.group(2) is not None else -1
+
+    # ------------------------------------------------------------------
+    # writes
+    # ------------------------------------------------------------------
+    def append(self, entry: Dict[str, Any], date: Optional[str] = None):
+        self.append_many([entry], date=date)
+
+    def append_many(self, entries: List[Dict[str, Any]], date: Optional[str] = None):
+        """Append ``entries`` for ``date`` (defaults to today) in one write.
+
+        GCS errors are reported and swallowed so the local copy is always
+        written, mirroring the previous save behaviour.
+        """
+        if not entries:
+            return
+        date = date or _today()
+        payload = _encode_records(entries)
+        if self.bucket:
+            try:
+                self._append_gcs(date, payload)
+            except Exception as e:
+                print(f"[LOG_STORE] GCS append failed for {self.prefix}_{date}: {type(e).__name__}: {e}")
+        self._append_local(date, payload)
+
+    def _current_local_index(self, date: str) -> int:
+        index = self._local_index.get(date)
+        if index is None:
+            indices = [
+                parsed[1]
+                for parsed in map(self.parse_filename, glob.glob(os.path.join(self.base_dir, f"{self.prefix}_{date}.*.jsonl")))
+                if parsed
+            ]
+            index = max(indices) if indices else 0
+            self._local_index[date] = index
+        return index
+
+    def _append_local(self, date: str, payload: bytes):
+        os.makedirs(self.base_dir, exist_ok=True)
+        with self._lock:
+            index = self._current_local_index(date)
+            while True:
+                path = os.path.join(self.base_dir, self.segment_filename(date, index))
+                with open(path, 'ab') as f:
+                    if _fcntl is not None:
+                        _fcntl.flock(f.fileno(), _fcntl.LOCK_EX)
+                    try:
+                        if not self._still_linked(f, path):
+                            # Compacted away while we waited for the lock.
+                            continue
+                        size = os.fstat(f.fileno()).st_size
+                        if size > 0 and size + len(payload) > self.segment_max_bytes:
+                            index += 1
+                            self._local_index[date] = index
+                            continue
+                        f.write(payload)
+                        f.flush()
+                    finally:
+                        if _fcntl is not None:
+                            _fcntl.flock(f.fileno(), _fcntl.LOCK_UN)
+                return
+
+    @staticmethod
+    def _still_linked(f, path: str) -> bool:
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _gcs_segment_name(self, date: str, index: int) -> str:
+        return f"{self.gcs_prefix}/{self.segment_filename(date, index)}"
+
+    def _load_gcs_state(self, date: str) -> Dict[str, int]:
+        """Find the tail segment for ``date`` by listing its objects."""
+        state = {'index': 0, 'generation': 0, 'size': 0, 'components': 0}
+        for blob in self.bucket.list_blobs(prefix=f"{self.gcs_prefix}/{self.prefix}_{date}."):
+            parsed = self.parse_filename(blob.name)
+            if not parsed or parsed[1] < 0 or parsed[1] < state['index']:
+                continue
+            state = {
+                'index': parsed[1],
+                'generation': blob.generation or 0,
+                'size': blob.size or 0,
+                'components': blob.component_count or 1,
+            }
+        return state
+
+    def _append_gcs(self, date: str, payload: bytes):
+        with self._lock:
+            state = self._gcs_state.get(date)
+        if state is None:
+            state = self._load_gcs_state(date)
+
+        part = None
+        try:
+            for _ in range(GCS_COMPOSE_RETRIES):
+                if state['generation'] and (
+                    state['size'] + len(payload) > self.segment_max_bytes
+                    or state['components'] >= GCS_MAX_COMPONENTS
+                ):
+                    state = {'index': state['index'] + 1, 'generation': 0, 'size': 0, 'components': 0}
+
+                segment = self.bucket.blob(self._gcs_segment_name(date, state['index']))
+                try:
+                    if not state['generation']:
+                        # First write to this segment: create it only if absent.
+                        segment.upload_from_string(payload, content_type='application/x-ndjson',
+                                                   if_generation_match=0)
+                    else:
+                        if part is None:
+                            part = self.bucket.blob(
+                                f"{self.gcs_prefix}/_parts/{self.prefix}_{date}/{uuid.uuid4().hex}.jsonl"
+                            )
+                            part.upload_from_string(payload, content_type='application/x-ndjson')
+                        segment.content_type = 'application/x-ndjson'
+                        segment.compose([segment, part], if_generation_match=state['generation'])
+                except Exception as e:
+                    if not _is_precondition_failure(e):
+                        raise
+                    # Another writer advanced the segment; re-read the tail and retry.
+                    state = self._load_gcs_state(date)
+                    continue
+
+                state = {
+                    'index': state['index'],
+                    'generation': segment.generation or 0,
+                    'size': segment.size or (state['size'] + len(payload)),
+                    'components': segment.component_count or (state['components'] + 1),
+                }
+                with self._lock:
+                    self._gcs_state[date] = state
+                return
+            raise RuntimeError(f"GCS append contention for {self.prefix}_{date}")
+        finally:
+            if part is not None:
+                try:
+                    part.delete()
+                except Exception:
+                    pass
+
+    # ------------------------------------------------------------------
+    # reads
+    # ------------------------------------------------------------------
+    def load(self, date: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return every entry for ``date`` (GCS first, then local)."""
+        date = date or _today()
+        if self.bucket:
+            try:
+                logs = self._load_gcs(date)
+                if logs is not None:
+                    return logs
+            except Exception as e:
+                print(f"[LOG_STORE] GCS load failed for {self.prefix}_{date}: {type(e).__name__}: {e}")
+        return self._load_local(date)
+
+    def _load_local(self, date: str) -> List[Dict[str, Any]]:
+        logs: List[Dict[str, Any]] = []
+        for _, path in self.local_files(date):
+            logs.extend(self._read_file(path))
+        return logs
+
+    def local_files(self, date: str):
+        """Return ``[(segment_index, path)]`` for ``date`` in read order."""
+        files = []
+        for path in glob.glob(os.path.join(self.base_dir, f"{self.prefix}_{date}.*")):
+            parsed = self.parse_filename(path)
+            if parsed and parsed[0] == date:
+                files.append((parsed[1], path))
+        files.sort()
+        return files
+
+    @staticmethod
+    def _read_file(path: str) -> List[Dict[str, Any]]:
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return []
+        if path.endswith('.jsonl'):
+            return _decode_records(raw)
+        try:
+            data = json.loads(raw.decode('utf-8'))
+            return data if isinstance(data, list) else []
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return []
+
+    def _load_gcs(self, date: str) -> Optional[List[Dict[str, Any]]]:
+        blobs = []
+        for blob in self.bucket.list_blobs(prefix=f"{self.gcs_prefix}/{self.prefix}_{date}."):
+            parsed = self.parse_filename(blob.name)
+            if parsed and parsed[0] == date:
+                blobs.append((parsed[1], blob.name, blob))
+        if not blobs:
+            return None
+        blobs.sort(key=lambda item: (item[0], item[1]))
+        logs: List[Dict[str, Any]] = []
+        for index, _, blob in blobs:
+            raw = blob.download_as_bytes()
+            if index < 0:
+                try:
+                    data = json.loads(raw.decode('utf-8'))
+                    logs.extend(data if isinstance(data, list) else [])
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+            else:
+                logs.extend(_decode_records(raw))
+        return logs
+
+    def segments(self, date: str):
+        """Return ``(source, [(segment_index, name, size)])`` for ``date``.
+
+        ``source`` is ``'gcs'`` when the bucket has objects for the day (the
+        same GCS-first rule as :meth:`load`), otherwise ``'local'``.  Names are
+        object names or local paths and can be passed to :meth:`read_range`.
+        """
+        if self.bucket:
+            try:
+                found = []
+                for blob in self.bucket.list_blobs(prefix=f"{self.gcs_prefix}/{self.prefix}_{date}."):
+                    parsed = self.parse_filename(blob.name)
+                    if parsed and parsed[0] == date:
+                        found.append((parsed[1], blob.name, blob.size or 0))
+                if found:
+                    return 'gcs', sorted(found)
+            except Exception as e:
+                print(f"[LOG_STORE] GCS listing failed for {self.prefix}_{date}: {type(e).__name__}: {e}")
+        found = []
+        for index, path in self.local_files(date):
+            try:
+                found.append((index, path, os.path.getsize(path)))
+            except OSError:
+                continue
+        return 'local', found
+
+    def read_range(self, source: str, name: str, start: int, end: int) -> bytes:
+        """Read bytes ``[start, end)`` of a segment returned by :meth:`segments`."""
+        if end <= start:
+            return b''
+        if source == 'gcs':
+            # GCS ranges are inclusive of ``end``.
+            return self.bucket.blob(name).download_as_bytes(start=start, end=end - 1)
+        with open(name, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def read_segment(self, source: str, name: str) -> List[Dict[str, Any]]:
+        """Read every entry of one segment (used for legacy array files)."""
+        if source == 'gcs':
+            raw = self.bucket.blob(name).download_as_bytes()
+            if name.endswith('.jsonl'):
+                return _decode_records(raw)
+            try:
+                data = json.loads(raw.decode('utf-8'))
+                return data if isinstance(data, list) else []
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                return []
+        return self._read_file(name)
+
+    # ------------------------------------------------------------------
+    # compaction
+    # ------------------------------------------------------------------
+    def compact(self, date: str, min_idle: float = 0, id_field: Optional[str] = None) -> int:
+        """Merge the segments of ``date`` into its daily array file.
+
+        The daily file is rewritten with the existing array followed by the
+        segment entries, then the segments are deleted.  Days whose newest
+        segment was modified less than ``min_idle`` seconds ago are skipped, so
+        only finished days should be passed.  With ``id_field`` entries are
+        de-duplicated by that field, which makes a compaction interrupted
+        between the rewrite and the deletes safe to run again.
+
+        Returns the number of entries in the rewritten file (0 if skipped).
+        """
+        written = 0
+        if self.bucket:
+            try:
+                written = self._compact_gcs(date, min_idle, id_field)
+            except Exception as e:
+                print(f"[LOG_STORE] GCS compaction failed for {self.prefix}_{date}: {type(e).__name__}: {e}")
+        return max(written, self._compact_local(date, min_idle, id_field))
+
+    def _compact_local(self, date: str, min_idle: float, id_field: Optional[str]) -> int:
+        with self._lock:
+            files = self.local_files(date)
+            segments = [path for index, path in files if index >= 0]
+            if not segments:
+                return 0
+            try:
+                newest = max(os.path.getmtime(path) for path in segments)
+            except OSError:
+                return 0
+            if time.time() - newest < min_idle:
+                return 0
+            with ExitStack() as stack:
+                # Hold every segment's append lock for the whole read/rewrite/delete,
+                # in index order (appenders only ever hold one of them).
+                locked = []
+                for path in segments:
+                    try:
+                        f = stack.enter_context(open(path, 'rb'))
+                    except FileNotFoundError:
+                        continue
+                    if _fcntl is not None:
+                        _fcntl.flock(f.fileno(), _fcntl.LOCK_EX)
+                    if self._still_linked(f, path):
+                        locked.append(path)
+                segments = locked
+                if not segments:
+                    return 0
+                # Only the locked segments: newer ones may still be appended to.
+                entries = []
+                for path in [path for index, path in files if index < 0] + segments:
+                    entries.extend(self._read_file(path))
+                entries = dedupe_entries(entries, id_field)
+                fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=self.base_dir)
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        json.dump(entries, f, ensure_ascii=False, indent=2)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, os.path.join(self.base_dir, self.legacy_filename(date)))
+                    tmp = None
+                finally:
+                    if tmp and os.path.exists(tmp):
+                        os.remove(tmp)
+                for path in segments:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                # The locks are released when the descriptors close.
+            self._local_index.pop(date, None)
+        print(f"[LOG_STORE] Compacted {len(segments)} local segments of {self.prefix}_{date} ({len(entries)} entries)")
+        return len(entries)
+
+    def _compact_gcs(self, date: str, min_idle: float, id_field: Optional[str]) -> int:
+        # Every object is read and deleted at the generation seen here; a
+        # segment that was appended to in between fails the precondition and
+        # is left for the next pass.
+        legacy = None
+        segments = []
+        for blob in self.bucket.list_blobs(prefix=f"{self.gcs_prefix}/{self.prefix}_{date}."):
+            parsed = self.parse_filename(blob.name)
+            if not parsed or parsed[0] != date:
+                continue
+            if parsed[1] < 0:
+                legacy = blob
+            else:
+                segments.append((parsed[1], blob))
+        if not segments:
+            return 0
+        updated = [blob.updated for _, blob in segments if blob.updated is not None]
+        if updated and (datetime.now(timezone.utc) - max(updated)).total_seconds() < min_idle:
+            return 0
+        segments.sort(key=lambda item: item[0])
+
+        entries: List[Dict[str, Any]] = []
+        if legacy is not None:
+            raw = legacy.download_as_bytes(if_generation_match=legacy.generation)
+            try:
+                data = json.loads(raw.decode('utf-8'))
+                entries.extend(data if isinstance(data, list) else [])
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                pass
+        folded = []
+        for _, blob in segments:
+            try:
+                raw = blob.download_as_bytes(if_generation_match=blob.generation)
+            except Exception as e:
+                if not _is_precondition_failure(e):
+                    raise
+                continue
+            entries.extend(_decode_records(raw))
+            folded.append(blob)
+        if not folded:
+            return 0
+        entries = dedupe_entries(entries, id_field)
+        # Fails if another compactor rewrote the daily file since we read it.
+        self.bucket.blob(f"{self.gcs_prefix}/{self.legacy_filename(date)}").upload_from_string(
+            json.dumps(entries, ensure_ascii=False, indent=2),
+            content_type='application/json',
+            if_generation_match=legacy.generation if legacy is not None else 0,
+        )
+        kept = 0
+        for blob in folded:
+            try:
+                blob.delete(if_generation_match=blob.generation)
+            except Exception as e:
+                kept += 1
+                if not _is_precondition_failure(e):
+                    print(f"[LOG_STORE] Could not delete {blob.name}: {type(e).__name__}: {e}")
+        with self._lock:
+            self._gcs_state.pop(date, None)
+        print(f"[LOG_STORE] Compacted {len(folded) - kept} GCS segments of {self.prefix}_{date} "
+              f"({len(entries)} entries, {kept} kept for the next pass)")
+        return len(entries)
+
+    def local_dates(self) -> List[str]:
+        """Return the set of dates with local files, newest first."""
+        dates = set()
+        for path in glob.glob(os.path.join(self.base_dir, f"{self.prefix}_*")):
+            parsed = self.parse_filename(path)
+            if parsed:
+                dates.add(parsed[0])
+        return sorted(dates, reverse=True)
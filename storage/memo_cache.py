@@ -0,0 +1,333 @@
+"""Memoized results with in-flight request coalescing.
+
+Results are JSON values stored under a caller-chosen key, in Redis (shared by
+every process) or, without Redis, as one JSON file per key under
+``local_dir``.  Entries expire ``ttl`` seconds after they were stored; expired
+local files are deleted when they are read and by a sweep that local writes
+start at most once every ``purge_interval`` seconds (Redis expires its keys
+itself).
+
+Concurrent requests for one key share a single computation:
+
+- within a process, later callers wait for the first caller's result;
+- across processes (with Redis), the first caller takes a short lease
+  (``SET NX EX``) and the others poll for the stored result until the lease
+  is released or expires, then compute it themselves if it is still missing.
+
+Callers that produce the result themselves (e.g. while streaming it) use
+:meth:`MemoCache.begin` / :meth:`MemoCache.finish` to take the same claim, and
+duplicates use :meth:`MemoCache.wait` instead of computing again.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from storage.shard_store import ShardedJsonStore
+
+DEFAULT_TTL = 24 * 3600
+# Longest a computation may hold the cross-process lease.
+DEFAULT_LEASE_TTL = 300
+# Seconds between sweeps of expired local entries.
+DEFAULT_PURGE_INTERVAL = 3600
+# Interval of the result poll while another process holds the lease.
+_POLL_INTERVAL = 0.5
+
+# Delete the lease only while it is still ours.
+_RELEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class _Flight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Claim:
+    """A caller's exclusive right to compute one key (see :meth:`MemoCache.begin`)."""
+
+    __slots__ = ('key', 'flight', 'token')
+
+    def __init__(self, key: str, flight: _Flight, token: str):
+        self.key = key
+        self.flight = flight
+        self.token = token
+
+
+class MemoCache:
+    """Memoization store with single-flight computation.
+
+    Args:
+        local_dir: directory for the file fallback.
+        redis_conn: optional Redis connection (shared by every process).
+        ttl: seconds a result is kept.
+        lease_ttl: seconds a cross-process computation lease lasts.
+        key_prefix: Redis key prefix (also used in log messages).
+        purge_interval: seconds between sweeps of expired local entries
+            (``0`` disables the sweep; :meth:`purge_expired` still works).
+    """
+
+    def __init__(self, local_dir: str, redis_conn=None, ttl: int = DEFAULT_TTL,
+                 lease_ttl: int = DEFAULT_LEASE_TTL, key_prefix: str = 'memo',
+                 purge_interval: float = DEFAULT_PURGE_INTERVAL):
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+        self.key_prefix = key_prefix
+        self.purge_interval = purge_interval
+        # 0 so that the first local write also clears what earlier runs left behind.
+        self._last_purge = 0.0
+        self._purging = False
+        self._local = ShardedJsonStore(local_dir, fsync=False)
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._release_script = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.purged = 0
+
+    def _parts(self, key: str):
+        return [key[:2], key]
+
+    # ------------------------------------------------------------------
+    # storage
+    # ------------------------------------------------------------------
+    def get(self, key: str) -> Optional[Any]:
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(f"{self.key_prefix}:{key}")
+                return json.loads(raw) if raw else None
+            except Exception as e:
+                print(f"[MEMO_CACHE] {self.key_prefix}: Redis read failed, using local cache: {e}")
+        parts = self._parts(key)
+        record = self._local.get(parts)
+        if not record:
+            return None
+        if record.get('expires_at', 0) < time.time():
+            try:
+                self._local.delete(parts)
+            except OSError:
+                pass
+            return None
+        return record.get('value')
+
+    def put(self, key: str, value: Any):
+        if self.redis is not None:
+            try:
+                self.redis.set(f"{self.key_prefix}:{key}", json.dumps(value, ensure_ascii=False), ex=self.ttl)
+                return
+            except Exception as e:
+                print(f"[MEMO_CACHE] {self.key_prefix}: Redis write failed, using local cache: {e}")
+        try:
+            self._local.put(self._parts(key), {'value': value, 'expires_at': time.time() + self.ttl})
+        except OSError as e:
+            print(f"[MEMO_CACHE] {self.key_prefix}: Local write failed for {key}: {e}")
+        self._maybe_purge()
+
+    def purge_expired(self) -> int:
+        """Delete expired local entries; returns how many were removed."""
+        removed = 0
+        now = time.time()
+        for path, record in self._local.iter_records():
+            if isinstance(record, dict) and record.get('expires_at', 0) < now:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        with self._lock:
+            self.purged += removed
+        return removed
+
+    def _maybe_purge(self):
+        """Start a background sweep if the last one is ``purge_interval`` seconds old."""
+        if not self.purge_interval:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._purging or (self._last_purge and now - self._last_purge < self.purge_interval):
+                return
+            self._purging = True
+            self._last_purge = now
+        threading.Thread(target=self._purge_in_background, name=f'{self.key_prefix}-purge', daemon=True).start()
+
+    def _purge_in_background(self):
+        try:
+            removed = self.purge_expired()
+            if removed:
+                print(f"[MEMO_CACHE] {self.key_prefix}: Purged {removed} expired local entries")
+        except Exception as e:
+            print(f"[MEMO_CACHE] {self.key_prefix}: Purge failed: {e}")
+        finally:
+            with self._lock:
+                self._purging = False
+
+    # ------------------------------------------------------------------
+    # memoized computation
+    # ------------------------------------------------------------------
+    def get_or_compute(self, key: str, compute: Callable[[], Any],
+                       cacheable: Callable[[Any], bool] = bool) -> Any:
+        """Return the stored result for ``key`` or compute it once.
+
+        Results for which ``cacheable`` is false (e.g. error messages) are
+        returned to the caller that computed them but are not stored or
+        shared with waiting callers; those compute their own.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.coalesced += 1
+            flight.event.wait()
+            if flight.error is None and flight.result is not None:
+                return flight.result
+            return self._compute(key, compute, cacheable)
+
+        try:
+            result = self._compute(key, compute, cacheable)
+            if cacheable(result):
+                flight.result = result
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    # ------------------------------------------------------------------
+    # computations run by the caller (e.g. while streaming the result)
+    # ------------------------------------------------------------------
+    def begin(self, key: str) -> Optional[Claim]:
+        """Claim ``key`` for a computation the caller runs itself.
+
+        Returns a :class:`Claim` to pass to :meth:`finish`, or ``None`` when
+        another caller (in this or another process) is already computing it;
+        use :meth:`wait` for that caller's result.
+        """
+        with self._lock:
+            if key in self._flights:
+                return None
+            flight = self._flights[key] = _Flight()
+        token = self._acquire_lease(key)
+        if token is None:
+            self._end_flight(key, flight)
+            return None
+        return Claim(key, flight, token)
+
+    def finish(self, claim: Claim, result: Any = None):
+        """Store ``result`` (unless ``None``) and release ``claim``, waking waiters."""
+        try:
+            if result is not None:
+                self.put(claim.key, result)
+                claim.flight.result = result
+        finally:
+            if claim.token:
+                self._release_lease(claim.key, claim.token)
+            self._end_flight(claim.key, claim.flight)
+
+    def wait(self, key: str, timeout: float) -> Optional[Any]:
+        """Wait up to ``timeout`` seconds for another caller's result for ``key``.
+
+        Returns ``None`` if it did not arrive (timeout, or that caller failed).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+        if flight is not None:
+            flight.event.wait(timeout)
+            if flight.result is not None:
+                self.coalesced += 1
+                return flight.result
+            return self.get(key)
+        if self.redis is not None:
+            return self._await_remote(key, timeout)
+        return self.get(key)
+
+    def _end_flight(self, key: str, flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.event.set()
+
+    def _compute(self, key: str, compute: Callable[[], Any], cacheable: Callable[[Any], bool]) -> Any:
+        token = self._acquire_lease(key)
+        if token is None:
+            # Another process is computing; wait for its result.
+            cached = self._await_remote(key)
+            if cached is not None:
+                self.coalesced += 1
+                return cached
+        try:
+            cached = self.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            result = compute()
+            if cacheable(result):
+                self.put(key, result)
+            return result
+        finally:
+            if token:
+                self._release_lease(key, token)
+
+    def _acquire_lease(self, key: str) -> Optional[str]:
+        """Return a lease token, ``''`` when leases are unavailable, ``None`` if held elsewhere."""
+        if self.redis is None:
+            return ''
+        token = uuid.uuid4().hex
+        try:
+            if self.redis.set(f"{self.key_prefix}:lease:{key}", token, nx=True, ex=self.lease_ttl):
+                return token
+            return None
+        except Exception as e:
+            print(f"[MEMO_CACHE] {self.key_prefix}: Lease failed, computing without it: {e}")
+            return ''
+
+    def _release_lease(self, key: str, token: str):
+        try:
+            if self._release_script is None:
+                self._release_script = self.redis.register_script(_RELEASE_LUA)
+            self._release_script(keys=[f"{self.key_prefix}:lease:{key}"], args=[token])
+        except Exception as e:
+            print(f"[MEMO_CACHE] {self.key_prefix}: Lease release failed: {e}")
+
+    def _await_remote(self, key: str, timeout: Optional[float] = None) -> Optional[Any]:
+        deadline = time.monotonic() + (self.lease_ttl if timeout is None else timeout)
+        lease_key = f"{self.key_prefix}:lease:{key}"
+        while time.monotonic() < deadline:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            try:
+                if not self.redis.exists(lease_key):
+                    return self.get(key)
+            except Exception:
+                return None
+            time.sleep(_POLL_INTERVAL)
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            in_flight = len(self._flights)
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'in_flight': in_flight,
+                'purged': self.purged}
@@ -0,0 +1,204 @@
+"""Lazily built external clients with background health checks.
+
+Creating the GCS, Firestore, OpenAI and Redis clients at import time makes
+every cold start pay for all of them, and a synchronous Redis ``PING`` blocks
+startup for the whole connect timeout when Redis is down.  A
+:class:`ServiceContainer` instead builds each client the first time it is
+used and, for services registered with a probe, decides availability from a
+background health check that is repeated periodically, so a backend that
+comes back later is picked up without a restart.
+
+Code that used to hold the client in a module global can hold a
+:class:`LazyService` instead: attribute access goes to the client (built on
+demand) and ``bool(proxy)`` tells whether it is usable.
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_RETRY_INTERVAL = 30.0
+DEFAULT_PROBE_INTERVAL = 15.0
+
+
+class ServiceUnavailable(RuntimeError):
+    """Raised when a service is used while it cannot be built or is unhealthy."""
+
+
+class _Service:
+    __slots__ = ('name', 'factory', 'probe', 'on_change', 'lock', 'instance', 'error',
+                 'failed_at', 'healthy', 'checked_at')
+
+    def __init__(self, name, factory, probe, on_change):
+        self.name = name
+        self.factory = factory
+        self.probe = probe
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.instance = None
+        self.error: Optional[str] = None
+        self.failed_at = 0.0
+        # None until the first probe; always True for services without a probe.
+        self.healthy: Optional[bool] = None if probe else True
+        self.checked_at: Optional[float] = None
+
+
+class ServiceContainer:
+    """Registry of lazily built clients.
+
+    Args:
+        retry_interval: seconds before a failed build is attempted again.
+    """
+
+    def __init__(self, retry_interval: float = DEFAULT_RETRY_INTERVAL):
+        self.retry_interval = retry_interval
+        self._services: Dict[str, _Service] = {}
+        self._checker: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._fork_hook = False
+
+    def register(self, name: str, factory: Callable[[], Any],
+                 probe: Optional[Callable[[Any], Any]] = None,
+                 on_change: Optional[Callable[[bool], None]] = None):
+        """Register ``factory`` under ``name``.
+
+        With a ``probe`` the service counts as available only after
+        ``probe(instance)`` has succeeded; ``on_change(available)`` is called
+        whenever that verdict flips.
+        """
+        self._services[name] = _Service(name, factory, probe, on_change)
+
+    # ------------------------------------------------------------------
+    # access
+    # ------------------------------------------------------------------
+    def _build(self, service: _Service):
+        if service.instance is not None:
+            return service.instance
+        with service.lock:
+            if service.instance is not None:
+                return service.instance
+            if service.error is not None and time.monotonic() - service.failed_at < self.retry_interval:
+                return None
+            try:
+                service.instance = service.factory()
+                service.error = None
+                print(f"[SERVICES] {service.name} initialized")
+            except Exception as e:
+                service.error = f"{type(e).__name__}: {e}"
+                service.failed_at = time.monotonic()
+                print(f"[SERVICES] {service.name} initialization failed: {service.error}")
+            return service.instance
+
+    def get(self, name: str) -> Optional[Any]:
+        """Return the client, building it on first use; ``None`` while unavailable."""
+        service = self._services[name]
+        if service.probe is not None and not service.healthy:
+            return None
+        return self._build(service)
+
+    def require(self, name: str) -> Any:
+        instance = self.get(name)
+        if instance is None:
+            error = self._services[name].error or 'not available'
+            raise ServiceUnavailable(f"{name}: {error}")
+        return instance
+
+    def lazy(self, name: str) -> 'LazyService':
+        return LazyService(self, name)
+
+    # ------------------------------------------------------------------
+    # health checks
+    # ------------------------------------------------------------------
+    def probe(self, name: str) -> bool:
+        """Run the health check of ``name`` now and return its verdict."""
+        service = self._services[name]
+        if service.probe is None:
+            return self._build(service) is not None
+        instance = self._build(service)
+        healthy = False
+        if instance is not None:
+            try:
+                service.probe(instance)
+                healthy = True
+            except Exception as e:
+                service.error = f"{type(e).__name__}: {e}"
+        first = service.checked_at is None
+        service.checked_at = time.time()
+        changed = healthy != bool(service.healthy)
+        service.healthy = healthy
+        if changed or first:
+            state = 'available' if healthy else f"unavailable ({service.error})"
+            print(f"[SERVICES] {name} {state}")
+        if changed and service.on_change is not None:
+            try:
+                service.on_change(healthy)
+            except Exception as e:
+                print(f"[SERVICES] {name} change handler failed: {e}")
+        return healthy
+
+    def start_health_checks(self, interval: float = DEFAULT_PROBE_INTERVAL):
+        """Probe every service with a health check now and then every ``interval`` seconds."""
+        if self._checker is not None or interval <= 0:
+            return
+        names = [name for name, service in self._services.items() if service.probe is not None]
+        if not names:
+            return
+
+        def run():
+            while True:
+                for name in names:
+                    self.probe(name)
+                if self._stop.wait(interval):
+                    return
+
+        self._checker = threading.Thread(target=run, name='service-health', daemon=True)
+        self._checker.start()
+        if hasattr(os, 'register_at_fork') and not self._fork_hook:
+            # Threads do not survive fork (e.g. gunicorn --preload); restart in the child.
+            self._fork_hook = True
+            os.register_at_fork(after_in_child=lambda: self._restart_checker(interval))
+
+    def _restart_checker(self, interval: float):
+        self._checker = None
+        self._stop = threading.Event()
+        self.start_health_checks(interval)
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                'built': service.instance is not None,
+                # None while neither built nor failed yet (lazy, unused so far).
+                'available': (bool(service.healthy) if service.instance is not None
+                              else (False if service.error else None)),
+                'error': service.error,
+                'checked_at': service.checked_at,
+            }
+            for name, service in self._services.items()
+        }
+
+
+class LazyService:
+    """Stand-in for a client held in a module global.
+
+    Attribute access builds the client on first use (raising
+    :class:`ServiceUnavailable` when it cannot be built); ``bool()`` is true
+    only while the client is usable.
+    """
+
+    __slots__ = ('_container', '_name')
+
+    def __init__(self, container: ServiceContainer, name: str):
+        object.__setattr__(self, '_container', container)
+        object.__setattr__(self, '_name', name)
+
+    def __getattr__(self, attr):
+        return getattr(self._container.require(self._name), attr)
+
+    def __bool__(self):
+        return self._container.get(self._name) is not None
+
+    def __repr__(self):
+        return f"<LazyService {self._name}>"
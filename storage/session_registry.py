@@ -0,0 +1,128 @@
+"""Registry of the active login session per student.
+
+Used to detect the same student logging in from a second device.  Both
+directions are O(1) lookups:
+
+- ``student -> session_id``
+- ``session_id -> (student, device)``
+
+With Redis the registry is shared by every process and host; entries expire
+``ttl`` seconds after they were registered.  Without Redis (or when a Redis
+call fails) an in-process map with the same expiry is used.
+"""
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+DEFAULT_TTL = 8 * 3600
+# Sweep expired local entries after this many registrations.
+_LOCAL_SWEEP_EVERY = 256
+
+# Delete the student key only while it still points at the given session.
+_CLEAR_STUDENT_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SessionRegistry:
+    """Active session registry.
+
+    Args:
+        redis_conn: optional Redis connection (shared registry when set).
+        ttl: seconds before an entry expires.
+        key_prefix: Redis key prefix.
+    """
+
+    def __init__(self, redis_conn=None, ttl: int = DEFAULT_TTL, key_prefix: str = 'active_session'):
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._lock = threading.Lock()
+        self._students: Dict[str, Tuple[str, float]] = {}
+        self._sessions: Dict[str, Tuple[str, str, float]] = {}
+        self._registrations = 0
+        self._clear_script = None
+
+    def _student_key(self, student_id: str) -> str:
+        return f"{self.key_prefix}:student:{student_id}"
+
+    def _session_key(self, session_id: str) -> str:
+        return f"{self.key_prefix}:session:{session_id}"
+
+    @staticmethod
+    def _text(value) -> Optional[str]:
+        if value is None:
+            return None
+        return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+    def register(self, student_id: str, session_id: str, device: str):
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.set(self._student_key(student_id), session_id, ex=self.ttl)
+                pipe.hset(self._session_key(session_id), mapping={'student_id': student_id, 'device': device})
+                pipe.expire(self._session_key(session_id), self.ttl)
+                pipe.execute()
+                return
+            except Exception as e:
+                print(f"[SESSION_REGISTRY] Redis register failed, using local registry: {e}")
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._students[student_id] = (session_id, expires)
+            self._sessions[session_id] = (student_id, device, expires)
+            self._registrations += 1
+            if self._registrations % _LOCAL_SWEEP_EVERY == 0:
+                self._sweep_locked()
+
+    def lookup(self, student_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """Return ``(session_id, device)`` of the student's active session."""
+        if self.redis is not None:
+            try:
+                session_id = self._text(self.redis.get(self._student_key(student_id)))
+                if session_id is None:
+                    return None, None
+                return session_id, self._text(self.redis.hget(self._session_key(session_id), 'device'))
+            except Exception as e:
+                print(f"[SESSION_REGISTRY] Redis lookup failed, using local registry: {e}")
+        now = time.time()
+        with self._lock:
+            entry = self._students.get(student_id)
+            if entry is None or entry[1] < now:
+                return None, None
+            session_id = entry[0]
+            info = self._sessions.get(session_id)
+            device = info[1] if info is not None and info[2] >= now else None
+            return session_id, device
+
+    def clear(self, session_id: str):
+        """Forget ``session_id`` (and its student's entry if it still points here)."""
+        if self.redis is not None:
+            try:
+                student_id = self._text(self.redis.hget(self._session_key(session_id), 'student_id'))
+                self.redis.delete(self._session_key(session_id))
+                if student_id is not None:
+                    if self._clear_script is None:
+                        self._clear_script = self.redis.register_script(_CLEAR_STUDENT_LUA)
+                    self._clear_script(keys=[self._student_key(student_id)], args=[session_id])
+                return
+            except Exception as e:
+                print(f"[SESSION_REGISTRY] Redis clear failed, using local registry: {e}")
+        with self._lock:
+            info = self._sessions.pop(session_id, None)
+            if info is not None:
+                entry = self._students.get(info[0])
+                if entry is not None and entry[0] == session_id:
+                    del self._students[info[0]]
+
+    def _sweep_locked(self):
+        now = time.time()
+        for student_id in [k for k, v in self._students.items() if v[1] < now]:
+            del self._students[student_id]
+        for session_id in [k for k, v in self._sessions.items() if v[2] < now]:
+            del self._sessions[session_id]
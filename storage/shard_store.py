@@ -0,0 +1,172 @@
+"""Sharded local JSON storage: one small file per record.
+
+Each record lives at ``<root>/<part1>/<part2>/.../<last>.json`` so writers for
+different keys never touch the same file or contend on one lock.  Records are
+replaced atomically (temp file + ``os.replace``), which makes single-record
+writes last-writer-wins without any read-modify-write of a shared map.
+
+With ``locking=True`` writes hold the record's cross-process lock (see
+:mod:`storage.json_txn`), and :meth:`ShardedJsonStore.update` offers a
+read-modify-write of one record that other processes cannot interleave.
+"""
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+from storage.json_txn import file_lock
+
+_UNSAFE = {os.sep, '/', '\\', '\0'}
+
+
+def _safe_part(part: Any) -> str:
+    text = str(part)
+    text = ''.join('_' if ch in _UNSAFE else ch for ch in text).strip()
+    if text in ('', '.', '..'):
+        text = f"_{text.replace('.', '_')}_"
+    return text
+
+
+class ShardedJsonStore:
+    """Directory-backed key/value store of JSON records.
+
+    Args:
+        root_dir: directory that holds the shards.
+        fsync: fsync each record file after writing (the directory entry is
+            not fsynced; a crash can at worst revert to the previous record).
+        locking: serialize writers of a record across processes with a
+            sidecar ``<record>.json.lock`` file.
+        lock_for: ``lock_for(path)`` returns the in-process lock of a record
+            (only used with ``locking``).
+    """
+
+    def __init__(self, root_dir: str, fsync: bool = True, locking: bool = False,
+                 lock_for: Optional[Callable[[str], Any]] = None):
+        self.root_dir = root_dir
+        self.fsync = fsync
+        self.locking = locking
+        self.lock_for = lock_for
+
+    def path_for(self, parts: Sequence[Any]) -> str:
+        safe = [_safe_part(p) for p in parts]
+        return os.path.join(self.root_dir, *safe[:-1], f"{safe[-1]}.json")
+
+    def get(self, parts: Sequence[Any]) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path_for(parts), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def exists(self, parts: Sequence[Any]) -> bool:
+        return os.path.exists(self.path_for(parts))
+
+    @contextmanager
+    def _locked(self, path: str):
+        if not self.locking:
+            yield
+            return
+        with file_lock(path, self.lock_for(path) if self.lock_for else None):
+            yield
+
+    def put(self, parts: Sequence[Any], record: Dict[str, Any]):
+        path = self.path_for(parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._locked(path):
+            self._write(path, record)
+
+    def update(self, parts: Sequence[Any],
+               mutate: Callable[[Optional[Dict[str, Any]]], Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """Replace a record with ``mutate(current)`` (``current`` is ``None`` if missing).
+
+        When ``mutate`` returns ``None`` the record is left untouched.  Returns
+        the written record or ``None``.
+        """
+        path = self.path_for(parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._locked(path):
+            record = mutate(self.get(parts))
+            if record is not None:
+                self._write(path, record)
+            return record
+
+    def _write(self, path: str, record: Dict[str, Any]):
+        dirpath = os.path.dirname(path)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=dirpath)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False, separators=(',', ':'))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+            tmp = None
+        finally:
+            if tmp and os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def delete(self, parts: Sequence[Any]) -> bool:
+        path = self.path_for(parts)
+        with self._locked(path):
+            try:
+                os.remove(path)
+                return True
+            except FileNotFoundError:
+                return False
+
+    def iter_records(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Yield ``(path, record)`` for every stored record."""
+        for dirpath, _, filenames in os.walk(self.root_dir):
+            for name in filenames:
+                if not name.endswith('.json') or name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        yield path, json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    continue
+
+    def migrate_from_map(self, legacy_path: str, parts_for: Callable[[str, Dict[str, Any]], Optional[Iterable[Any]]]) -> int:
+        """Import a legacy ``{key: record}`` JSON file into shards.
+
+        ``parts_for(key, record)`` returns the shard key parts for a record (or
+        ``None`` to skip it).  Existing shards are never overwritten, since
+        they are newer than the legacy map.  The legacy file is renamed to
+        ``<legacy_path>.migrated`` afterwards so the import runs once.
+        Returns the number of records written.
+        """
+        if not os.path.exists(legacy_path):
+            return 0
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[SHARD_STORE] Could not read legacy map {legacy_path}: {e}")
+            return 0
+        if not isinstance(legacy, dict):
+            return 0
+
+        written = 0
+        for key, record in legacy.items():
+            if not isinstance(record, dict):
+                continue
+            parts = parts_for(key, record)
+            if not parts:
+                continue
+            parts = list(parts)
+            if self.exists(parts):
+                continue
+            self.put(parts, record)
+            written += 1
+
+        try:
+            os.replace(legacy_path, f"{legacy_path}.migrated")
+        except OSError as e:
+            print(f"[SHARD_STORE] Could not rename legacy map {legacy_path}: {e}")
+        print(f"[SHARD_STORE] Migrated {written} records from {legacy_path} to {self.root_dir}")
+        return written
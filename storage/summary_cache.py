@@ -0,0 +1,48 @@
+"""Memoized summary texts.
+
+A summary is keyed by ``(unit, stage, model, hash of the normalized
+conversation)``, so a reload, a retried request or a second worker asking for
+the same conversation gets the stored text instead of another model call.
+Concurrent requests for one conversation share a single call (see
+:class:`storage.memo_cache.MemoCache`).
+"""
+import hashlib
+import json
+from typing import Any, Dict, List
+
+from storage.memo_cache import MemoCache, DEFAULT_LEASE_TTL, DEFAULT_TTL
+
+
+def normalize_conversation(conversation) -> List[Dict[str, str]]:
+    """Keep user/assistant turns with non-empty text, stripped."""
+    normalized = []
+    for message in conversation or []:
+        if not isinstance(message, dict):
+            continue
+        role = message.get('role')
+        content = message.get('content')
+        if role in ('user', 'assistant') and isinstance(content, str) and content.strip():
+            normalized.append({'role': role, 'content': content.strip()})
+    return normalized
+
+
+class SummaryCache(MemoCache):
+    """Summary memoization store.
+
+    Args:
+        local_dir: directory for the file fallback.
+        redis_conn: optional Redis connection (shared by every process).
+        ttl: seconds a summary is kept.
+        lease_ttl: seconds a cross-process computation lease lasts.
+        key_prefix: Redis key prefix.
+    """
+
+    def __init__(self, local_dir: str, redis_conn=None, ttl: int = DEFAULT_TTL,
+                 lease_ttl: int = DEFAULT_LEASE_TTL, key_prefix: str = 'summary_memo'):
+        super().__init__(local_dir, redis_conn=redis_conn, ttl=ttl, lease_ttl=lease_ttl, key_prefix=key_prefix)
+
+    @staticmethod
+    def key(unit: Any, stage: str, conversation, model: str = '') -> str:
+        material = json.dumps([unit, stage, model, normalize_conversation(conversation)],
+                              ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
@@ -0,0 +1,99 @@
+"""Local summary repository: one record per (student, unit, stage).
+
+Records live in a :class:`ShardedJsonStore` (atomic, fsynced replace per
+record, written under the record's cross-process lock), so concurrent saves of different summaries never rewrite a shared
+file.  An in-memory index serves reads without taking a lock or parsing JSON;
+each hit is validated with one ``stat`` of the record file (inode and mtime;
+every save replaces the file) so summaries written by other processes, e.g.
+RQ workers, are picked up.
+"""
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from storage.shard_store import ShardedJsonStore
+
+_Key = Tuple[str, str, str]
+_Version = Tuple[int, int]
+
+
+class SummaryRepository:
+    """Summary records keyed by ``(student_id, unit, stage)``.
+
+    Args:
+        root_dir: directory holding ``<student_id>/<unit>/<stage>.json`` records.
+        lock_for: ``lock_for(path)`` returns the (re-entrant) in-process lock
+            of a record; without it all saves share one lock.
+    """
+
+    def __init__(self, root_dir: str, lock_for=None):
+        self._store = ShardedJsonStore(root_dir, locking=True, lock_for=lock_for)
+        self._lock_for = lock_for
+        self._write_lock = threading.RLock()
+        # key -> ((inode, mtime_ns) of the record file, record)
+        self._index: Dict[_Key, Tuple[_Version, Dict[str, Any]]] = {}
+
+    @staticmethod
+    def _key(student_id, unit, stage) -> _Key:
+        return str(student_id), str(unit), str(stage)
+
+    def _version(self, key: _Key) -> Optional[_Version]:
+        try:
+            st = os.stat(self._store.path_for(key))
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+    def get(self, student_id, unit, stage) -> Optional[Dict[str, Any]]:
+        """Return the stored record, or ``None``."""
+        key = self._key(student_id, unit, stage)
+        version = self._version(key)
+        if version is None:
+            self._index.pop(key, None)
+            return None
+        cached = self._index.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        record = self._store.get(key)
+        if record is not None:
+            self._index[key] = (version, record)
+        return record
+
+    def get_summary(self, student_id, unit, stage) -> str:
+        record = self.get(student_id, unit, stage)
+        return record.get('summary', '') if record else ''
+
+    def put(self, student_id, unit, stage, summary_text: str) -> Dict[str, Any]:
+        key = self._key(student_id, unit, stage)
+        record = {
+            'summary': summary_text,
+            'saved_at': datetime.now().isoformat(),
+            'student_id': student_id,
+            'unit': unit,
+            'stage': stage,
+        }
+        # Held around the write and the stat so the index gets this write's version.
+        lock = self._lock_for(self._store.path_for(key)) if self._lock_for else self._write_lock
+        with lock:
+            self._store.put(key, record)
+            version = self._version(key)
+            if version is not None:
+                self._index[key] = (version, record)
+        return record
+
+    def migrate_from_map(self, legacy_path: str) -> int:
+        """Import a legacy ``summary_storage.json`` map (``"<student>_<unit>_<stage>": record``)."""
+        def parts_for(key, record):
+            if not all(record.get(field) for field in ('student_id', 'unit', 'stage')):
+                print(f"[SUMMARY_REPO] Skipping entry without student_id/unit/stage: {key}")
+                return None
+            return self._key(record['student_id'], record['unit'], record['stage'])
+
+        return self._store.migrate_from_map(legacy_path, parts_for)
+
+    def __len__(self) -> int:
+        return len(self._index)
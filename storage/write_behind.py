@@ -0,0 +1,217 @@
+"""Background write-behind queue for persistence calls.
+
+Request handlers enqueue persistence work and return immediately; a small
+pool of worker threads drains the queue.  Three kinds of work are supported:
+
+- ``submit(fn, *args)``: run ``fn`` once in the background.
+- ``submit_keyed(key, fn, *args)``: like ``submit`` but only the latest
+  pending call for ``key`` runs (used for snapshot-style writes such as
+  session conversations, where intermediate snapshots are redundant).
+  Calls for one key never run concurrently: a call submitted while the
+  previous one is running runs right after it, so the newest snapshot is
+  always written last.  :meth:`WriteBehindQueue.pending_args` exposes the
+  not-yet-written snapshot so reads can see it.
+- ``submit_batch(group, item)``: items of the same group that are waiting
+  together are handed to the group's registered handler as one list
+  (group commit), e.g. many log entries appended in a single write.
+
+The queue is bounded.  When it is full the caller runs the work inline, so
+back-pressure slows requests down instead of dropping data.
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+_BATCH = 'batch'
+_TASK = 'task'
+_KEYED = 'keyed'
+
+
+class WriteBehindQueue:
+    def __init__(self, name: str = 'persistence', max_size: int = 2000, workers: int = 2,
+                 batch_size: int = 100, batch_wait: float = 0.02):
+        self.name = name
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self._queue: 'queue.Queue' = queue.Queue(maxsize=max_size)
+        self._handlers: Dict[str, Callable[[List[Any]], None]] = {}
+        # key -> latest call not started yet / call being run
+        self._keyed: Dict[str, tuple] = {}
+        self._running: Dict[str, tuple] = {}
+        self._keyed_lock = threading.Lock()
+        self._idle = threading.Condition()
+        self._in_flight = 0
+        self._stats = {'enqueued': 0, 'processed': 0, 'inline': 0, 'errors': 0, 'batches': 0}
+        self._stopped = False
+        self._workers = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._run, name=f"{name}-writer-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    # ------------------------------------------------------------------
+    # producer API
+    # ------------------------------------------------------------------
+    def register_batch_handler(self, group: str, handler: Callable[[List[Any]], None]):
+        self._handlers[group] = handler
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self._put((_TASK, (fn, args, kwargs)), lambda: fn(*args, **kwargs))
+
+    def submit_keyed(self, key: str, fn: Callable, *args, **kwargs):
+        with self._keyed_lock:
+            pending = key in self._keyed or key in self._running
+            self._keyed[key] = (fn, args, kwargs)
+        if pending:
+            # A queued token or the running call for this key will pick up the latest args.
+            return
+        self._put((_KEYED, key), lambda: self._run_keyed(key))
+
+    def submit_batch(self, group: str, item: Any):
+        if group not in self._handlers:
+            raise KeyError(f"no batch handler registered for {group!r}")
+        self._put((_BATCH, (group, item)), lambda: self._handlers[group]([item]))
+
+    def _put(self, work, inline: Callable[[], None]):
+        if self._stopped:
+            self._run_inline(inline)
+            return
+        with self._idle:
+            self._in_flight += 1
+        try:
+            self._queue.put_nowait(work)
+            self._count('enqueued')
+        except queue.Full:
+            with self._idle:
+                self._in_flight -= 1
+                self._idle.notify_all()
+            print(f"[WRITE_BEHIND] {self.name} queue full, writing inline")
+            self._run_inline(inline)
+
+    def _run_inline(self, inline: Callable[[], None]):
+        self._count('inline')
+        try:
+            inline()
+        except Exception as e:
+            self._count('errors')
+            print(f"[WRITE_BEHIND] {self.name} inline write failed: {type(e).__name__}: {e}")
+
+    # ------------------------------------------------------------------
+    # worker
+    # ------------------------------------------------------------------
+    def _run(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                return
+            items = [work]
+            deadline = time.monotonic() + self.batch_wait
+            while len(items) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    nxt = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    # Put the stop sentinel back for this worker's next loop.
+                    self._queue.put(None)
+                    break
+                items.append(nxt)
+            try:
+                self._process(items)
+            finally:
+                with self._idle:
+                    self._in_flight -= len(items)
+                    self._idle.notify_all()
+
+    def _process(self, items: List[tuple]):
+        batches: Dict[str, List[Any]] = {}
+        for kind, payload in items:
+            if kind == _BATCH:
+                group, item = payload
+                batches.setdefault(group, []).append(item)
+            elif kind == _KEYED:
+                self._safe(lambda: self._run_keyed(payload), payload)
+            else:
+                fn, args, kwargs = payload
+                self._safe(lambda: fn(*args, **kwargs), getattr(fn, '__name__', 'task'))
+        for group, group_items in batches.items():
+            self._count('batches')
+            self._safe(lambda: self._handlers[group](group_items), f"{group} x{len(group_items)}")
+            self._count('processed', len(group_items) - 1)
+
+    def _run_keyed(self, key: str):
+        """Run the latest call for ``key``, then any call submitted meanwhile."""
+        while True:
+            with self._keyed_lock:
+                call = self._keyed.pop(key, None)
+                if call is None:
+                    self._running.pop(key, None)
+                    return
+                self._running[key] = call
+            fn, args, kwargs = call
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self._count('errors')
+                print(f"[WRITE_BEHIND] {self.name} write failed ({key}): {type(e).__name__}: {e}")
+
+    def pending_args(self, key: str) -> Optional[tuple]:
+        """Positional args of the newest call for ``key`` that has not finished, if any."""
+        with self._keyed_lock:
+            call = self._keyed.get(key) or self._running.get(key)
+        return call[1] if call is not None else None
+
+    def _count(self, name: str, n: int = 1):
+        with self._idle:
+            self._stats[name] += n
+
+    def _safe(self, fn: Callable[[], None], label: str):
+        try:
+            fn()
+        except Exception as e:
+            self._count('errors')
+            print(f"[WRITE_BEHIND] {self.name} write failed ({label}): {type(e).__name__}: {e}")
+        finally:
+            self._count('processed')
+
+    # ------------------------------------------------------------------
+    # lifecycle / introspection
+    # ------------------------------------------------------------------
+    def depth(self) -> int:
+        """Number of enqueued or in-progress writes."""
+        return self._in_flight
+
+    def stats(self) -> Dict[str, Any]:
+        with self._idle:
+            counters = dict(self._stats)
+        return {
+            'name': self.name,
+            'depth': self.depth(),
+            'queued': self._queue.qsize(),
+            'capacity': self._queue.maxsize,
+            'workers': len(self._workers),
+            **counters,
+        }
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until every pending write has completed; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._in_flight > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def shutdown(self, timeout: Optional[float] = 10.0) -> bool:
+        """Flush pending writes and stop the workers.  Later submits run inline."""
+        flushed = self.flush(timeout)
+        self._stopped = True
+        for _ in self._workers:
+            self._queue.put(None)
+        if not flushed:
+            print(f"[WRITE_BEHIND] {self.name} shutdown timed out with {self.depth()} pending writes")
+        return flushed